@@ -1,2 +1,10 @@
 from cushyPostIntegration.cushyPostIntegration import CushyPostIntegration
 from cushyPostIntegration import exceptions
+from cushyPostIntegration.transport import HttpTransport, get_default_transport, set_default_transport
+from cushyPostIntegration.transport import AsyncHttpTransport, get_default_async_transport, set_default_async_transport
+from cushyPostIntegration.asyncCushyPostIntegration import AsyncCushyPostIntegration
+from cushyPostIntegration.cache import MemoryCache, SQLiteCache, LabelCache
+from cushyPostIntegration.business_days import BusinessCalendar, collection_dates
+from cushyPostIntegration.token_store import FileTokenStore, SQLiteTokenStore
+from cushyPostIntegration.mirror import ShipmentMirror
+from cushyPostIntegration import snapshot
@@ -0,0 +1,974 @@
+import asyncio
+import binascii
+import contextlib
+import inspect
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from cushyPostIntegration.cushyPostIntegration import CushyPostIntegration
+from cushyPostIntegration.logger_decorator import logger, logging
+from cushyPostIntegration.exceptions import LoginFailed, RefreshFailed, MissingToken, ShippingRateFailed, \
+    GeoDbAutoComplete, MissingFrom, MissingData, ApproveRateFailed, SearchPaidShipmentsFailed, SearchQuotationFailed, \
+    NoQuotationFoundFailed, AddToCartFailed, RemoveFromCartFailed, BuyCartFailed, ConfirmCartFailed, \
+    ConfirmCartMissingParameters, ShipmentLabelFailed
+from cushyPostIntegration.transport import get_default_async_transport
+from cushyPostIntegration.templates import CART_ITEM
+from cushyPostIntegration.models import Location
+
+# Threads where the tasks wait for the lock of the token store, apart from the default executor of the loop
+# where the lock is released, so that the waiting tasks can never hold up the release
+_token_store_lock_executor = ThreadPoolExecutor(thread_name_prefix="cushypost-token-store")
+
+
+class AsyncCushyPostIntegration(CushyPostIntegration):
+    def __init__(self, environment, app, token=None, refresh_token=None, transport=None, geo_cache=None,
+                 geo_negative_ttl=300, holiday_cache=None, token_refresh_margin=60, token_store=None,
+                 label_cache=None, rate_cache=None, deterministic_hashes=False):
+        """
+        Class initialization. Every call to CushyPost is a coroutine, the state handling is the same
+        of CushyPostIntegration
+        :param environment: TEST or PRD
+        :param app: app name for CushyPost
+        :param token: (optional) in case you already have a valid token
+        :param refresh_token: (optional) in case you already have a valid refresh token
+        :param transport: (optional) AsyncHttpTransport to use, by default the pooled one shared in the process
+        :param geo_cache: (optional) MemoryCache/SQLiteCache where the GeoDB locations are kept between instances
+        :param geo_negative_ttl: (optional) seconds for which a CAP without GeoDB results is not searched again
+        :param holiday_cache: (optional) MemoryCache/SQLiteCache where the holidays are kept between instances,
+                              by default an in process cache shared by all the instances
+        :param token_refresh_margin: (optional) seconds before the expiry of the token in which it gets refreshed
+        :param token_store: (optional) FileTokenStore/SQLiteTokenStore where the tokens are shared between processes
+        :param label_cache: (optional) LabelCache where the downloaded labels are kept for reprints
+        :param rate_cache: (optional) MemoryCache/SQLiteCache where the rates are kept, use a short ttl
+        :param deterministic_hashes: (optional) derive the hash of the packages from their content, instead of
+                                     a random one, so that identical shipments produce identical requests
+        """
+        super(AsyncCushyPostIntegration, self).__init__(
+            environment, app, token=token, refresh_token=refresh_token,
+            transport=transport if transport else get_default_async_transport(),
+            geo_cache=geo_cache,
+            geo_negative_ttl=geo_negative_ttl,
+            holiday_cache=holiday_cache,
+            token_refresh_margin=token_refresh_margin,
+            token_store=token_store,
+            label_cache=label_cache,
+            rate_cache=rate_cache,
+            deterministic_hashes=deterministic_hashes)
+        self.__token_refresher = None
+        self.__refresh_lock = None
+
+    @logger
+    async def login(self, username, password):
+        """
+        This method get the token and refresh_token starting a session with CushyPost.
+        With a token_store, the valid tokens already stored by another process are used instead
+        :param username:
+        :param password:
+        :return:
+        """
+        async with self.__token_store_lock():
+            if self.token_store is not None and self._use_valid_tokens(*await self.__run_in_executor(
+                    self.token_store.load)):
+                return
+            request_body = {
+                "app": self.app,
+                "username": username,
+                "password": password
+            }
+            response = await self.transport.request("POST",
+                                                    "{}/security/v1/login".format(self.domain),
+                                                    headers={'Content-Type': 'application/json'},
+                                                    data=json.dumps(request_body))
+            if response.status_code != 200:
+                logging.error(response.json())
+                raise LoginFailed()
+            self.token = response.headers.get('X-Cushypost-JWT')
+            self.refresh_token = response.headers.get('X-Cushypost-Refresh-JWT')
+            await self.__save_tokens()
+
+    @staticmethod
+    async def __run_in_executor(function, *args, **kwargs):
+        """
+        Run the blocking I/O of the token store in the default executor, out of the event loop
+        :param function:
+        :return:
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, partial(function, *args, **kwargs))
+
+    async def __save_tokens(self):
+        """
+
+        :return:
+        """
+        if self.token_store is not None:
+            await self.__run_in_executor(self.token_store.save, self.token, self.refresh_token)
+
+    @contextlib.asynccontextmanager
+    async def __token_store_lock(self):
+        """
+        Lock of the token store taken without blocking the event loop: the task waits for it in a thread
+        while another task, thread or process holds it
+        :return:
+        """
+        if self.token_store is None:
+            yield
+            return
+        owner = asyncio.current_task()
+        acquired = asyncio.get_running_loop().run_in_executor(_token_store_lock_executor,
+                                                              partial(self.token_store.acquire, owner=owner))
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # The thread keeps waiting, the lock is given back as soon as it gets it
+            acquired.add_done_callback(partial(self.__release_abandoned_lock, owner))
+            raise
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            await asyncio.shield(self.__run_in_executor(self.token_store.release, owner=owner, failed=failed))
+
+    def __release_abandoned_lock(self, owner, acquired):
+        """
+        Release the lock of the token store taken for a task cancelled while waiting for it
+        :param owner: task that was waiting for the lock
+        :param acquired: future of the acquisition
+        :return:
+        """
+        if not acquired.cancelled() and acquired.exception() is None:
+            asyncio.ensure_future(self.__run_in_executor(self.token_store.release, owner=owner))
+
+    @logger
+    async def refresh_tokens(self):
+        """
+        This method is refreshing the token using the refresh_token.
+        Refreshes are serialized, so that coroutines sharing the instance never use a consumed refresh_token
+        :return:
+        """
+        async with self.__get_refresh_lock():
+            await self.__refresh_tokens()
+
+    async def __refresh_tokens(self):
+        """
+        Refresh, to be called holding the refresh lock
+        :return:
+        """
+        async with self.__token_store_lock():
+            if self.token_store is not None and self._use_changed_tokens(*await self.__run_in_executor(
+                    self.token_store.load)):
+                # Already refreshed by another process
+                return
+            if not self.refresh_token:
+                raise MissingToken()
+            response = await self.transport.request("POST",
+                                                    "{}/security/refresh_token".format(self.domain),
+                                                    headers={'Content-Type': 'application/json',
+                                                             'Authorization': 'Bearer {}'.format(self.refresh_token)},
+                                                    data=json.dumps({"app": self.app}))
+            if response.status_code != 200:
+                logging.error(response.json())
+                raise RefreshFailed()
+            self.token = response.headers.get('X-Cushypost-JWT')
+            self.refresh_token = response.headers.get('X-Cushypost-Refresh-JWT')
+            await self.__save_tokens()
+
+    def __get_refresh_lock(self):
+        """
+        The lock is created lazily, as it needs to be bound to the running event loop
+        :return:
+        """
+        if self.__refresh_lock is None:
+            self.__refresh_lock = asyncio.Lock()
+        return self.__refresh_lock
+
+    @logger
+    async def __refresh_tokens_once(self, used_token):
+        """
+        Single flight refresh: the calls rejected with the same token trigger only one refresh,
+        the others wait for it and use the new token
+        :param used_token: token rejected by CushyPost
+        :return:
+        """
+        async with self.__get_refresh_lock():
+            if self.token == used_token:
+                await self.__refresh_tokens()
+
+    def start_token_refresher(self):
+        """
+        Refresh the token in a background task ahead of its expiry. It needs a running event loop.
+        The refresher stops once the token is about to expire without a refresh_token, start it again after
+        the next login
+        :return:
+        """
+        if self.__token_refresher is None or self.__token_refresher.done():
+            self.__token_refresher = asyncio.ensure_future(self.__refresh_tokens_in_background())
+
+    def stop_token_refresher(self):
+        """
+
+        :return:
+        """
+        if self.__token_refresher is not None:
+            self.__token_refresher.cancel()
+            self.__token_refresher = None
+
+    async def __refresh_tokens_in_background(self):
+        """
+
+        :return:
+        """
+        while True:
+            if self._token_cannot_be_renewed(self.token_refresh_margin):
+                logging.warning("Token refresher stopped: the token expires and there is no refresh token")
+                return
+            lifetime = self.token_lifetime()
+            await asyncio.sleep(self.token_refresh_margin if lifetime is None
+                                else max(lifetime - self.token_refresh_margin, 1))
+            if self._token_needs_refresh():
+                try:
+                    await self.refresh_tokens()
+                except Exception as error:
+                    logging.error(error)
+                    await asyncio.sleep(10)
+
+    @logger
+    async def __call_endpoint_with_refresh(self, http_method, path, params=None, data=None, retry=True):
+        """
+        Method that integrate CushyPost with the refreshToken call in case of 401.
+        A token close to its expiry is refreshed before the call, an expired one without refresh_token
+        raises MissingToken without calling CushyPost
+        :param http_method: GET/POST/PATCH/DELETE
+        :param path: path on CushyPost
+        :param data: body of the message as string
+        :param retry: (Optional) Flag to trigger retry. Do not populate
+        :return:
+        """
+        if retry and self.token_store is not None and not self.__get_refresh_lock().locked():
+            self._use_changed_tokens(*await self.__run_in_executor(self.token_store.load))
+        if retry and self._token_cannot_be_renewed():
+            raise MissingToken()
+        if retry and self._token_needs_refresh():
+            try:
+                await self.__refresh_tokens_once(self.token)
+            except RefreshFailed:
+                # The token is still valid, the 401 handling is still in place
+                pass
+        token = self.token
+        response = await self.transport.request(http_method,
+                                                "{}/{}".format(self.domain, path),
+                                                headers={'Content-Type': 'application/json',
+                                                         'Authorization': 'Bearer {}'.format(token)},
+                                                data=data,
+                                                params=params)
+        if response.status_code == 401 and retry:
+            await self.__refresh_tokens_once(token)
+            return await self.__call_endpoint_with_refresh(http_method, path, params=params, data=data, retry=False)
+        return response
+
+    @logger
+    async def __geo_db_place_autocomplete(self, country_code, cap, city=None, multi_results=False):
+        """
+        Integration of autocomplete
+        :param country_code:
+        :param cap:
+        :param multi_results: In case you are actually searching the DB
+        :return:
+        """
+        if not self.token:
+            raise MissingToken()
+        memoized = self._geo_db_memoized(country_code, cap, city, multi_results)
+        if memoized is not None:
+            return memoized
+        request_body = {
+            "app": self.app,
+            "country_code": country_code,
+            "sequence": "{} {}".format(cap, city) if city else cap,
+            "limit": 10
+        }
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "geodb/place_autocomplete",
+                                                           data=json.dumps(request_body))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise GeoDbAutoComplete()
+        locations = response.json()["response"]["data"]
+        if multi_results:
+            self._store_geo_db_locations(country_code, cap, city, locations)
+            return locations
+        if len(locations) == 0:
+            # This part is useful for the quotation part! As the CAP define the price.
+            locations = await self.__geo_db_place_autocomplete(country_code, cap, multi_results=True)
+            if len(locations) == 0:
+                raise GeoDbAutoComplete()
+            self.geo_db_misses.set(self._geo_db_fallback_key(country_code, cap, city), locations[0])
+        return locations[0]
+
+    @logger
+    async def search_geo_db(self, country_code, cap):
+        """
+        This method is searching the DB, returning all the location that maches
+        :param country_code:
+        :param cap:
+        :return:
+        """
+        return await self.__geo_db_place_autocomplete(country_code, cap, multi_results=True)
+
+    @logger
+    async def set_from(self, country_code, cap, city):
+        await self.__set_elem(country_code, cap, city, "from_location", "from")
+
+    @logger
+    async def set_to(self, country_code, cap, city):
+        await self.__set_elem(country_code, cap, city, "to_location", "to")
+
+    @logger
+    async def __set_elem(self, country_code, cap, city, elem, elem_name):
+        """
+        Here we are expecting a real zipcode.
+        :param country_code:
+        :param cap:
+        :param elem:
+        :param elem_name:
+        :return:
+        """
+        location = await self.__resolve_location(country_code, cap, city)
+        self._set_node(elem, Location.from_geo_db(country_code, cap, location, elem_name))
+
+    @logger
+    async def __resolve_location(self, country_code, cap, city):
+        """
+        Get the GeoDB location, from the data already collected when available
+        :param country_code:
+        :param cap:
+        :param city:
+        :return:
+        """
+        geo_db_data_key = "{}_{}_{}".format(country_code, cap, city)
+        if self.geo_db_data.get(geo_db_data_key):
+            return self.geo_db_data[geo_db_data_key]
+        location = self.geo_cache.get(geo_db_data_key) if self.geo_cache is not None else None
+        if location is None:
+            location = await self.__geo_db_place_autocomplete(country_code, cap, city)
+            if self.geo_cache is not None:
+                self.geo_cache.set(geo_db_data_key, location)
+        return location
+
+    @logger
+    async def set_services(self, year, month=None, day=None, insurance_value=None, cash_on_delivery=None):
+        """
+        Generation of the services node
+        :param year:
+        :param month (optional)
+        :param day (optional)
+        :param insurance_value (optional)
+        :param cash_on_delivery (optional)
+        :return:
+        """
+        if not self._has_node("from_location"):
+            raise MissingFrom()
+        if not self.token:
+            raise MissingToken()
+        country = self._from_country()
+        calendar = self._business_calendar(country, year, await self.__get_holidays(country, year))
+        self.services = self._services_model(self._collection_date(year, month=month, day=day, calendar=calendar),
+                                             insurance_value=insurance_value,
+                                             cash_on_delivery=cash_on_delivery)
+
+    @logger
+    async def __get_holidays(self, country, year, refresh=False):
+        """
+        Get the holidays of the country, from the holiday cache when available
+        :param country:
+        :param year:
+        :param refresh: (optional) ignore the cached calendar
+        :return: the holidays, None in case they are not available
+        """
+        holiday_cache_key = "{}_{}".format(country, year)
+        holidays = None if refresh else self.holiday_cache.get(holiday_cache_key)
+        if holidays is not None:
+            return holidays
+        request_body = {
+            "app": self.app,
+            "country": country,
+            "year": year
+        }
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "calendar/holidays",
+                                                           data=json.dumps(request_body))
+        if response.status_code != 200:
+            return None
+        holidays = response.json()["response"]["data"]
+        self.holiday_cache.set(holiday_cache_key, holidays)
+        return holidays
+
+    @logger
+    async def refresh_holidays(self, country, year):
+        """
+        Download again the holidays of the country, replacing the cached ones
+        :param country:
+        :param year:
+        :return: the holidays, None in case they are not available
+        """
+        if not self.token:
+            raise MissingToken()
+        return await self.__get_holidays(country, year, refresh=True)
+
+    @logger
+    async def preload_holidays(self, countries, years):
+        """
+        Fill the holiday cache, e.g. at startup
+        :param countries: list of country codes
+        :param years: list of years
+        :return:
+        """
+        if not self.token:
+            raise MissingToken()
+        await asyncio.gather(*[self.__get_holidays(country, year) for country in countries for year in years])
+
+    @logger
+    async def get_rates(self, use_cache=True):
+        """
+        Call to get rates. The rates read from the rate cache have no quotation id: to approve one of them
+        get the rates again with use_cache=False
+        :param use_cache: (optional) with False CushyPost is called also when the rates are cached
+        :return:
+        """
+        if not self.token:
+            raise MissingToken()
+        if not all(self._has_node(name) for name in self.MODEL_NODES):
+            raise MissingData()
+        return await self.__rate(self._current_rates_body(), use_cache=use_cache)
+
+    @logger
+    async def __rate(self, request_body, use_cache=True):
+        """
+        Call to shipment/rate, the rate cache is consulted before calling CushyPost.
+        The rates are cached without the quotation ids, that belong only to the caller that got them
+        :param request_body:
+        :param use_cache: (optional) with False the cached rates are ignored, and replaced
+        :return:
+        """
+        rate_cache_key = self._rate_cache_key(request_body) if self.rate_cache is not None else None
+        if rate_cache_key is not None and use_cache:
+            rates = self.rate_cache.get(rate_cache_key)
+            if rates is not None:
+                return rates
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "shipment/rate",
+                                                           data=self._encode_rates_body(request_body))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise ShippingRateFailed()
+        rates = response.json()["response"]["data"]
+        if rate_cache_key is not None:
+            self.rate_cache.set(rate_cache_key, self._rates_without_quotations(rates))
+        return rates
+
+    @logger
+    def get_rates_batch(self, rate_requests, max_concurrency=10):
+        """
+        Rate many shipments concurrently, without touching the shipment stored on the instance.
+        Locations and holidays are resolved once for every distinct key
+        :param rate_requests: list of shipments as described in CushyPostIntegration.get_rates_batch
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: async generator of {"index": ..., "data": ..., "error": ...} in order of completion
+        """
+        if not self.token:
+            raise MissingToken()
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be greater than 0")
+        rate_requests = list(rate_requests)
+        location_keys = set()
+        holiday_keys = set()
+        for rate_request in rate_requests:
+            try:
+                location_keys.update(self._rate_request_location_keys(rate_request))
+                holiday_keys.add(self._rate_request_holiday_key(rate_request))
+            except Exception:
+                # The error is reported by the rate of the single shipment
+                pass
+        return self.__rates_batch(rate_requests, max_concurrency, location_keys, holiday_keys)
+
+    async def __rates_batch(self, rate_requests, max_concurrency, location_keys, holiday_keys):
+        """
+        Async generator of get_rates_batch, the calls start at the first result requested
+        :param rate_requests:
+        :param max_concurrency:
+        :param location_keys: keys of the locations to resolve
+        :param holiday_keys: keys of the holidays calendars to get
+        :return:
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def bounded(coroutine_function, *args):
+            async with semaphore:
+                return await coroutine_function(*args)
+
+        async def rate(index, rate_request):
+            try:
+                from_key, to_key = self._rate_request_location_keys(rate_request)
+                request_body = self._rate_request_body(rate_request,
+                                                       await locations[from_key],
+                                                       await locations[to_key],
+                                                       await holidays[self._rate_request_holiday_key(rate_request)],
+                                                       location_models=location_models)
+                return {"index": index, "data": await bounded(self.__rate, request_body), "error": None}
+            except Exception as error:
+                return {"index": index, "data": None, "error": error}
+
+        locations = {key: asyncio.ensure_future(bounded(self.__resolve_location, *key)) for key in location_keys}
+        holidays = {key: asyncio.ensure_future(bounded(self.__get_holidays, *key)) for key in holiday_keys}
+        location_models = {}
+        rates = [asyncio.ensure_future(rate(index, rate_request)) for index, rate_request in enumerate(rate_requests)]
+        try:
+            for next_rate in asyncio.as_completed(rates):
+                yield await next_rate
+        finally:
+            # When the caller stops early, the calls not completed are cancelled
+            for future in list(locations.values()) + list(holidays.values()) + rates:
+                future.cancel()
+
+    @logger
+    async def rate_matrix(self, origins, destinations, parcels, services=None, max_concurrency=10):
+        """
+        Rate every origin x destination x parcel profile, as in CushyPostIntegration.rate_matrix
+        :param origins: list of locations like {"country_code": "IT", "cap": "00150", "city": "Roma"}
+        :param destinations: list of locations like the origins
+        :param parcels: list of parcel profiles, each one the list of packages of set_shipping
+        :param services: (optional) parameters of set_services, by default the collection is from tomorrow
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: table as a dictionary column -> list, one row for each rate (or error) of each lane and profile
+        """
+        lanes, rate_requests = self._rate_matrix_requests(origins, destinations, parcels, services)
+        return self._rate_matrix_table(lanes, [result async for result in self.get_rates_batch(
+            rate_requests, max_concurrency=max_concurrency)])
+
+    @logger
+    async def approve_quotation(self, quotation_id, from_extra_data, to_extra_data, shipping_extra_data=None):
+        """
+        Call to approve a rate
+        :param quotation_id: id of the rate to approve, the cached rates have none
+        :param from_extra_data: data with all the info for from address
+        :param to_extra_data: data with all the info for to address
+        :param shipping_extra_data: (optional) data with description and special instructions.
+                                    It needs to contains the has of the packages for which
+                                    we want to modify the description
+        :return:
+        """
+        if not self.token:
+            raise MissingToken()
+        if not quotation_id or not self.from_location or not self.to_location or not self.shipping \
+                or not self.services:
+            raise MissingData()
+        request_body = self._approve_quotation_body(quotation_id, from_extra_data, to_extra_data,
+                                                    shipping_extra_data=shipping_extra_data)
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "quotation/approve",
+                                                           data=json.dumps(request_body))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise ApproveRateFailed()
+        return response.json()["response"]["data"]
+
+    @logger
+    async def search_paid_shipping(self, page=None, page_size=None):
+        """
+
+        :param page: (optional) the endpoint has pagination
+        :param page_size: (optional) number of shipments in a page, 10 by default
+        :return:
+        """
+        if page is None:
+            page = 0
+        request_body = self._search_paid_shipping_body(page, page_size=page_size if page_size else 10)
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "shipment/search",
+                                                           data=request_body)
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise SearchPaidShipmentsFailed()
+        return response.json()["response"]["data"]
+
+    @logger
+    async def search_quotation_to_pay(self, page=None, page_size=None):
+        """
+
+        :param page: (optional) the endpoint has pagination
+        :param page_size: (optional) number of shipments in a page, 10 by default
+        :return:
+        """
+        if page is None:
+            page = 0
+        request_body = self._search_quotation_to_pay_body(page, page_size=page_size if page_size else 10)
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "shipment/search",
+                                                           data=request_body)
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise SearchQuotationFailed()
+        return response.json()["response"]["data"]
+
+    @logger
+    async def iter_paid_shipments(self, page_size=50, prefetch=True):
+        """
+        Iterate over all the paid shipments, one page at a time
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param prefetch: (optional) download the next page while the current one is consumed
+        :return: async generator of shipments
+        """
+        async for item in self.__iter_pages(self.search_paid_shipping, page_size, prefetch):
+            yield item
+
+    @logger
+    async def iter_quotations_to_pay(self, page_size=50, prefetch=True):
+        """
+        Iterate over all the quotations to pay, one page at a time
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param prefetch: (optional) download the next page while the current one is consumed
+        :return: async generator of shipments
+        """
+        async for item in self.__iter_pages(self.search_quotation_to_pay, page_size, prefetch):
+            yield item
+
+    @logger
+    async def search_all_paid_shipping(self, page_size=100, max_concurrency=4):
+        """
+        Download all the paid shipments, fetching the pages concurrently
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: list of shipments in the order of the search
+        """
+        return await self.__search_all(self.search_paid_shipping, page_size, max_concurrency)
+
+    @logger
+    async def search_all_quotation_to_pay(self, page_size=100, max_concurrency=4):
+        """
+        Download all the quotations to pay, fetching the pages concurrently
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: list of shipments in the order of the search
+        """
+        return await self.__search_all(self.search_quotation_to_pay, page_size, max_concurrency)
+
+    async def __search_all(self, search, page_size, max_concurrency):
+        """
+        The first page tells the total, the others are fetched in parallel
+        :param search: search coroutine with page and page_size parameters
+        :param page_size:
+        :param max_concurrency:
+        :return:
+        """
+        first_page = await search(0, page_size)
+        if not self._has_next_page(first_page, 1, page_size):
+            return self._merge_pages([first_page])
+        if first_page.get("total") is None:
+            # No way to know the number of pages
+            return self._merge_pages([first_page] + [{"items": [item async for item in self.__iter_pages(
+                lambda page, size: search(page + 1, size), page_size, prefetch=False)]}])
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def bounded_search(page):
+            async with semaphore:
+                return await search(page, page_size)
+
+        pages = await asyncio.gather(*[bounded_search(page) for page in range(1, -(-first_page["total"] // page_size))])
+        return self._merge_pages([first_page] + list(pages))
+
+    async def __iter_pages(self, search, page_size, prefetch):
+        """
+
+        :param search: search coroutine with page and page_size parameters
+        :param page_size:
+        :param prefetch:
+        :return:
+        """
+        page = 0
+        next_page = asyncio.ensure_future(search(page, page_size)) if prefetch else None
+        try:
+            while True:
+                response_data = await next_page if prefetch else await search(page, page_size)
+                items = response_data.get("items", [])
+                page += 1
+                has_next_page = self._has_next_page(response_data, page, page_size)
+                if prefetch and has_next_page:
+                    next_page = asyncio.ensure_future(search(page, page_size))
+                for item in items:
+                    yield item
+                if not has_next_page:
+                    return
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+
+    @logger
+    async def search_by_quotation_id(self, quotation_ids, page=None, page_size=None):
+        """
+
+        :param quotation_ids: quotation to get
+        :param page: (optional) page to start to search
+        :param page_size: (optional) number of shipments downloaded with each call, 10 by default
+        :return: list of shipment ids and list of tracking URL, in the order in which they are found
+        """
+        shipments = await self.search_shipments_by_quotation_id(quotation_ids, page=page, page_size=page_size)
+        if len(shipments) != len(set(quotation_ids)):
+            raise NoQuotationFoundFailed()
+        return [shipment_id for shipment_id, _ in shipments.values()], \
+               [tracking_url for _, tracking_url in shipments.values()]
+
+    @logger
+    async def search_shipments_by_quotation_id(self, quotation_ids, page=None, page_size=None):
+        """
+        Scan the quotations to pay until all the quotations are found or the pages are over
+        :param quotation_ids: quotation to get
+        :param page: (optional) page to start to search
+        :param page_size: (optional) number of shipments downloaded with each call, 10 by default
+        :return: dictionary quotation id -> (shipment id, tracking URL) of the quotations found
+        """
+        page = 0 if page is None else page
+        missing_quotation_ids = set(quotation_ids)
+        shipments = {}
+        while missing_quotation_ids:
+            items = (await self.search_quotation_to_pay(page, page_size=page_size)).get("items", [])
+            if len(items) == 0:
+                break
+            for item in items:
+                quotation_id = item["quotation"]["id"]
+                if quotation_id in missing_quotation_ids:
+                    missing_quotation_ids.discard(quotation_id)
+                    shipments[quotation_id] = (item["_id"]["$oid"],
+                                               (item.get("contract") or {}).get("tracking_url_format", ""))
+            page += 1
+        return shipments
+
+    @logger
+    async def add_shipping_ids_to_cart(self, shipping_ids, max_concurrency=None):
+        """
+
+        :param shipping_ids: Shipping ids to add
+        :param max_concurrency: (optional) add the shipments in parallel, with at most this number of calls in flight.
+                                The result is then a dictionary shipping id -> {"data": ..., "error": ...}
+                                and on failure only the shipments added are removed, the outcomes of the
+                                additions and of the removals are on AddToCartFailed
+        :return:
+        """
+        if max_concurrency is not None:
+            outcomes = await self.__run_cart_items(self.__add_shipping_id_to_cart, shipping_ids, max_concurrency)
+            added_ids = [shipping_id for shipping_id, outcome in outcomes.items() if outcome["error"] is None]
+            if len(added_ids) != len(outcomes):
+                removal_outcomes = await self.remove_shipping_ids_to_cart(
+                    added_ids, raise_error=False, max_concurrency=max_concurrency)
+                raise AddToCartFailed(outcomes, removal_outcomes)
+            return outcomes
+        response = None
+        for shipping_id in shipping_ids:
+            try:
+                response = await self.__add_shipping_id_to_cart(shipping_id)
+            except AddToCartFailed:
+                await self.remove_shipping_ids_to_cart(shipping_ids, raise_error=False)
+                raise
+        return response
+
+    @logger
+    async def remove_shipping_ids_to_cart(self, shipping_ids, raise_error=True, max_concurrency=None):
+        """
+
+        :param shipping_ids: Shipping ids to remove
+        :param raise_error: (optional) continue removing without raising error
+        :param max_concurrency: (optional) remove the shipments in parallel, with at most this number of calls in
+                                flight. The result is then a dictionary shipping id -> {"data": ..., "error": ...},
+                                also when the removals failed and raise_error is False
+        :return:
+        """
+        if max_concurrency is not None:
+            outcomes = await self.__run_cart_items(lambda shipping_id: self.__remove_shipping_id_from_cart(
+                shipping_id, raise_error), shipping_ids, max_concurrency)
+            if raise_error and any(outcome["error"] is not None for outcome in outcomes.values()):
+                raise RemoveFromCartFailed(outcomes)
+            return outcomes
+        response = None
+        for shipping_id in shipping_ids:
+            response = await self.__remove_shipping_id_from_cart(shipping_id, raise_error)
+        return response
+
+    async def __add_shipping_id_to_cart(self, shipping_id):
+        """
+
+        :param shipping_id: Shipping id to add
+        :return:
+        """
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "cart/item",
+                                                           data=CART_ITEM.bind(app=self.app).render(id=shipping_id))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise AddToCartFailed()
+        return response.json().get("response", {}).get("data")
+
+    async def __remove_shipping_id_from_cart(self, shipping_id, raise_error):
+        """
+
+        :param shipping_id: Shipping id to remove
+        :param raise_error: raise an error when the removal fails
+        :return:
+        """
+        request_body = {
+            "app": self.app,
+            "id": shipping_id
+        }
+        response = await self.__call_endpoint_with_refresh("DELETE",
+                                                           "cart/item",
+                                                           params=request_body)
+        if response.status_code != 200 and raise_error:
+            logging.error(response.json())
+            raise RemoveFromCartFailed()
+        return response.json().get("response", {}).get("data")
+
+    @staticmethod
+    async def __run_cart_items(coroutine_function, shipping_ids, max_concurrency):
+        """
+
+        :param coroutine_function: coroutine function adding or removing a single shipping id
+        :param shipping_ids:
+        :param max_concurrency:
+        :return: dictionary shipping id -> {"data": ..., "error": ...}, in the order of shipping_ids
+        """
+        shipping_ids = list(dict.fromkeys(shipping_ids))
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run(shipping_id):
+            async with semaphore:
+                try:
+                    return {"data": await coroutine_function(shipping_id), "error": None}
+                except Exception as error:
+                    return {"data": None, "error": error}
+
+        return dict(zip(shipping_ids, await asyncio.gather(*[run(shipping_id) for shipping_id in shipping_ids])))
+
+    @logger
+    async def buy_cart(self, success_url, cancel_url, description):
+        """
+
+        :param success_url: Page to come back after payment
+        :param cancel_url: Page to come back if payment is cancelled
+        :param description: Description on the payment page
+        :return:
+        """
+        request_body = {
+            "app": self.app,
+            "success_url": success_url,
+            "cancel_url": cancel_url,
+            "description": description
+        }
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "cart/buy",
+                                                           data=json.dumps(request_body))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise BuyCartFailed()
+        response_data = response.json()["response"]["data"]
+        self.checkout_session_id = response_data["id"]
+        return response_data["url"]
+
+    @logger
+    async def confirm_cart(self):
+        """
+
+        :return:
+        """
+        if not self.checkout_session_id:
+            raise ConfirmCartMissingParameters()
+        request_body = {
+            "app": self.app,
+            "session_id": self.checkout_session_id
+        }
+        response = await self.__call_endpoint_with_refresh("POST",
+                                                           "cart/confirm",
+                                                           data=json.dumps(request_body))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise ConfirmCartFailed()
+        return response.json()["response"]["data"]
+
+    @logger
+    async def get_shipment_label(self, shipping_ids):
+        """
+
+        :param shipping_ids: Label to download
+        :return:
+        """
+        shipment_labels = []
+        for shipping_id in shipping_ids:
+            try:
+                if self.label_cache is None:
+                    shipment_labels.append(await self.__get_shipment_label(shipping_id))
+                else:
+                    shipment_labels.append(binascii.b2a_base64(await self.__get_shipment_label_content(shipping_id),
+                                                               newline=False).decode())
+            except ShipmentLabelFailed:
+                continue
+        return shipment_labels
+
+    @logger
+    async def download_shipment_labels(self, shipping_ids, sink, max_concurrency=8):
+        """
+        Download the labels concurrently, writing each one to the sink as soon as it arrives,
+        so that the memory used does not depend on the number of labels
+        :param shipping_ids: Label to download, any iterable
+        :param sink: directory where the labels are saved as <shipping id>.pdf, file-like object
+                     where the labels are appended, or function (or coroutine function) called with
+                     the shipping id and the PDF content
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: dictionary shipping id -> {"data": size of the label in bytes, "error": ...}
+        """
+        write_label = self._label_writer(sink)
+        shipping_ids = iter(shipping_ids)
+        outcomes = {}
+
+        async def download():
+            for shipping_id in shipping_ids:
+                try:
+                    label = await self.__get_shipment_label_content(shipping_id)
+                    written = write_label(shipping_id, label)
+                    if inspect.isawaitable(written):
+                        await written
+                    outcomes[shipping_id] = {"data": len(label), "error": None}
+                except Exception as error:
+                    logging.error("Label of %s not downloaded: %s", shipping_id, error)
+                    outcomes[shipping_id] = {"data": None, "error": error}
+
+        await asyncio.gather(*[download() for _ in range(max(1, max_concurrency))])
+        return outcomes
+
+    async def __get_shipment_label_content(self, shipping_id):
+        """
+        The label cache is consulted before calling CushyPost
+        :param shipping_id: Label to download
+        :return: content of the label, the PDF bytes
+        """
+        label = self.label_cache.get(shipping_id) if self.label_cache is not None else None
+        if label is None:
+            label = binascii.a2b_base64(await self.__get_shipment_label(shipping_id))
+            if self.label_cache is not None:
+                self.label_cache.set(shipping_id, label)
+        return label
+
+    async def __get_shipment_label(self, shipping_id):
+        """
+
+        :param shipping_id: Label to download
+        :return: label, base64 encoded
+        """
+        request_body = {
+            "app": self.app,
+            "shipment_id": shipping_id
+        }
+        response = await self.__call_endpoint_with_refresh("GET",
+                                                           "shipment/label",
+                                                           params=request_body)
+        label = response.json().get("response", {}).get("data") if response.status_code == 200 else None
+        if not label:
+            raise ShipmentLabelFailed()
+        return label
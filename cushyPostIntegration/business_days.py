@@ -0,0 +1,85 @@
+import datetime
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class BusinessCalendar:
+    def __init__(self, holidays=None):
+        """
+        Business days calendar: Monday to Friday, holidays excluded.
+        When numpy is installed the dates are rolled with numpy.busday_offset in a single pass
+        :param holidays: (optional) holidays as returned by calendar/holidays, or as "YYYY-MM-DD" strings or dates
+        """
+        self.holidays = frozenset(self.__to_date(holiday) for holiday in (holidays or []))
+        self.__busday_calendar = numpy.busdaycalendar(weekmask="1111100",
+                                                      holidays=sorted(self.holidays)) if numpy is not None else None
+
+    @staticmethod
+    def __to_date(holiday):
+        """
+
+        :param holiday:
+        :return:
+        """
+        if isinstance(holiday, dict):
+            holiday = holiday["date"]
+        if isinstance(holiday, str):
+            return datetime.date.fromisoformat(holiday)
+        if isinstance(holiday, datetime.datetime):
+            return holiday.date()
+        return holiday
+
+    def is_business_day(self, date):
+        """
+
+        :param date: date or datetime
+        :return:
+        """
+        date = self.__to_date(date)
+        return date.weekday() < 5 and date not in self.holidays
+
+    def roll_forward(self, dates):
+        """
+        Move every date that is not a business day to the next business day.
+        The time of the datetimes is kept
+        :param dates: list of dates or datetimes
+        :return: list of the rolled dates, in the same order
+        """
+        if not dates:
+            return []
+        days = [self.__to_date(date) for date in dates]
+        if self.__busday_calendar is not None:
+            days_array = numpy.array(days, dtype="datetime64[D]")
+            offsets = (numpy.busday_offset(days_array, 0, roll="forward", busdaycal=self.__busday_calendar) -
+                       days_array).astype(int).tolist()
+        else:
+            offsets = []
+            for day in days:
+                offset = 0
+                while not self.is_business_day(day + datetime.timedelta(days=offset)):
+                    offset += 1
+                offsets.append(offset)
+        return [date + datetime.timedelta(days=offset) if offset else date for date, offset in zip(dates, offsets)]
+
+
+def collection_dates(requested_dates, countries, calendars):
+    """
+    Compute the collection dates of many shipments at once, without calling CushyPost
+    :param requested_dates: list of the first dates (or datetimes) in which the collection can happen
+    :param countries: list of the countries of collection, one for each date
+    :param calendars: dictionary country -> BusinessCalendar. Countries missing only skip the week ends
+    :return: list of the collection dates, in the same order
+    """
+    if len(requested_dates) != len(countries):
+        raise ValueError("requested_dates and countries must have the same length")
+    indexes_by_country = {}
+    for index, country in enumerate(countries):
+        indexes_by_country.setdefault(country, []).append(index)
+    results = [None] * len(requested_dates)
+    for country, indexes in indexes_by_country.items():
+        calendar = calendars.get(country) or BusinessCalendar()
+        for index, date in zip(indexes, calendar.roll_forward([requested_dates[index] for index in indexes])):
+            results[index] = date
+    return results
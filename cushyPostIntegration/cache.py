@@ -0,0 +1,334 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    def __init__(self, ttl=None, max_entries=None):
+        """
+        In process LRU cache
+        :param ttl: (optional) seconds after which an entry expires, None to keep it forever
+        :param max_entries: (optional) maximum number of entries, the least recently used are evicted
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return: the value, None in case it is missing or expired
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self.__entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """
+
+        :param key:
+        :param value:
+        :param ttl: (optional) override the ttl of the cache for this entry
+        :return:
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        with self.__lock:
+            self.__entries[key] = (value, time.time() + ttl if ttl is not None else None)
+            self.__entries.move_to_end(key)
+            while self.max_entries is not None and len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+
+        :param key:
+        :return:
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        """
+
+        :return: hits, misses and number of entries
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+
+class SQLiteCache:
+    def __init__(self, path, table="cache", ttl=None, max_entries=None):
+        """
+        LRU cache stored on a SQLite database, so that it can be shared between processes.
+        Values need to be JSON serializable
+        :param path: path of the database file
+        :param table: (optional) table to use, so that many caches can share the same file
+        :param ttl: (optional) seconds after which an entry expires, None to keep it forever
+        :param max_entries: (optional) maximum number of entries, the least recently used are evicted
+        """
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                  "expires_at REAL, accessed_at REAL NOT NULL)".format(table))
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS {0}_accessed_at ON {0} (accessed_at)".format(table))
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return: the value, None in case it is missing or expired
+        """
+        now = time.time()
+        with self.__lock:
+            row = self.__connection.execute("SELECT value, expires_at FROM {} WHERE key = ?".format(self.table),
+                                            (key,)).fetchone()
+            if row is not None and row[1] is not None and row[1] < now:
+                self.__connection.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.__connection.execute("UPDATE {} SET accessed_at = ? WHERE key = ?".format(self.table), (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """
+
+        :param key:
+        :param value:
+        :param ttl: (optional) override the ttl of the cache for this entry
+        :return:
+        """
+        now = time.time()
+        ttl = ttl if ttl is not None else self.ttl
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO {} (key, value, expires_at, accessed_at) "
+                                      "VALUES (?, ?, ?, ?)".format(self.table),
+                                      (key, json.dumps(value), now + ttl if ttl is not None else None, now))
+            if self.max_entries is not None:
+                self.__connection.execute("DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY accessed_at DESC "
+                                          "LIMIT -1 OFFSET ?)".format(self.table), (self.max_entries,))
+
+    def delete(self, key):
+        """
+
+        :param key:
+        :return:
+        """
+        with self.__lock:
+            self.__connection.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        with self.__lock:
+            self.__connection.execute("DELETE FROM {}".format(self.table))
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+
+    def stats(self):
+        """
+
+        :return: hits, misses and number of entries
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+    def close(self):
+        """
+
+        :return:
+        """
+        self.__connection.close()
+
+
+class LabelCache:
+    def __init__(self, directory, max_bytes=None):
+        """
+        Content addressed cache of the shipment labels on disk: each PDF is saved once, named by its SHA-256,
+        and a SQLite index maps the shipment ids to the PDFs
+        :param directory: directory of the cache, created when missing
+        :param max_bytes: (optional) maximum size of the PDFs, the least recently used labels are evicted
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.__connection = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=30,
+                                            check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS labels (shipping_id TEXT PRIMARY KEY, "
+                                  "digest TEXT NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS labels_accessed_at ON labels (accessed_at)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS labels_digest ON labels (digest)")
+
+    def __path(self, digest):
+        """
+
+        :param digest:
+        :return: path of the PDF
+        """
+        return os.path.join(self.directory, "{}.pdf".format(digest))
+
+    def get(self, shipping_id):
+        """
+
+        :param shipping_id:
+        :return: content of the label, None in case it is missing
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT digest FROM labels WHERE shipping_id = ?",
+                                            (shipping_id,)).fetchone()
+            content = None
+            if row is not None:
+                try:
+                    with open(self.__path(row[0]), "rb") as file:
+                        content = file.read()
+                except FileNotFoundError:
+                    self.__connection.execute("DELETE FROM labels WHERE shipping_id = ?", (shipping_id,))
+            if content is None:
+                self.misses += 1
+                return None
+            self.__connection.execute("UPDATE labels SET accessed_at = ? WHERE shipping_id = ?",
+                                      (time.time(), shipping_id))
+            self.hits += 1
+            return content
+
+    def set(self, shipping_id, content):
+        """
+
+        :param shipping_id:
+        :param content: content of the label, the PDF bytes
+        :return:
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        with self.__lock:
+            path = self.__path(digest)
+            if not os.path.exists(path):
+                temporary_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+                with open(temporary_path, "wb") as file:
+                    file.write(content)
+                os.replace(temporary_path, path)
+            previous = self.__connection.execute("SELECT digest FROM labels WHERE shipping_id = ?",
+                                                 (shipping_id,)).fetchone()
+            self.__connection.execute("INSERT OR REPLACE INTO labels (shipping_id, digest, size, accessed_at) "
+                                      "VALUES (?, ?, ?, ?)", (shipping_id, digest, len(content), time.time()))
+            if previous is not None:
+                self.__remove_unreferenced(previous[0])
+            self.__evict()
+
+    def __evict(self):
+        """
+        Remove the least recently used labels until the PDFs fit max_bytes
+        :return:
+        """
+        if self.max_bytes is None:
+            return
+        while self.__size() > self.max_bytes:
+            shipping_id, digest = self.__connection.execute("SELECT shipping_id, digest FROM labels "
+                                                            "ORDER BY accessed_at LIMIT 1").fetchone()
+            self.__connection.execute("DELETE FROM labels WHERE shipping_id = ?", (shipping_id,))
+            self.__remove_unreferenced(digest)
+
+    def __size(self):
+        """
+
+        :return: bytes used by the distinct PDFs
+        """
+        return self.__connection.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                                         "(SELECT MAX(size) AS size FROM labels GROUP BY digest)").fetchone()[0]
+
+    def __remove_unreferenced(self, digest):
+        """
+
+        :param digest:
+        :return:
+        """
+        if self.__connection.execute("SELECT 1 FROM labels WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+            try:
+                os.remove(self.__path(digest))
+            except FileNotFoundError:
+                pass
+
+    def delete(self, shipping_id):
+        """
+        Invalidate the label of a shipment
+        :param shipping_id:
+        :return:
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT digest FROM labels WHERE shipping_id = ?",
+                                            (shipping_id,)).fetchone()
+            if row is not None:
+                self.__connection.execute("DELETE FROM labels WHERE shipping_id = ?", (shipping_id,))
+                self.__remove_unreferenced(row[0])
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        with self.__lock:
+            digests = [row[0] for row in self.__connection.execute("SELECT DISTINCT digest FROM labels").fetchall()]
+            self.__connection.execute("DELETE FROM labels")
+            for digest in digests:
+                self.__remove_unreferenced(digest)
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+
+    def stats(self):
+        """
+
+        :return: hits, misses, number of entries and bytes used
+        """
+        with self.__lock:
+            size = self.__size()
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self), "bytes": size}
+
+    def close(self):
+        """
+
+        :return:
+        """
+        self.__connection.close()
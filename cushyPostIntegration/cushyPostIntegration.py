@@ -1,96 +1,447 @@
-import requests
+import binascii
+import contextlib
 import json
+import os
 import datetime
+import hashlib
 import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from cushyPostIntegration.logger_decorator import logger, logging
 from cushyPostIntegration.exceptions import LoginFailed, RefreshFailed, MissingToken, ShippingRateFailed, \
     GeoDbAutoComplete, MissingFrom, MissingData, ApproveRateFailed, SearchPaidShipmentsFailed, SearchQuotationFailed, \
     NoQuotationFoundFailed, AddToCartFailed, RemoveFromCartFailed, BuyCartFailed, ConfirmCartFailed, \
-    ConfirmCartMissingParameters, InvalidEnvironment
+    ConfirmCartMissingParameters, InvalidEnvironment, ShipmentLabelFailed, InvalidSnapshot, MissingSnapshot
+from cushyPostIntegration.transport import get_default_transport
+from cushyPostIntegration.cache import MemoryCache
+from cushyPostIntegration.business_days import BusinessCalendar
+from cushyPostIntegration.tokens import get_token_expiry
+from cushyPostIntegration.snapshot import dumps_snapshot, loads_snapshot
+from cushyPostIntegration.models import Model, Location, Package, Shipping, Services, RatesRequest
+from cushyPostIntegration.templates import SEARCH_PAID_SHIPPING, SEARCH_QUOTATION_TO_PAY, CART_ITEM
+
+# Business calendars built from the holidays, shared by all the instances
+_business_calendars = MemoryCache(max_entries=1000)
+# Holidays of the instances created without a holiday_cache, shared so that short lived clients do not download
+# them again. They expire after a day, so that long running processes pick up the changes
+_holidays = MemoryCache(ttl=86400, max_entries=1000)
 
 
 class CushyPostIntegration:
+    MODEL_NODES = ("from_location", "to_location", "shipping", "services")
+    # Fields of a rate that identify the quotation on CushyPost
+    QUOTATION_FIELDS = ("id", "call")
+    SNAPSHOT_FIELDS = ("environment", "app", "token", "refresh_token", "from_location", "to_location", "services",
+                       "shipping", "checkout_session_id")
+
     @logger
-    def __init__(self, environment, app, token=None, refresh_token=None):
+    def __init__(self, environment, app, token=None, refresh_token=None, transport=None, geo_cache=None,
+                 geo_negative_ttl=300, holiday_cache=None, token_refresh_margin=60, token_store=None,
+                 label_cache=None, rate_cache=None, deterministic_hashes=False):
         """
         Class initialization
         :param environment: TEST or PRD
         :param app: app name for CushyPost
         :param token: (optional) in case you already have a valid token
         :param refresh_token: (optional) in case you already have a valid refresh token
+        :param transport: (optional) HttpTransport to use, by default the pooled one shared in the process
+        :param geo_cache: (optional) MemoryCache/SQLiteCache where the GeoDB locations are kept between instances
+        :param geo_negative_ttl: (optional) seconds for which a CAP without GeoDB results is not searched again
+        :param holiday_cache: (optional) MemoryCache/SQLiteCache where the holidays are kept between instances,
+                              by default an in process cache shared by all the instances
+        :param token_refresh_margin: (optional) seconds before the expiry of the token in which it gets refreshed
+        :param token_store: (optional) FileTokenStore/SQLiteTokenStore where the tokens are shared between processes
+        :param label_cache: (optional) LabelCache where the downloaded labels are kept for reprints
+        :param rate_cache: (optional) MemoryCache/SQLiteCache where the rates are kept, use a short ttl
+        :param deterministic_hashes: (optional) derive the hash of the packages from their content, instead of
+                                     a random one, so that identical shipments produce identical requests
         """
+        self.transport = transport if transport else get_default_transport()
+        self.geo_cache = geo_cache
+        self.geo_negative_ttl = geo_negative_ttl
+        # CAP without results and city not found mapped to the CAP fallback
+        self.geo_db_misses = MemoryCache(max_entries=10000)
+        self.holiday_cache = holiday_cache if holiday_cache is not None else _holidays
+        self.token_refresh_margin = token_refresh_margin
+        self.__token_expiry = (None, None)
+        self.__token_refresher = None
+        self.__refresh_lock = threading.RLock()
         self.environment = environment
         self.token = token
         self.refresh_token = refresh_token
         self.app = app
         self.domain = self.__get_domain()
+        # The nodes of the shipment are kept as models until they are read as dictionaries
+        self.__node_models = {}
+        self.__nodes = {}
         self.from_location = None
         self.to_location = None
         self.services = None
         self.shipping = None
         self.checkout_session_id = None
         self.geo_db_data = {}
+        self.label_cache = label_cache
+        self.rate_cache = rate_cache
+        self.deterministic_hashes = deterministic_hashes
+        # State of the last snapshot written or read, the base of the next delta
+        self.__snapshot_baseline = None
+        self.token_store = token_store
+        if token_store is not None and not token:
+            self.token, self.refresh_token = token_store.load()
+
+    @property
+    def from_location(self):
+        """
+
+        :return: from node, as a dictionary
+        """
+        return self._node("from_location")
+
+    @from_location.setter
+    def from_location(self, value):
+        self._set_node("from_location", value)
+
+    @property
+    def to_location(self):
+        """
+
+        :return: to node, as a dictionary
+        """
+        return self._node("to_location")
+
+    @to_location.setter
+    def to_location(self, value):
+        self._set_node("to_location", value)
+
+    @property
+    def shipping(self):
+        """
+
+        :return: shipping node, as a dictionary
+        """
+        return self._node("shipping")
+
+    @shipping.setter
+    def shipping(self, value):
+        self._set_node("shipping", value)
+
+    @property
+    def services(self):
+        """
+
+        :return: services node, as a dictionary
+        """
+        return self._node("services")
+
+    @services.setter
+    def services(self, value):
+        self._set_node("services", value)
+
+    def _node(self, name):
+        """
+        The node is built from its model the first time it is read as a dictionary.
+        From then on the dictionary is the node, as it can be changed in place
+        :param name: one of MODEL_NODES
+        :return:
+        """
+        model = self.__node_models.pop(name, None)
+        if model is not None:
+            self.__nodes[name] = model.to_dict()
+        return self.__nodes.get(name)
+
+    def _set_node(self, name, value):
+        """
+
+        :param name: one of MODEL_NODES
+        :param value: the node as a Model or as a dictionary
+        :return:
+        """
+        self.__node_models.pop(name, None)
+        self.__nodes.pop(name, None)
+        if isinstance(value, Model):
+            self.__node_models[name] = value
+        else:
+            self.__nodes[name] = value
+
+    def _has_node(self, name):
+        """
+        Unlike reading the node, it keeps the model
+        :param name: one of MODEL_NODES
+        :return:
+        """
+        return name in self.__node_models or bool(self.__nodes.get(name))
+
+    def _state_value(self, field):
+        """
+        Value of a field for get_dict and the snapshots, it keeps the models of the nodes
+        :param field: one of SNAPSHOT_FIELDS
+        :return:
+        """
+        model = self.__node_models.get(field)
+        return model.to_dict() if model is not None else getattr(self, field)
+
+    def _from_country(self):
+        """
+
+        :return: country of the from node
+        """
+        model = self.__node_models.get("from_location")
+        return model.country if model is not None else self.from_location["country"]
+
+    def _current_rates_body(self):
+        """
+        Body of shipment/rate for the shipment of the instance: a RatesRequest, encoded from the cached
+        encodings of the nodes, while all of them are models
+        :return:
+        """
+        models = [self.__node_models.get(name) for name in self.MODEL_NODES]
+        if all(model is not None for model in models):
+            return RatesRequest(app=self.app, from_location=models[0], to_location=models[1], shipping=models[2],
+                                services=models[3])
+        return self._rates_body(self.from_location, self.to_location, self.shipping, self.services)
 
     @logger
     def login(self, username, password):
         """
-        This method get the token and refresh_token starting a session with CushyPost
+        This method get the token and refresh_token starting a session with CushyPost.
+        With a token_store, the valid tokens already stored by another process are used instead
         :param username:
         :param password:
         :return:
         """
-        request_body = {
-            "app": self.app,
-            "username": username,
-            "password": password
-        }
-        response = requests.request("POST",
-                                    "{}/security/v1/login".format(self.domain),
-                                    headers={'Content-Type': 'application/json'},
-                                    data=json.dumps(request_body))
-        if response.status_code != 200:
-            logging.error(response.json())
-            raise LoginFailed()
-        self.token = response.raw.headers.get('X-Cushypost-JWT')
-        self.refresh_token = response.raw.headers.get('X-Cushypost-Refresh-JWT')
+        with self._token_store_lock():
+            if self._use_stored_tokens():
+                return
+            request_body = {
+                "app": self.app,
+                "username": username,
+                "password": password
+            }
+            response = self.transport.request("POST",
+                                              "{}/security/v1/login".format(self.domain),
+                                              headers={'Content-Type': 'application/json'},
+                                              data=json.dumps(request_body))
+            if response.status_code != 200:
+                logging.error(response.json())
+                raise LoginFailed()
+            self.token = response.raw.headers.get('X-Cushypost-JWT')
+            self.refresh_token = response.raw.headers.get('X-Cushypost-Refresh-JWT')
+            self._save_tokens()
+
+    def _token_store_lock(self):
+        """
+
+        :return: the lock of the token store, a no-op one without token store
+        """
+        return self.token_store.lock() if self.token_store is not None else contextlib.nullcontext()
+
+    def _use_stored_tokens(self):
+        """
+        Adopt the tokens of the token store when they are valid
+        :return: True when the stored tokens are used
+        """
+        if self.token_store is None:
+            return False
+        return self._use_valid_tokens(*self.token_store.load())
+
+    def _use_valid_tokens(self, token, refresh_token):
+        """
+        Adopt the stored tokens when the token is valid
+        :param token: stored token
+        :param refresh_token: stored refresh token
+        :return: True when the stored tokens are used
+        """
+        expires_at = get_token_expiry(token)
+        if not token or (expires_at is not None and expires_at - time.time() < self.token_refresh_margin):
+            return False
+        self.token = token
+        self.refresh_token = refresh_token
+        return True
+
+    def _load_tokens_from_store(self):
+        """
+        Adopt the tokens of the token store when another process changed them
+        :return: True when the tokens have been changed
+        """
+        return self._use_changed_tokens(*self.token_store.load())
+
+    def _use_changed_tokens(self, token, refresh_token):
+        """
+        Adopt the stored tokens when they differ from the ones in use
+        :param token: stored token
+        :param refresh_token: stored refresh token
+        :return: True when the tokens have been changed
+        """
+        if not token or token == self.token:
+            return False
+        self.token = token
+        self.refresh_token = refresh_token
+        return True
+
+    def _save_tokens(self):
+        """
+
+        :return:
+        """
+        if self.token_store is not None:
+            self.token_store.save(self.token, self.refresh_token)
 
     @logger
     def refresh_tokens(self):
         """
-        This method is refreshing the token using the refresh_token
+        This method is refreshing the token using the refresh_token.
+        Refreshes are serialized, so that threads sharing the instance never use a consumed refresh_token
         :return:
         """
-        if not self.refresh_token:
-            raise MissingToken()
-        response = requests.request("POST",
-                                    "{}/security/refresh_token".format(self.domain),
-                                    headers={'Content-Type': 'application/json',
-                                             'Authorization': 'Bearer {}'.format(self.refresh_token)},
-                                    data=json.dumps({"app": self.app}))
-        if response.status_code != 200:
-            logging.error(response.json())
-            raise RefreshFailed()
-        self.token = response.raw.headers.get('X-Cushypost-JWT')
-        self.refresh_token = response.raw.headers.get('X-Cushypost-Refresh-JWT')
+        with self.__refresh_lock, self._token_store_lock():
+            if self.token_store is not None and self._load_tokens_from_store():
+                # Already refreshed by another process
+                return
+            if not self.refresh_token:
+                raise MissingToken()
+            response = self.transport.request("POST",
+                                              "{}/security/refresh_token".format(self.domain),
+                                              headers={'Content-Type': 'application/json',
+                                                       'Authorization': 'Bearer {}'.format(self.refresh_token)},
+                                              data=json.dumps({"app": self.app}))
+            if response.status_code != 200:
+                logging.error(response.json())
+                raise RefreshFailed()
+            self.token = response.raw.headers.get('X-Cushypost-JWT')
+            self.refresh_token = response.raw.headers.get('X-Cushypost-Refresh-JWT')
+            self._save_tokens()
+
+    @logger
+    def __refresh_tokens_once(self, used_token):
+        """
+        Single flight refresh: the calls rejected with the same token trigger only one refresh,
+        the others wait for it and use the new token
+        :param used_token: token rejected by CushyPost
+        :return:
+        """
+        with self.__refresh_lock:
+            if self.token == used_token:
+                self.refresh_tokens()
+
+    def token_expires_at(self):
+        """
+        Expiry of the token, read from the JWT
+        :return: expiry as timestamp, None when it is not known
+        """
+        if self.__token_expiry[0] != self.token:
+            self.__token_expiry = (self.token, get_token_expiry(self.token))
+        return self.__token_expiry[1]
+
+    def token_lifetime(self):
+        """
+
+        :return: seconds before the token expires, None when it is not known
+        """
+        expires_at = self.token_expires_at()
+        return None if expires_at is None else expires_at - time.time()
+
+    def _token_needs_refresh(self):
+        """
+
+        :return: True when the token expires within token_refresh_margin and it can be refreshed
+        """
+        lifetime = self.token_lifetime()
+        return lifetime is not None and lifetime < self.token_refresh_margin and bool(self.refresh_token)
+
+    def _token_cannot_be_renewed(self, margin=0):
+        """
+
+        :param margin: (optional) seconds before the expiry from which the token counts as expired
+        :return: True when the token expires within margin and there is no refresh_token to renew it
+        """
+        lifetime = self.token_lifetime()
+        return lifetime is not None and lifetime < margin and not self.refresh_token
+
+    def start_token_refresher(self):
+        """
+        Refresh the token in a background thread ahead of its expiry. The refresher stops once the token
+        is about to expire without a refresh_token, start it again after the next login
+        :return:
+        """
+        if self.__token_refresher is not None:
+            return
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self.__refresh_tokens_in_background,
+                                  args=(stop_event,),
+                                  name="cushypost-token-refresher",
+                                  daemon=True)
+        self.__token_refresher = (thread, stop_event)
+        thread.start()
+
+    def stop_token_refresher(self):
+        """
+
+        :return:
+        """
+        if self.__token_refresher is None:
+            return
+        thread, stop_event = self.__token_refresher
+        self.__token_refresher = None
+        stop_event.set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def __refresh_tokens_in_background(self, stop_event):
+        """
+
+        :param stop_event: event to stop the refresher
+        :return:
+        """
+        while not stop_event.is_set():
+            if self._token_cannot_be_renewed(self.token_refresh_margin):
+                logging.warning("Token refresher stopped: the token expires and there is no refresh token")
+                if self.__token_refresher is not None and self.__token_refresher[1] is stop_event:
+                    self.__token_refresher = None
+                return
+            lifetime = self.token_lifetime()
+            if stop_event.wait(self.token_refresh_margin if lifetime is None
+                               else max(lifetime - self.token_refresh_margin, 1)):
+                return
+            if self._token_needs_refresh():
+                try:
+                    self.refresh_tokens()
+                except Exception as error:
+                    logging.error(error)
+                    stop_event.wait(10)
 
     @logger
     def __call_endpoint_with_refresh(self, http_method, path, params=None, data=None, retry=True):
         """
-        Method that integrate CushyPost with the refreshToken call in case of 401
+        Method that integrate CushyPost with the refreshToken call in case of 401.
+        A token close to its expiry is refreshed before the call, an expired one without refresh_token
+        raises MissingToken without calling CushyPost
         :param http_method: GET/POST/PATCH/DELETE
         :param path: path on CushyPost
         :param data: body of the message as string
         :param retry: (Optional) Flag to trigger retry. Do not populate
         :return:
         """
-        response = requests.request(http_method,
-                                    "{}/{}".format(self.domain, path),
-                                    headers={'Content-Type': 'application/json',
-                                             'Authorization': 'Bearer {}'.format(self.token)},
-                                    data=data,
-                                    params=params)
+        if retry and self.token_store is not None:
+            with self.__refresh_lock:
+                self._load_tokens_from_store()
+        if retry and self._token_cannot_be_renewed():
+            raise MissingToken()
+        if retry and self._token_needs_refresh():
+            try:
+                self.__refresh_tokens_once(self.token)
+            except RefreshFailed:
+                # The token is still valid, the 401 handling is still in place
+                pass
+        token = self.token
+        response = self.transport.request(http_method,
+                                          "{}/{}".format(self.domain, path),
+                                          headers={'Content-Type': 'application/json',
+                                                   'Authorization': 'Bearer {}'.format(token)},
+                                          data=data,
+                                          params=params)
         if response.status_code == 401 and retry:
-            self.refresh_tokens()
+            self.__refresh_tokens_once(token)
             return self.__call_endpoint_with_refresh(http_method, path, params=params, data=data, retry=False)
         return response
 
@@ -105,6 +456,9 @@ class CushyPostIntegration:
         """
         if not self.token:
             raise MissingToken()
+        memoized = self._geo_db_memoized(country_code, cap, city, multi_results)
+        if memoized is not None:
+            return memoized
         request_body = {
             "app": self.app,
             "country_code": country_code,
@@ -120,16 +474,61 @@ class CushyPostIntegration:
         # I am expecting only one result
         locations = response.json()["response"]["data"]
         if multi_results:
-            for location in locations:
-                self.geo_db_data["{}_{}_{}".format(country_code, location["postcode"], location["city"])] = location
+            self._store_geo_db_locations(country_code, cap, city, locations)
             return locations
         if len(locations) == 0:
             # This part is useful for the quotation part! As the CAP define the price.
             locations = self.__geo_db_place_autocomplete(country_code, cap, multi_results=True)
             if len(locations) == 0:
                 raise GeoDbAutoComplete()
+            self.geo_db_misses.set(self._geo_db_fallback_key(country_code, cap, city), locations[0])
         return locations[0]
 
+    @staticmethod
+    def _geo_db_fallback_key(country_code, cap, city):
+        """
+
+        :param country_code:
+        :param cap:
+        :param city:
+        :return: key of the CAP location used when the city is not found
+        """
+        return "fallback_{}_{}_{}".format(country_code, cap, city)
+
+    def _geo_db_memoized(self, country_code, cap, city, multi_results):
+        """
+        Look up the memo of the GeoDB misses: the CAPs without results and the CAP fallbacks
+        :param country_code:
+        :param cap:
+        :param city:
+        :param multi_results:
+        :return: the memoized result, None when GeoDB needs to be called
+        """
+        if self.geo_db_misses.get("empty_{}_{}".format(country_code, cap)) is not None:
+            if multi_results:
+                return []
+            raise GeoDbAutoComplete()
+        if not multi_results:
+            return self.geo_db_misses.get(self._geo_db_fallback_key(country_code, cap, city))
+        return None
+
+    def _store_geo_db_locations(self, country_code, cap, city, locations):
+        """
+        Keep the locations found on the instance and in the geo cache, a CAP without results is memoized
+        :param country_code:
+        :param cap:
+        :param city:
+        :param locations: results of GeoDB
+        :return:
+        """
+        for location in locations:
+            geo_db_data_key = "{}_{}_{}".format(country_code, location["postcode"], location["city"])
+            self.geo_db_data[geo_db_data_key] = location
+            if self.geo_cache is not None:
+                self.geo_cache.set(geo_db_data_key, location)
+        if len(locations) == 0 and not city:
+            self.geo_db_misses.set("empty_{}_{}".format(country_code, cap), True, ttl=self.geo_negative_ttl)
+
     @logger
     def search_geo_db(self, country_code, cap):
         """
@@ -158,34 +557,27 @@ class CushyPostIntegration:
         :param elem_name:
         :return:
         """
+        location = self.__resolve_location(country_code, cap, city)
+        self._set_node(elem, Location.from_geo_db(country_code, cap, location, elem_name))
+
+    @logger
+    def __resolve_location(self, country_code, cap, city):
+        """
+        Get the GeoDB location, from the data already collected when available
+        :param country_code:
+        :param cap:
+        :param city:
+        :return:
+        """
         geo_db_data_key = "{}_{}_{}".format(country_code, cap, city)
-        location = self.geo_db_data[geo_db_data_key] \
-            if self.geo_db_data.get(geo_db_data_key) \
-            else self.__geo_db_place_autocomplete(country_code, cap, city)
-        setattr(self, elem, {
-            "name": elem_name,
-            "country": country_code,
-            "postalcode": cap,
-            "city": location["city"],
-            "province": location["province"],
-            "phone": "",
-            "email": "",
-            "contact": "",
-            "locality": location["city"],
-            "administrative_area_level_1": location["region"],
-            "administrative_area_level_2": location["province"],
-            "location": {
-                "lat": location["location"]["coordinates"][1],
-                "lng": location["location"]["coordinates"][0],
-                "location_type": "APPROXIMATE"
-            },
-            "validity": {
-                "valid": True,
-                "component": "postalcode"
-            },
-            "type": "geodb",
-            "hash": location["id"]
-        })
+        if self.geo_db_data.get(geo_db_data_key):
+            return self.geo_db_data[geo_db_data_key]
+        location = self.geo_cache.get(geo_db_data_key) if self.geo_cache is not None else None
+        if location is None:
+            location = self.__geo_db_place_autocomplete(country_code, cap, city)
+            if self.geo_cache is not None:
+                self.geo_cache.set(geo_db_data_key, location)
+        return location
 
     @logger
     def set_services(self, year, month=None, day=None, insurance_value=None, cash_on_delivery=None):
@@ -198,56 +590,116 @@ class CushyPostIntegration:
         :param cash_on_delivery (optional)
         :return:
         """
-        if not self.from_location:
+        if not self._has_node("from_location"):
             raise MissingFrom()
         if not self.token:
             raise MissingToken()
+        country = self._from_country()
+        calendar = self._business_calendar(country, year, self.__get_holidays(country, year))
+        self.services = self._services_model(self._collection_date(year, month=month, day=day, calendar=calendar),
+                                             insurance_value=insurance_value,
+                                             cash_on_delivery=cash_on_delivery)
+
+    @logger
+    def __get_holidays(self, country, year, refresh=False):
+        """
+        Get the holidays of the country, from the holiday cache when available
+        :param country:
+        :param year:
+        :param refresh: (optional) ignore the cached calendar
+        :return: the holidays, None in case they are not available
+        """
+        holiday_cache_key = "{}_{}".format(country, year)
+        holidays = None if refresh else self.holiday_cache.get(holiday_cache_key)
+        if holidays is not None:
+            return holidays
         request_body = {
             "app": self.app,
-            "country": self.from_location["country"],
+            "country": country,
             "year": year
         }
+        response = self.__call_endpoint_with_refresh("POST",
+                                                     "calendar/holidays",
+                                                     data=json.dumps(request_body))
+        if response.status_code != 200:
+            return None
+        holidays = response.json()["response"]["data"]
+        self.holiday_cache.set(holiday_cache_key, holidays)
+        return holidays
+
+    @logger
+    def refresh_holidays(self, country, year):
+        """
+        Download again the holidays of the country, replacing the cached ones
+        :param country:
+        :param year:
+        :return: the holidays, None in case they are not available
+        """
+        if not self.token:
+            raise MissingToken()
+        return self.__get_holidays(country, year, refresh=True)
+
+    @logger
+    def preload_holidays(self, countries, years):
+        """
+        Fill the holiday cache, e.g. at startup
+        :param countries: list of country codes
+        :param years: list of years
+        :return:
+        """
+        if not self.token:
+            raise MissingToken()
+        for country in countries:
+            for year in years:
+                self.__get_holidays(country, year)
+
+    @staticmethod
+    def _business_calendar(country, year, holidays):
+        """
+        The calendar of a country and year is built once, and again only when its holidays change
+        :param country:
+        :param year:
+        :param holidays: holidays as returned by calendar/holidays, None when they are not available
+        :return: BusinessCalendar
+        """
+        business_calendar_key = "{}_{}".format(country, year)
+        cached = _business_calendars.get(business_calendar_key)
+        if cached is None or cached[0] != holidays:
+            cached = (holidays, BusinessCalendar(holidays))
+            _business_calendars.set(business_calendar_key, cached)
+        return cached[1]
+
+    def _collection_date(self, year, month=None, day=None, calendar=None):
+        """
+        Compute the collection date, moving it after week ends and holidays
+        :param year:
+        :param month: (optional)
+        :param day: (optional)
+        :param calendar: (optional) BusinessCalendar of the country, by default only the week ends are skipped
+        :return:
+        """
         collection_date = datetime.datetime.utcnow().replace(microsecond=0)
         collection_date = collection_date.replace(year=int(year))
         if month:
             collection_date = collection_date.replace(month=int(month))
         if day:
             collection_date = collection_date.replace(day=int(day))
-        if day or month:
-            if collection_date.weekday() > 4:
-                collection_date = collection_date + datetime.timedelta(days=1 if collection_date.weekday() == 6 else 2)
-        else:
-            collection_date = collection_date + datetime.timedelta(days=7-collection_date.weekday()
-                                                                   if collection_date.weekday() > 3 else 1)
-        response = self.__call_endpoint_with_refresh("POST",
-                                                     "calendar/holidays",
-                                                     data=json.dumps(request_body))
-        if response.status_code == 200:
-            date_yyyy_mm_dd_format = collection_date.strftime('%Y-%m-%d')
-            for holiday in response.json()["response"]["data"]:
-                if date_yyyy_mm_dd_format == holiday["date"]:
-                    collection_date = collection_date + datetime.timedelta(days=1)
-                    date_yyyy_mm_dd_format = collection_date.strftime('%Y-%m-%d')
-                    # If the next day is during the week end, we move after
-                    if collection_date.weekday() > 4:
-                        collection_date = collection_date + datetime.timedelta(days=1 if collection_date.weekday() == 6
-                                                                               else 2)
-        # We keep cash_on_delivery and insurance hardcoded to 0
-        self.services = {
-            "collection": {
-                "date": "{}Z".format(collection_date.isoformat()),
-                "hours": [10, 14]
-            },
-            "insurance": {
-                "value": float(insurance_value) if insurance_value else 0,
-                "currency": "EUR",
-                "algorithm": "any" if insurance_value else "none"
-            },
-            "cash_on_delivery": {
-                "value": float(cash_on_delivery) if cash_on_delivery else 0,
-                "currency": "EUR"
-            }
-        }
+        if not day and not month:
+            # The collection can happen from tomorrow
+            collection_date = collection_date + datetime.timedelta(days=1)
+        return (calendar if calendar is not None else BusinessCalendar()).roll_forward([collection_date])[0]
+
+    @staticmethod
+    def _services_model(collection_date, insurance_value=None, cash_on_delivery=None):
+        """
+
+        :param collection_date:
+        :param insurance_value: (optional)
+        :param cash_on_delivery: (optional)
+        :return: Services
+        """
+        return Services(collection_date="{}Z".format(collection_date.isoformat()), hours=(10, 14),
+                        insurance_value=insurance_value, cash_on_delivery=cash_on_delivery)
 
     @logger
     def set_shipping(self, packages, goods_desc=None, special_instructions=None):
@@ -260,54 +712,360 @@ class CushyPostIntegration:
         """
         if not packages:
             raise MissingData()
-        self.shipping = {
-            "total_weight": sum([int(package["weight"]) for package in packages]),
-            "goods_desc": goods_desc if goods_desc else "content",
-            "product": "All",
-            "special_instructions": "Questo è solo un test. Si prega di cancellare!"
-                                    if self.environment == "TEST" else (special_instructions
-                                                                        if special_instructions else "Nessuna"),
-            "packages": [{
-                "type": package.get("type", "Parcel"),
-                "height": package["height"],
-                "width": package["width"],
-                "length": package["length"],
-                "weight": package["weight"],
-                "content": package["contentDesc"] if package.get("contentDesc") else "content",
-                "hash": uuid.uuid4().hex
-            } for package in packages]
-        }
+        self.shipping = self._shipping_model(packages, goods_desc=goods_desc, special_instructions=special_instructions)
+
+    def _shipping_model(self, packages, goods_desc=None, special_instructions=None):
+        """
+
+        :param packages:
+        :param goods_desc: (optional)
+        :param special_instructions: (optional)
+        :return: Shipping
+        """
+        return Shipping(
+            goods_desc=goods_desc if goods_desc else "content",
+            product="All",
+            special_instructions="Questo è solo un test. Si prega di cancellare!"
+                                 if self.environment == "TEST" else (special_instructions
+                                                                     if special_instructions else "Nessuna"),
+            packages=[Package(
+                type=package.get("type", "Parcel"),
+                height=package["height"],
+                width=package["width"],
+                length=package["length"],
+                weight=package["weight"],
+                content=package["contentDesc"] if package.get("contentDesc") else "content",
+                hash=package_hash
+            ) for package, package_hash in zip(packages, self._package_hashes(packages))])
+
+    def _package_hashes(self, packages):
+        """
+        The hash already on a package, e.g. when approve_quotation builds the shipping again, is kept.
+        The deterministic hashes are built on type, sizes, weight and content, plus the number of
+        identical packages before, so that identical packages in the same shipment have different hashes
+        :param packages:
+        :return: list of hashes, one for each package
+        """
+        hashes = []
+        occurrences = {}
+        for package in packages:
+            if package.get("hash"):
+                hashes.append(package["hash"])
+                continue
+            if not self.deterministic_hashes:
+                hashes.append(uuid.uuid4().hex)
+                continue
+            fingerprint = json.dumps([package.get("type", "Parcel")] +
+                                     [str(package[field]) for field in ("height", "width", "length", "weight")] +
+                                     [package.get("contentDesc") or "content"])
+            occurrences[fingerprint] = occurrences.get(fingerprint, 0) + 1
+            hashes.append(hashlib.sha256("{}#{}".format(fingerprint, occurrences[fingerprint]).encode())
+                          .hexdigest()[:32])
+        return hashes
 
     @logger
-    def get_rates(self):
+    def get_rates(self, use_cache=True):
         """
-        Call to get rates
+        Call to get rates. The rates read from the rate cache have no quotation id: to approve one of them
+        get the rates again with use_cache=False
+        :param use_cache: (optional) with False CushyPost is called also when the rates are cached
         :return:
         """
         if not self.token:
             raise MissingToken()
-        if not self.from_location or not self.to_location or not self.shipping or not self.services:
+        if not all(self._has_node(name) for name in self.MODEL_NODES):
             raise MissingData()
-        request_body = {
+        return self.__rate(self._current_rates_body(), use_cache=use_cache)
+
+    def _rates_body(self, from_location, to_location, shipping, services):
+        """
+
+        :param from_location:
+        :param to_location:
+        :param shipping:
+        :param services:
+        :return:
+        """
+        return {
             "app": self.app,
-            "from": self.from_location,
-            "to": self.to_location,
-            "shipping": self.shipping,
-            "services": self.services
+            "from": from_location,
+            "to": to_location,
+            "shipping": shipping,
+            "services": services
         }
+
+    @logger
+    def __rate(self, request_body, use_cache=True):
+        """
+        Call to shipment/rate, the rate cache is consulted before calling CushyPost.
+        The rates are cached without the quotation ids, that belong only to the caller that got them
+        :param request_body:
+        :param use_cache: (optional) with False the cached rates are ignored, and replaced
+        :return:
+        """
+        rate_cache_key = self._rate_cache_key(request_body) if self.rate_cache is not None else None
+        if rate_cache_key is not None and use_cache:
+            rates = self.rate_cache.get(rate_cache_key)
+            if rates is not None:
+                return rates
         response = self.__call_endpoint_with_refresh("POST",
                                                      "shipment/rate",
-                                                     data=json.dumps(request_body))
+                                                     data=self._encode_rates_body(request_body))
         if response.status_code != 200:
             logging.error(response.json())
             raise ShippingRateFailed()
-        return response.json()["response"]["data"]
+        rates = response.json()["response"]["data"]
+        if rate_cache_key is not None:
+            self.rate_cache.set(rate_cache_key, self._rates_without_quotations(rates))
+        return rates
+
+    @classmethod
+    def _rates_without_quotations(cls, rates):
+        """
+        Copy of the rates without the ids of the quotations, so that a quotation is never approved twice
+        :param rates: data of a shipment/rate response
+        :return:
+        """
+        if isinstance(rates, list):
+            return [cls._rates_without_quotations(rate) for rate in rates]
+        if not isinstance(rates, dict):
+            return rates
+        return {key: cls._rates_without_quotations(value) if key in ("list", "best_price", "best_time")
+                else value for key, value in rates.items() if key not in cls.QUOTATION_FIELDS}
+
+    @staticmethod
+    def _encode_rates_body(request_body):
+        """
+
+        :param request_body: body of shipment/rate, as dictionary or RatesRequest
+        :return: JSON of the body
+        """
+        return request_body.encode() if isinstance(request_body, RatesRequest) else json.dumps(request_body)
+
+    def _rate_cache_key(self, request_body):
+        """
+        Fingerprint of the rate request: domain, locations, packages and services. The fields not affecting the
+        price, like the random hash of the packages, the description of the content or the time of the
+        collection date (it is the time of the request), are ignored. The domain keeps the TEST and PRD
+        quotes apart when they share the cache
+        :param request_body: body of shipment/rate, as dictionary or RatesRequest
+        :return:
+        """
+        if isinstance(request_body, RatesRequest):
+            request_body = request_body.to_dict()
+        services = dict(request_body["services"])
+        if isinstance(services.get("collection"), dict):
+            collection = services["collection"] = dict(services["collection"])
+            if isinstance(collection.get("date"), str):
+                collection["date"] = collection["date"][:10]
+        fingerprint = {
+            "domain": self.domain,
+            "app": request_body["app"],
+            "from": [request_body["from"].get(field) for field in ("country", "postalcode", "hash")],
+            "to": [request_body["to"].get(field) for field in ("country", "postalcode", "hash")],
+            "product": request_body["shipping"].get("product"),
+            "packages": sorted([package.get("type", "Parcel")] +
+                               [float(package[field]) for field in ("height", "width", "length", "weight")]
+                               for package in request_body["shipping"]["packages"]),
+            "services": services
+        }
+        return "rate_{}".format(hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest())
+
+    @logger
+    def get_rates_batch(self, rate_requests, max_concurrency=10):
+        """
+        Rate many shipments concurrently, without touching the shipment stored on the instance.
+        Locations and holidays are resolved once for every distinct key
+        :param rate_requests: list of shipments like {"from": {"country_code": "IT", "cap": "00150", "city": "Roma"},
+                              "to": {...}, "shipping": {"packages": [...]}, "services": {"year": "2021"}}.
+                              "shipping" and "services" take the parameters of set_shipping and set_services
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: generator of {"index": ..., "data": ..., "error": ...} in order of completion
+        """
+        if not self.token:
+            raise MissingToken()
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be greater than 0")
+        rate_requests = list(rate_requests)
+        errors = {}
+        location_keys = set()
+        holiday_keys = set()
+        for index, rate_request in enumerate(rate_requests):
+            try:
+                location_keys.update(self._rate_request_location_keys(rate_request))
+                holiday_keys.add(self._rate_request_holiday_key(rate_request))
+            except Exception as error:
+                errors[index] = error
+        return self.__rates_batch(rate_requests, max_concurrency, errors, location_keys, holiday_keys)
+
+    def __rates_batch(self, rate_requests, max_concurrency, errors, location_keys, holiday_keys):
+        """
+        Generator of get_rates_batch, the calls start at the first result requested
+        :param rate_requests:
+        :param max_concurrency:
+        :param errors: dictionary index -> error of the shipments not valid
+        :param location_keys: keys of the locations to resolve
+        :param holiday_keys: keys of the holidays calendars to get
+        :return:
+        """
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        locations = {}
+        holidays = {}
+        rates = {}
+        try:
+            locations.update((key, executor.submit(self.__resolve_location, *key)) for key in location_keys)
+            holidays.update((key, executor.submit(self.__get_holidays, *key)) for key in holiday_keys)
+            location_models = {}
+            for index, rate_request in enumerate(rate_requests):
+                if index in errors:
+                    yield {"index": index, "data": None, "error": errors[index]}
+                    continue
+                try:
+                    from_key, to_key = self._rate_request_location_keys(rate_request)
+                    request_body = self._rate_request_body(
+                        rate_request,
+                        locations[from_key].result(),
+                        locations[to_key].result(),
+                        holidays[self._rate_request_holiday_key(rate_request)].result(),
+                        location_models=location_models)
+                except Exception as error:
+                    yield {"index": index, "data": None, "error": error}
+                    continue
+                rates[executor.submit(self.__rate, request_body)] = index
+            for future in as_completed(rates):
+                error = future.exception()
+                yield {"index": rates[future], "data": None if error else future.result(), "error": error}
+        finally:
+            # When the caller stops early, the calls still queued are not sent.
+            # They are cancelled one by one, shutdown(cancel_futures=True) needs Python 3.9
+            for future in list(locations.values()) + list(holidays.values()) + list(rates):
+                future.cancel()
+            executor.shutdown()
+
+    @staticmethod
+    def _rate_request_location_keys(rate_request):
+        """
+
+        :param rate_request: shipment as described in get_rates_batch
+        :return: keys of from and to locations
+        """
+        return tuple((rate_request[elem]["country_code"], rate_request[elem]["cap"], rate_request[elem]["city"])
+                     for elem in ("from", "to"))
+
+    @staticmethod
+    def _rate_request_holiday_key(rate_request):
+        """
+
+        :param rate_request: shipment as described in get_rates_batch
+        :return: key of the holidays calendar
+        """
+        return rate_request["from"]["country_code"], rate_request["services"]["year"]
+
+    def _rate_request_body(self, rate_request, from_geo_location, to_geo_location, holidays, location_models=None):
+        """
+        Build the shipment/rate body of a shipment described as in get_rates_batch
+        :param rate_request:
+        :param from_geo_location: GeoDB location of from
+        :param to_geo_location: GeoDB location of to
+        :param holidays: holidays of the from country
+        :param location_models: (optional) dictionary where the locations are shared between the requests,
+                                so that each one is encoded once
+        :return: RatesRequest
+        """
+        shipping = dict(rate_request["shipping"])
+        packages = shipping.pop("packages", None)
+        if not packages:
+            raise MissingData()
+        services = dict(rate_request["services"])
+        year = services.pop("year")
+        collection_date = self._collection_date(year, month=services.pop("month", None), day=services.pop("day", None),
+                                                calendar=self._business_calendar(rate_request["from"]["country_code"],
+                                                                                 year, holidays))
+        location_models = location_models if location_models is not None else {}
+        for elem, geo_location in (("from", from_geo_location), ("to", to_geo_location)):
+            key = (rate_request[elem]["country_code"], rate_request[elem]["cap"], geo_location["id"], elem)
+            if key not in location_models:
+                location_models[key] = Location.from_geo_db(key[0], key[1], geo_location, elem)
+        return RatesRequest(
+            app=self.app,
+            from_location=location_models[(rate_request["from"]["country_code"], rate_request["from"]["cap"],
+                                           from_geo_location["id"], "from")],
+            to_location=location_models[(rate_request["to"]["country_code"], rate_request["to"]["cap"],
+                                         to_geo_location["id"], "to")],
+            shipping=self._shipping_model(packages, **shipping),
+            services=self._services_model(collection_date, **services))
+
+    @logger
+    def rate_matrix(self, origins, destinations, parcels, services=None, max_concurrency=10):
+        """
+        Rate every origin x destination x parcel profile. Every distinct location is resolved once
+        and the rates are requested concurrently, as in get_rates_batch
+        :param origins: list of locations like {"country_code": "IT", "cap": "00150", "city": "Roma"}
+        :param destinations: list of locations like the origins
+        :param parcels: list of parcel profiles, each one the list of packages of set_shipping
+        :param services: (optional) parameters of set_services, by default the collection is from tomorrow
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: table as a dictionary column -> list, one row for each rate (or error) of each lane and profile.
+                 origin, destination and profile are the indexes in the lists given, e.g. pandas.DataFrame(table).
+                 The quotation_id of the rates read from the rate cache is None
+        """
+        lanes, rate_requests = self._rate_matrix_requests(origins, destinations, parcels, services)
+        return self._rate_matrix_table(lanes, self.get_rates_batch(rate_requests, max_concurrency=max_concurrency))
+
+    @staticmethod
+    def _rate_matrix_requests(origins, destinations, parcels, services):
+        """
+
+        :param origins:
+        :param destinations:
+        :param parcels:
+        :param services:
+        :return: list of (origin, destination, profile) indexes and list of shipments for get_rates_batch
+        """
+        services = services if services is not None else {"year": str(datetime.datetime.utcnow().year)}
+        lanes = []
+        rate_requests = []
+        for origin_index, origin in enumerate(origins):
+            for destination_index, destination in enumerate(destinations):
+                for profile_index, packages in enumerate(parcels):
+                    lanes.append((origin_index, destination_index, profile_index))
+                    rate_requests.append({"from": origin, "to": destination,
+                                          "shipping": {"packages": packages}, "services": services})
+        return lanes, rate_requests
+
+    @staticmethod
+    def _rate_matrix_table(lanes, results):
+        """
+
+        :param lanes: list of (origin, destination, profile) indexes
+        :param results: results of get_rates_batch
+        :return:
+        """
+        columns = ("origin", "destination", "profile", "carrier", "product", "price", "net_price", "currency",
+                   "delivery_time", "quotation_id", "error")
+        table = {column: [] for column in columns}
+
+        def add_row(lane, rate=None, error=None):
+            values = lane + ((rate.get("label"), rate.get("product"), rate.get("price"), rate.get("net_price"),
+                              rate.get("currency"), rate.get("delivery_time"), (rate.get("id") or {}).get("$oid"),
+                              None) if rate is not None else (None,) * 7 + (str(error),))
+            for column, value in zip(columns, values):
+                table[column].append(value)
+
+        for result in sorted(results, key=lambda rate_result: rate_result["index"]):
+            lane = lanes[result["index"]]
+            if result["error"] is not None:
+                add_row(lane, error=result["error"])
+                continue
+            for rate in (result["data"] or {}).get("list", []):
+                add_row(lane, rate=rate)
+        return table
 
     @logger
     def approve_quotation(self, quotation_id, from_extra_data, to_extra_data, shipping_extra_data=None):
         """
         Call to get rates
-        :param quotation_id: id of the rate to approve
+        :param quotation_id: id of the rate to approve, the cached rates have none
         :param from_extra_data: data with all the info for from address
         :param to_extra_data: data with all the info for to address
         :param shipping_extra_data: (optional) data with description and special instructions.
@@ -317,9 +1075,28 @@ class CushyPostIntegration:
         """
         if not self.token:
             raise MissingToken()
-        if not self.from_location or not self.to_location or not self.shipping or not self.services:
+        if not quotation_id or not self.from_location or not self.to_location or not self.shipping \
+                or not self.services:
             raise MissingData()
-        # PUT FINAL INFORMATION FOR ADDRESSES AND DESCRIPTIONS
+        request_body = self._approve_quotation_body(quotation_id, from_extra_data, to_extra_data,
+                                                    shipping_extra_data=shipping_extra_data)
+        response = self.__call_endpoint_with_refresh("POST",
+                                                     "quotation/approve",
+                                                     data=json.dumps(request_body))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise ApproveRateFailed()
+        return response.json()["response"]["data"]
+
+    def _approve_quotation_body(self, quotation_id, from_extra_data, to_extra_data, shipping_extra_data=None):
+        """
+        Put the final information on addresses and descriptions and build the approval body
+        :param quotation_id: id of the rate to approve
+        :param from_extra_data: data with all the info for from address
+        :param to_extra_data: data with all the info for to address
+        :param shipping_extra_data: (optional) data with description and special instructions
+        :return:
+        """
         self.from_location["name"] = from_extra_data["name"]
         self.from_location["phone"] = from_extra_data["phone"]
         self.from_location["email"] = from_extra_data["email"]
@@ -341,7 +1118,7 @@ class CushyPostIntegration:
             self.set_shipping(self.shipping["packages"],
                               goods_desc=shipping_extra_data.get("goodsDesc"),
                               special_instructions=shipping_extra_data.get("specialInstructions"))
-        request_body = {
+        return {
             "app": self.app,
             "as": "WaitingForPayment",
             "quotation_id": quotation_id,
@@ -353,162 +1130,324 @@ class CushyPostIntegration:
                 "services": self.services
             }
         }
-        response = self.__call_endpoint_with_refresh("POST",
-                                                     "quotation/approve",
-                                                     data=json.dumps(request_body))
-        if response.status_code != 200:
-            logging.error(response.json())
-            raise ApproveRateFailed()
-        return response.json()["response"]["data"]
+
+    def _search_paid_shipping_body(self, page, page_size=10):
+        """
+        The static part of the body is encoded once, in SEARCH_PAID_SHIPPING
+        :param page: page to get
+        :param page_size: (optional) number of shipments in a page
+        :return: JSON of the body
+        """
+        return SEARCH_PAID_SHIPPING.bind(app=self.app).render(limit=page_size, skip=page*page_size)
 
     @logger
-    def search_paid_shipping(self, page=None):
+    def search_paid_shipping(self, page=None, page_size=None):
         """
 
         :param page: (optional) the endpoint has pagination
+        :param page_size: (optional) number of shipments in a page, 10 by default
         :return:
         """
         if page is None:
             page = 0
-        request_body = {
-            "app": self.app,
-            "limit": 10,
-            "skip": page*10,
-            "sort": {
-                "services.collection.date": -1
-            },
-            "filter": {
-                "status.current.value": {
-                    "$nin": ["WaitingForPayment", "PaymentInitiated", "Draft", "Archived"]
-                }
-            },
-            "match": {
-                "status.current.value": {
-                    "$nin": ["WaitingForPayment", "PaymentInitiated", "Draft", "Archived"]
-                }
-            },
-            "inspect": False
-        }
-
+        request_body = self._search_paid_shipping_body(page, page_size=page_size if page_size else 10)
         response = self.__call_endpoint_with_refresh("POST",
                                                      "shipment/search",
-                                                     data=json.dumps(request_body))
+                                                     data=request_body)
         if response.status_code != 200:
             logging.error(response.json())
             raise SearchPaidShipmentsFailed()
         return response.json()["response"]["data"]
 
+    def _search_quotation_to_pay_body(self, page, page_size=10):
+        """
+        The static part of the body is encoded once, in SEARCH_QUOTATION_TO_PAY
+        :param page: page to get
+        :param page_size: (optional) number of shipments in a page
+        :return: JSON of the body
+        """
+        return SEARCH_QUOTATION_TO_PAY.bind(app=self.app).render(limit=page_size, skip=page*page_size)
+
     @logger
-    def search_quotation_to_pay(self, page=None):
+    def search_quotation_to_pay(self, page=None, page_size=None):
         """
 
         :param page: (optional) the endpoint has pagination
+        :param page_size: (optional) number of shipments in a page, 10 by default
         :return:
         """
         if page is None:
             page = 0
-        request_body = {
-            "app": self.app,
-            "limit": 10,
-            "skip": page*10,
-            "sort": {
-                "services.collection.date": -1
-            },
-            "filter": {
-                "status.current.value": {
-                    "$in": ["WaitingForPayment", "PaymentInitiated"]
-                }
-            }
-        }
-
+        request_body = self._search_quotation_to_pay_body(page, page_size=page_size if page_size else 10)
         response = self.__call_endpoint_with_refresh("POST",
                                                      "shipment/search",
-                                                     data=json.dumps(request_body))
+                                                     data=request_body)
         if response.status_code != 200:
             logging.error(response.json())
             raise SearchQuotationFailed()
         return response.json()["response"]["data"]
 
     @logger
-    def search_by_quotation_id(self, quotation_ids, page=None, shipments=None, tracking_url_list=None):
+    def iter_paid_shipments(self, page_size=50, prefetch=True):
+        """
+        Iterate over all the paid shipments, one page at a time
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param prefetch: (optional) download the next page while the current one is consumed
+        :return: generator of shipments
+        """
+        return self.__iter_pages(self.search_paid_shipping, page_size, prefetch)
+
+    @logger
+    def iter_quotations_to_pay(self, page_size=50, prefetch=True):
+        """
+        Iterate over all the quotations to pay, one page at a time
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param prefetch: (optional) download the next page while the current one is consumed
+        :return: generator of shipments
+        """
+        return self.__iter_pages(self.search_quotation_to_pay, page_size, prefetch)
+
+    def __iter_pages(self, search, page_size, prefetch):
+        """
+
+        :param search: search method with page and page_size parameters
+        :param page_size:
+        :param prefetch:
+        :return:
+        """
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = 0
+            next_page = executor.submit(search, page, page_size) if prefetch else None
+            while True:
+                response_data = next_page.result() if prefetch else search(page, page_size)
+                items = response_data.get("items", [])
+                page += 1
+                has_next_page = self._has_next_page(response_data, page, page_size)
+                if prefetch and has_next_page:
+                    next_page = executor.submit(search, page, page_size)
+                for item in items:
+                    yield item
+                if not has_next_page:
+                    return
+        finally:
+            if executor is not None:
+                # An early termination does not wait for the page being prefetched
+                executor.shutdown(wait=False)
+
+    @logger
+    def search_all_paid_shipping(self, page_size=100, max_concurrency=4):
+        """
+        Download all the paid shipments, fetching the pages concurrently
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: list of shipments in the order of the search
+        """
+        return self.__search_all(self.search_paid_shipping, page_size, max_concurrency)
+
+    @logger
+    def search_all_quotation_to_pay(self, page_size=100, max_concurrency=4):
+        """
+        Download all the quotations to pay, fetching the pages concurrently
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: list of shipments in the order of the search
+        """
+        return self.__search_all(self.search_quotation_to_pay, page_size, max_concurrency)
+
+    def __search_all(self, search, page_size, max_concurrency):
+        """
+        The first page tells the total, the others are fetched in parallel
+        :param search: search method with page and page_size parameters
+        :param page_size:
+        :param max_concurrency:
+        :return:
+        """
+        first_page = search(0, page_size)
+        if not self._has_next_page(first_page, 1, page_size):
+            return self._merge_pages([first_page])
+        if first_page.get("total") is None:
+            # No way to know the number of pages
+            return self._merge_pages([first_page] + [{"items": list(self.__iter_pages(
+                lambda page, size: search(page + 1, size), page_size, prefetch=False))}])
+        pages_number = -(-first_page["total"] // page_size)
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pages = list(executor.map(lambda page: search(page, page_size), range(1, pages_number)))
+        return self._merge_pages([first_page] + pages)
+
+    @staticmethod
+    def _merge_pages(pages):
+        """
+        Concatenate the pages, dropping the shipments that moved between pages while they were downloaded
+        :param pages: data of shipment/search responses, in order
+        :return:
+        """
+        seen_ids = set()
+        shipments = []
+        for page in pages:
+            for item in page.get("items", []):
+                shipment_id = item.get("_id", {}).get("$oid")
+                if shipment_id is not None:
+                    if shipment_id in seen_ids:
+                        continue
+                    seen_ids.add(shipment_id)
+                shipments.append(item)
+        return shipments
+
+    @staticmethod
+    def _has_next_page(response_data, next_page, page_size):
+        """
+
+        :param response_data: data of a shipment/search response
+        :param next_page: index of the next page
+        :param page_size:
+        :return:
+        """
+        if len(response_data.get("items", [])) < page_size:
+            return False
+        return response_data.get("total") is None or next_page * page_size < response_data["total"]
+
+    @logger
+    def search_by_quotation_id(self, quotation_ids, page=None, page_size=None):
         """
 
         :param quotation_ids: quotation to get
         :param page: (optional) page to start to search
-        :param shipments: (optional) list to start to build
-        :param tracking_url_list: (optional) list of tracking URL
-        :return:
+        :param page_size: (optional) number of shipments downloaded with each call, 10 by default
+        :return: list of shipment ids and list of tracking URL, in the order in which they are found
         """
-        page = 0 if page is None else page
-        response_data = self.search_quotation_to_pay(page)
-        if len(response_data.get("items", [])) == 0:
+        shipments = self.search_shipments_by_quotation_id(quotation_ids, page=page, page_size=page_size)
+        if len(shipments) != len(set(quotation_ids)):
             raise NoQuotationFoundFailed()
-        shipments = [] if shipments is None else shipments
-        tracking_url_list = [] if tracking_url_list is None else tracking_url_list
-        for item in response_data["items"]:
-            if item["quotation"]["id"] in quotation_ids:
-                shipments.append(item["_id"]["$oid"])
-                try:
-                    tracking_url_list.append(item.get("contract", {}).get("tracking_url_format", ""))
-                except Exception as error:
-                    logging.error(error)
-                    tracking_url_list.append("")
-        if len(quotation_ids) == len(shipments):
-            return shipments, tracking_url_list
-        else:
-            return self.search_by_quotation_id(quotation_ids,
-                                               page=page+1,
-                                               shipments=shipments,
-                                               tracking_url_list=tracking_url_list)
+        return [shipment_id for shipment_id, _ in shipments.values()], \
+               [tracking_url for _, tracking_url in shipments.values()]
 
     @logger
-    def add_shipping_ids_to_cart(self, shipping_ids):
+    def search_shipments_by_quotation_id(self, quotation_ids, page=None, page_size=None):
+        """
+        Scan the quotations to pay until all the quotations are found or the pages are over
+        :param quotation_ids: quotation to get
+        :param page: (optional) page to start to search
+        :param page_size: (optional) number of shipments downloaded with each call, 10 by default
+        :return: dictionary quotation id -> (shipment id, tracking URL) of the quotations found
+        """
+        page = 0 if page is None else page
+        missing_quotation_ids = set(quotation_ids)
+        shipments = {}
+        while missing_quotation_ids:
+            items = self.search_quotation_to_pay(page, page_size=page_size).get("items", [])
+            if len(items) == 0:
+                break
+            for item in items:
+                quotation_id = item["quotation"]["id"]
+                if quotation_id in missing_quotation_ids:
+                    missing_quotation_ids.discard(quotation_id)
+                    shipments[quotation_id] = (item["_id"]["$oid"],
+                                               (item.get("contract") or {}).get("tracking_url_format", ""))
+            page += 1
+        return shipments
+
+    @logger
+    def add_shipping_ids_to_cart(self, shipping_ids, max_concurrency=None):
         """
 
         :param shipping_ids: Shipping ids to add
+        :param max_concurrency: (optional) add the shipments in parallel, with at most this number of calls in flight.
+                                The result is then a dictionary shipping id -> {"data": ..., "error": ...}
+                                and on failure only the shipments added are removed, the outcomes of the
+                                additions and of the removals are on AddToCartFailed
         :return:
         """
+        if max_concurrency is not None:
+            outcomes = self.__run_cart_items(self.__add_shipping_id_to_cart, shipping_ids, max_concurrency)
+            added_ids = [shipping_id for shipping_id, outcome in outcomes.items() if outcome["error"] is None]
+            if len(added_ids) != len(outcomes):
+                removal_outcomes = self.remove_shipping_ids_to_cart(
+                    added_ids, raise_error=False, max_concurrency=max_concurrency)
+                raise AddToCartFailed(outcomes, removal_outcomes)
+            return outcomes
         response = None
         for shipping_id in shipping_ids:
-            request_body = {
-                "app": self.app,
-                "type": "shipment",
-                "id": shipping_id
-            }
-            response = self.__call_endpoint_with_refresh("POST",
-                                                         "cart/item",
-                                                         data=json.dumps(request_body))
-            if response.status_code != 200:
-                logging.error(response.json())
+            try:
+                response = self.__add_shipping_id_to_cart(shipping_id)
+            except AddToCartFailed:
                 self.remove_shipping_ids_to_cart(shipping_ids, raise_error=False)
-                raise AddToCartFailed()
-            response = response.json().get("response", {}).get("data")
+                raise
         return response
 
     @logger
-    def remove_shipping_ids_to_cart(self, shipping_ids, raise_error=True):
+    def remove_shipping_ids_to_cart(self, shipping_ids, raise_error=True, max_concurrency=None):
         """
 
         :param shipping_ids: Shipping ids to remove
         :param raise_error: (optional) continue removing without raising error
+        :param max_concurrency: (optional) remove the shipments in parallel, with at most this number of calls in
+                                flight. The result is then a dictionary shipping id -> {"data": ..., "error": ...},
+                                also when the removals failed and raise_error is False
         :return:
         """
+        if max_concurrency is not None:
+            outcomes = self.__run_cart_items(lambda shipping_id: self.__remove_shipping_id_from_cart(
+                shipping_id, raise_error), shipping_ids, max_concurrency)
+            if raise_error and any(outcome["error"] is not None for outcome in outcomes.values()):
+                raise RemoveFromCartFailed(outcomes)
+            return outcomes
         response = None
         for shipping_id in shipping_ids:
-            request_body = {
-                "app": self.app,
-                "id": shipping_id
-            }
-            response = self.__call_endpoint_with_refresh("DELETE",
-                                                         "cart/item",
-                                                         params=request_body)
-            if response.status_code != 200 and raise_error:
-                logging.error(response.json())
-                raise RemoveFromCartFailed()
-            else:
-                response = response.json().get("response", {}).get("data")
+            response = self.__remove_shipping_id_from_cart(shipping_id, raise_error)
         return response
 
+    def __add_shipping_id_to_cart(self, shipping_id):
+        """
+
+        :param shipping_id: Shipping id to add
+        :return:
+        """
+        response = self.__call_endpoint_with_refresh("POST",
+                                                     "cart/item",
+                                                     data=CART_ITEM.bind(app=self.app).render(id=shipping_id))
+        if response.status_code != 200:
+            logging.error(response.json())
+            raise AddToCartFailed()
+        return response.json().get("response", {}).get("data")
+
+    def __remove_shipping_id_from_cart(self, shipping_id, raise_error):
+        """
+
+        :param shipping_id: Shipping id to remove
+        :param raise_error: raise an error when the removal fails
+        :return:
+        """
+        request_body = {
+            "app": self.app,
+            "id": shipping_id
+        }
+        response = self.__call_endpoint_with_refresh("DELETE",
+                                                     "cart/item",
+                                                     params=request_body)
+        if response.status_code != 200 and raise_error:
+            logging.error(response.json())
+            raise RemoveFromCartFailed()
+        return response.json().get("response", {}).get("data")
+
+    @staticmethod
+    def __run_cart_items(function, shipping_ids, max_concurrency):
+        """
+
+        :param function: function adding or removing a single shipping id
+        :param shipping_ids:
+        :param max_concurrency:
+        :return: dictionary shipping id -> {"data": ..., "error": ...}, in the order of shipping_ids
+        """
+        shipping_ids = list(dict.fromkeys(shipping_ids))
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = {executor.submit(function, shipping_id): shipping_id for shipping_id in shipping_ids}
+            outcomes = {}
+            for future in as_completed(futures):
+                error = future.exception()
+                outcomes[futures[future]] = {"data": None if error else future.result(), "error": error}
+        return {shipping_id: outcomes[shipping_id] for shipping_id in shipping_ids}
+
     @logger
     def buy_cart(self, success_url, cancel_url, description):
         """
@@ -562,17 +1501,106 @@ class CushyPostIntegration:
         """
         shipment_labels = []
         for shipping_id in shipping_ids:
-            request_body = {
-                "app": self.app,
-                "shipment_id": shipping_id
-            }
-            response = self.__call_endpoint_with_refresh("GET",
-                                                         "shipment/label",
-                                                         params=request_body)
-            if response.status_code == 200 and response.json().get("response", {}).get("data"):
-                shipment_labels.append(response.json()["response"]["data"])
+            try:
+                if self.label_cache is None:
+                    shipment_labels.append(self.__get_shipment_label(shipping_id))
+                else:
+                    shipment_labels.append(binascii.b2a_base64(self.__get_shipment_label_content(shipping_id),
+                                                               newline=False).decode())
+            except ShipmentLabelFailed:
+                continue
         return shipment_labels
 
+    @logger
+    def download_shipment_labels(self, shipping_ids, sink, max_concurrency=8):
+        """
+        Download the labels in parallel, writing each one to the sink as soon as it arrives,
+        so that the memory used does not depend on the number of labels
+        :param shipping_ids: Label to download, any iterable
+        :param sink: directory where the labels are saved as <shipping id>.pdf, file-like object
+                     where the labels are appended, or function called with the shipping id and the PDF content
+        :param max_concurrency: (optional) maximum number of calls in flight
+        :return: dictionary shipping id -> {"data": size of the label in bytes, "error": ...}
+        """
+        write_label = self._label_writer(sink)
+        shipping_ids = iter(shipping_ids)
+        shipping_ids_lock = threading.Lock()
+        outcomes = {}
+
+        def download():
+            while True:
+                try:
+                    with shipping_ids_lock:
+                        shipping_id = next(shipping_ids)
+                except StopIteration:
+                    return
+                try:
+                    label = self.__get_shipment_label_content(shipping_id)
+                    write_label(shipping_id, label)
+                    outcomes[shipping_id] = {"data": len(label), "error": None}
+                except Exception as error:
+                    logging.error("Label of %s not downloaded: %s", shipping_id, error)
+                    outcomes[shipping_id] = {"data": None, "error": error}
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            for future in [executor.submit(download) for _ in range(max(1, max_concurrency))]:
+                future.result()
+        return outcomes
+
+    def __get_shipment_label_content(self, shipping_id):
+        """
+        The label cache is consulted before calling CushyPost
+        :param shipping_id: Label to download
+        :return: content of the label, the PDF bytes
+        """
+        label = self.label_cache.get(shipping_id) if self.label_cache is not None else None
+        if label is None:
+            label = binascii.a2b_base64(self.__get_shipment_label(shipping_id))
+            if self.label_cache is not None:
+                self.label_cache.set(shipping_id, label)
+        return label
+
+    def __get_shipment_label(self, shipping_id):
+        """
+
+        :param shipping_id: Label to download
+        :return: label, base64 encoded
+        """
+        request_body = {
+            "app": self.app,
+            "shipment_id": shipping_id
+        }
+        response = self.__call_endpoint_with_refresh("GET",
+                                                     "shipment/label",
+                                                     params=request_body)
+        label = response.json().get("response", {}).get("data") if response.status_code == 200 else None
+        if not label:
+            raise ShipmentLabelFailed()
+        return label
+
+    @staticmethod
+    def _label_writer(sink):
+        """
+
+        :param sink: directory, file-like object or function, as in download_shipment_labels
+        :return: function writing the content of a label
+        """
+        if hasattr(sink, "write"):
+            sink_lock = threading.Lock()
+
+            def write_to_file(shipping_id, label):
+                with sink_lock:
+                    sink.write(label)
+            return write_to_file
+        if callable(sink):
+            return sink
+        os.makedirs(sink, exist_ok=True)
+
+        def write_to_directory(shipping_id, label):
+            with open(os.path.join(sink, "{}.pdf".format(shipping_id)), "wb") as file:
+                file.write(label)
+        return write_to_directory
+
     def __get_domain(self):
         """
 
@@ -613,7 +1641,7 @@ class CushyPostIntegration:
 
     def get_dict(self):
         """
-
+        The nodes still kept as models are not turned into dictionaries on the instance
         :return:
         """
         class_dictionary = {
@@ -624,16 +1652,157 @@ class CushyPostIntegration:
                 "token": self.token,
                 "refresh_token": self.refresh_token
             },
-            "from_location": self.from_location,
-            "to_location": self.to_location,
-            "services": self.services,
-            "shipping": self.shipping,
+            "from_location": self._state_value("from_location"),
+            "to_location": self._state_value("to_location"),
+            "services": self._state_value("services"),
+            "shipping": self._state_value("shipping"),
             "geo_db_data": self.geo_db_data
         }
         if self.checkout_session_id:
             class_dictionary["checkout_session_id"] = self.checkout_session_id
         return class_dictionary
 
+    def get_snapshot(self, compress=True, geo_db_data="embed"):
+        """
+        Compact binary image of the instance, to be restored with parse_from_snapshot.
+        It is also the base of the deltas built by get_delta_snapshot
+        :param compress: (optional) compress the snapshot
+        :param geo_db_data: (optional) "embed" the GeoDB locations, "reference" them by key, to be read back
+                            from the geo_cache, or "exclude" them
+        :return: bytes
+        """
+        if geo_db_data not in ("embed", "reference", "exclude"):
+            raise ValueError("geo_db_data must be embed, reference or exclude")
+        state = {field: self._state_value(field) for field in self.SNAPSHOT_FIELDS}
+        if geo_db_data == "embed":
+            state["geo_db_data"] = self.geo_db_data
+        elif geo_db_data == "reference":
+            state["geo_db_keys"] = list(self.geo_db_data)
+        self.__snapshot_baseline = self.__new_snapshot_baseline(
+            geo_db_data, set(self.geo_db_data) if geo_db_data != "exclude" else None)
+        state["id"] = self.__snapshot_baseline["id"]
+        return dumps_snapshot(state, compress=compress)
+
+    def parse_from_snapshot(self, snapshot):
+        """
+        The GeoDB locations referenced are read from the geo_cache, the ones missing are skipped.
+        When they were excluded, the ones of the instance are kept
+        :param snapshot: bytes built by get_snapshot
+        :return:
+        """
+        state = loads_snapshot(snapshot)
+        if "base" in state:
+            raise InvalidSnapshot()
+        for field in self.SNAPSHOT_FIELDS:
+            setattr(self, field, state.get(field))
+        self.domain = self.__get_domain()
+        if "geo_db_data" in state:
+            self.geo_db_data = state["geo_db_data"]
+            geo_db_data, geo_db_keys = "embed", set(self.geo_db_data)
+        elif "geo_db_keys" in state:
+            self.geo_db_data = self.__resolve_geo_db_keys(state["geo_db_keys"], self.geo_db_data)
+            geo_db_data, geo_db_keys = "reference", set(state["geo_db_keys"])
+        else:
+            geo_db_data, geo_db_keys = "exclude", None
+        self.__snapshot_baseline = self.__new_snapshot_baseline(geo_db_data, geo_db_keys, snapshot_id=state.get("id"))
+
+    @logger
+    def get_delta_snapshot(self, compress=False):
+        """
+        Changes since the last snapshot or delta written or read by the instance: only the fields changed,
+        also in place, and the GeoDB locations added or removed. The GeoDB locations are handled as in the
+        snapshot the deltas start from
+        :param compress: (optional) compress the delta
+        :return: bytes
+        """
+        baseline = self.__snapshot_baseline
+        if baseline is None:
+            raise MissingSnapshot()
+        state = {
+            "base": baseline["id"],
+            "set": {field: self._state_value(field) for field in self.SNAPSHOT_FIELDS
+                    if self._snapshot_digest(self._state_value(field)) != baseline["digests"][field]}
+        }
+        geo_db_keys = None
+        if baseline["geo_db_data"] != "exclude":
+            geo_db_keys = set(self.geo_db_data)
+            added_keys = sorted(geo_db_keys - baseline["geo_db_keys"])
+            state["geo_db_set"] = {key: self.geo_db_data[key] for key in added_keys} \
+                if baseline["geo_db_data"] == "embed" else added_keys
+            state["geo_db_removed"] = sorted(baseline["geo_db_keys"] - geo_db_keys)
+        self.__snapshot_baseline = self.__new_snapshot_baseline(baseline["geo_db_data"], geo_db_keys)
+        state["id"] = self.__snapshot_baseline["id"]
+        return dumps_snapshot(state, compress=compress)
+
+    @logger
+    def apply_delta_snapshot(self, delta):
+        """
+        Apply a delta built by get_delta_snapshot on the snapshot (or delta) it was built from
+        :param delta: bytes built by get_delta_snapshot
+        :return:
+        """
+        state = loads_snapshot(delta)
+        baseline = self.__snapshot_baseline
+        if "base" not in state:
+            raise InvalidSnapshot()
+        if baseline is None or baseline["id"] != state["base"]:
+            raise MissingSnapshot()
+        for field, value in state["set"].items():
+            if field in self.SNAPSHOT_FIELDS:
+                setattr(self, field, value)
+        self.domain = self.__get_domain()
+        geo_db_keys = None
+        if baseline["geo_db_data"] != "exclude":
+            geo_db_keys = (baseline["geo_db_keys"] | set(state["geo_db_set"])) - set(state["geo_db_removed"])
+            for key in state["geo_db_removed"]:
+                self.geo_db_data.pop(key, None)
+            if baseline["geo_db_data"] == "embed":
+                self.geo_db_data.update(state["geo_db_set"])
+            else:
+                self.geo_db_data.update(self.__resolve_geo_db_keys(state["geo_db_set"], self.geo_db_data))
+        self.__snapshot_baseline = self.__new_snapshot_baseline(baseline["geo_db_data"], geo_db_keys,
+                                                                snapshot_id=state["id"])
+
+    def __resolve_geo_db_keys(self, keys, geo_db_data):
+        """
+
+        :param keys: keys of the GeoDB locations referenced
+        :param geo_db_data: locations already known
+        :return: the locations found in geo_db_data or in the geo_cache
+        """
+        locations = {}
+        for key in keys:
+            location = geo_db_data.get(key)
+            if location is None and self.geo_cache is not None:
+                location = self.geo_cache.get(key)
+            if location is not None:
+                locations[key] = location
+        return locations
+
+    def __new_snapshot_baseline(self, geo_db_data, geo_db_keys, snapshot_id=None):
+        """
+
+        :param geo_db_data: how the GeoDB locations are handled, embed, reference or exclude
+        :param geo_db_keys: keys of the GeoDB locations in the snapshot, None when excluded
+        :param snapshot_id: (optional) id of the snapshot read, computed when missing
+        :return:
+        """
+        digests = {field: self._snapshot_digest(self._state_value(field)) for field in self.SNAPSHOT_FIELDS}
+        if snapshot_id is None:
+            snapshot_id = self._snapshot_digest([digests[field] for field in self.SNAPSHOT_FIELDS] +
+                                                [sorted(geo_db_keys) if geo_db_keys is not None else None])
+        return {"id": snapshot_id, "digests": digests, "geo_db_data": geo_db_data, "geo_db_keys": geo_db_keys}
+
+    @staticmethod
+    def _snapshot_digest(value):
+        """
+
+        :param value: JSON value
+        :return: digest of the value
+        """
+        return hashlib.blake2b(json.dumps(value, sort_keys=True, separators=(",", ":")).encode(),
+                               digest_size=16).hexdigest()
+
     def __get_string(self):
         """
 
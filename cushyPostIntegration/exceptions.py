@@ -56,13 +56,16 @@ class NoQuotationFoundFailed(Exception):
 
 
 class AddToCartFailed(Exception):
-    def __init__(self):
+    def __init__(self, outcomes=None, removal_outcomes=None):
         super(AddToCartFailed, self).__init__("ADD TO CART FAILED")
+        self.outcomes = outcomes
+        self.removal_outcomes = removal_outcomes
 
 
 class RemoveFromCartFailed(Exception):
-    def __init__(self):
+    def __init__(self, outcomes=None):
         super(RemoveFromCartFailed, self).__init__("REMOVE FROM CART FAILED")
+        self.outcomes = outcomes
 
 
 class BuyCartFailed(Exception):
@@ -83,3 +86,18 @@ class ConfirmCartMissingParameters(Exception):
 class InvalidEnvironment(Exception):
     def __init__(self):
         super(InvalidEnvironment, self).__init__("ENVIRONMENT NOT VALID")
+
+
+class ShipmentLabelFailed(Exception):
+    def __init__(self):
+        super(ShipmentLabelFailed, self).__init__("SHIPMENT LABEL FAILED")
+
+
+class InvalidSnapshot(Exception):
+    def __init__(self):
+        super(InvalidSnapshot, self).__init__("SNAPSHOT NOT VALID")
+
+
+class MissingSnapshot(Exception):
+    def __init__(self):
+        super(MissingSnapshot, self).__init__("MISSING SNAPSHOT")
@@ -1,18 +1,45 @@
+import asyncio
 import logging
 import time
 from functools import wraps
 
 
+_root_logger = logging.getLogger()
+
+
 def logger(fn):
+    """
+    Log the run and the duration of fn at DEBUG level.
+    When DEBUG is disabled fn is called directly, the messages are formatted only when they are emitted
+    :param fn: function or coroutine function
+    :return:
+    """
+    name = fn.__name__
+    is_enabled_for = _root_logger.isEnabledFor
+
+    if asyncio.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if not is_enabled_for(logging.DEBUG):
+                return await fn(*args, **kwargs)
+            start_time = time.perf_counter()
+            logging.debug('About to run %s', name)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                logging.debug('Done running %s', name)
+                logging.debug("--- %s seconds ---", time.perf_counter() - start_time)
+        return async_wrapper
+
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        logging.debug('About to run %s' % fn.__name__)
+        if not is_enabled_for(logging.DEBUG):
+            return fn(*args, **kwargs)
+        start_time = time.perf_counter()
+        logging.debug('About to run %s', name)
         try:
             return fn(*args, **kwargs)
-        except Exception as error:
-            raise error
         finally:
-            logging.debug('Done running %s' % fn.__name__)
-            logging.debug("--- %s seconds ---" % (time.time() - start_time))
+            logging.debug('Done running %s', name)
+            logging.debug("--- %s seconds ---", time.perf_counter() - start_time)
     return wrapper
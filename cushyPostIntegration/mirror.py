@@ -0,0 +1,211 @@
+import calendar
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+
+class ShipmentMirror:
+    PAID = "paid"
+    TO_PAY = "to_pay"
+
+    DAY = 24 * 60 * 60 * 1000
+
+    def __init__(self, client, path, page_size=50, rescan_days=7):
+        """
+        Local copy, on a SQLite database, of the paid shipments and of the quotations to pay.
+        The searches are sorted by collection date, so the sync downloads only the pages down to
+        rescan_days before the most recent collection date already stored (the watermark).
+        The collection dates do not follow the order of creation or of the changes, so the shipments
+        created or changed with an older collection date are seen only within those days: use a
+        window as long as the time between booking and delivery, or sync(full=True) from time to time
+        :param client: CushyPostIntegration used to sync
+        :param path: path of the database file
+        :param page_size: (optional) number of shipments downloaded with each call
+        :param rescan_days: (optional) days before the watermark downloaded again at each sync
+        """
+        self.client = client
+        self.path = path
+        self.page_size = page_size
+        self.rescan_days = rescan_days
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS shipments (id TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+                                  "quotation_id TEXT, status TEXT, collection_date INTEGER, data TEXT NOT NULL, "
+                                  "synced_at REAL NOT NULL)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS shipments_quotation_id ON shipments (quotation_id)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS shipments_status ON shipments (status)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS shipments_collection_date "
+                                  "ON shipments (kind, collection_date)")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS watermarks (kind TEXT PRIMARY KEY, "
+                                  "collection_date INTEGER, synced_at REAL NOT NULL)")
+
+    @staticmethod
+    def _to_milliseconds(value):
+        """
+        Naive datetimes and dates are considered UTC, as the collection dates of CushyPost
+        :param value: date, datetime or milliseconds since the epoch
+        :return: milliseconds since the epoch
+        """
+        if value is None or isinstance(value, (int, float)):
+            return value
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(datetime.timezone.utc)
+            return calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+        return calendar.timegm(value.timetuple()) * 1000
+
+    @staticmethod
+    def _collection_date(shipment):
+        """
+
+        :param shipment:
+        :return: collection date in milliseconds, None when missing
+        """
+        try:
+            return int(shipment["services"]["collection"]["date"]["$date"]["$numberLong"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def watermark(self, kind):
+        """
+
+        :param kind: ShipmentMirror.PAID or ShipmentMirror.TO_PAY
+        :return: most recent collection date stored, in milliseconds, None before the first sync
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT collection_date FROM watermarks WHERE kind = ?",
+                                            (kind,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, full=False):
+        """
+        Download the shipments changed since the last sync, within the rescan window.
+        The shipments of the window downloaded again that are not returned anymore changed status and are
+        removed (a quotation paid moves from TO_PAY to PAID). Use full to download everything again
+        :param full: (optional) ignore the watermarks
+        :return: dictionary kind -> number of shipments downloaded
+        """
+        return {
+            self.PAID: self.__sync_kind(self.PAID, self.client.iter_paid_shipments, full),
+            self.TO_PAY: self.__sync_kind(self.TO_PAY, self.client.iter_quotations_to_pay, full)
+        }
+
+    def __sync_kind(self, kind, iterate, full):
+        """
+
+        :param kind:
+        :param iterate: page iterator of the client
+        :param full:
+        :return:
+        """
+        watermark = None if full else self.watermark(kind)
+        lower_bound = watermark - self.rescan_days * self.DAY if watermark is not None else None
+        shipments = []
+        for shipment in iterate(page_size=self.page_size, prefetch=False):
+            collection_date = self._collection_date(shipment)
+            if lower_bound is not None and collection_date is not None and collection_date < lower_bound:
+                break
+            shipments.append((shipment, collection_date))
+        now = time.time()
+        collection_dates = [collection_date for _, collection_date in shipments if collection_date is not None]
+        new_watermark = max(collection_dates + ([watermark] if watermark is not None else []), default=None)
+        seen_ids = {shipment["_id"]["$oid"] for shipment, _ in shipments}
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            try:
+                if watermark is None:
+                    stored_ids = self.__connection.execute("SELECT id FROM shipments WHERE kind = ?", (kind,))
+                else:
+                    stored_ids = self.__connection.execute("SELECT id FROM shipments WHERE kind = ? AND "
+                                                           "(collection_date >= ? OR collection_date IS NULL)",
+                                                           (kind, lower_bound))
+                self.__connection.executemany("DELETE FROM shipments WHERE id = ?",
+                                              [row for row in stored_ids.fetchall() if row[0] not in seen_ids])
+                self.__connection.executemany("INSERT OR REPLACE INTO shipments (id, kind, quotation_id, status, "
+                                              "collection_date, data, synced_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                              [(shipment["_id"]["$oid"], kind,
+                                                (shipment.get("quotation") or {}).get("id"),
+                                                ((shipment.get("status") or {}).get("current") or {}).get("value"),
+                                                collection_date, json.dumps(shipment), now)
+                                               for shipment, collection_date in shipments])
+                self.__connection.execute("INSERT OR REPLACE INTO watermarks (kind, collection_date, synced_at) "
+                                          "VALUES (?, ?, ?)", (kind, new_watermark, now))
+                self.__connection.execute("COMMIT")
+            except Exception:
+                self.__connection.execute("ROLLBACK")
+                raise
+        return len(shipments)
+
+    def __select(self, where, parameters):
+        """
+
+        :param where: condition of the query
+        :param parameters:
+        :return: list of shipments, the most recent collection date first
+        """
+        with self.__lock:
+            rows = self.__connection.execute("SELECT data FROM shipments WHERE {} "
+                                             "ORDER BY collection_date DESC".format(where), parameters).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, shipment_id):
+        """
+
+        :param shipment_id:
+        :return: the shipment, None when missing
+        """
+        shipments = self.__select("id = ?", (shipment_id,))
+        return shipments[0] if shipments else None
+
+    def by_quotation_id(self, quotation_ids):
+        """
+
+        :param quotation_ids: quotation id or list of quotation ids
+        :return: list of shipments
+        """
+        quotation_ids = [quotation_ids] if isinstance(quotation_ids, str) else list(quotation_ids)
+        return self.__select("quotation_id IN ({})".format(", ".join("?" * len(quotation_ids))), quotation_ids)
+
+    def by_status(self, statuses):
+        """
+
+        :param statuses: status or list of statuses, e.g. "WaitingForPayment"
+        :return: list of shipments
+        """
+        statuses = [statuses] if isinstance(statuses, str) else list(statuses)
+        return self.__select("status IN ({})".format(", ".join("?" * len(statuses))), statuses)
+
+    def by_collection_date(self, start=None, end=None, kind=None):
+        """
+
+        :param start: (optional) first collection date included, date, datetime or milliseconds
+        :param end: (optional) collection date excluded, date, datetime or milliseconds
+        :param kind: (optional) ShipmentMirror.PAID or ShipmentMirror.TO_PAY
+        :return: list of shipments
+        """
+        conditions = ["1 = 1"]
+        parameters = []
+        if start is not None:
+            conditions.append("collection_date >= ?")
+            parameters.append(self._to_milliseconds(start))
+        if end is not None:
+            conditions.append("collection_date < ?")
+            parameters.append(self._to_milliseconds(end))
+        if kind is not None:
+            conditions.append("kind = ?")
+            parameters.append(kind)
+        return self.__select(" AND ".join(conditions), parameters)
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM shipments").fetchone()[0]
+
+    def close(self):
+        """
+
+        :return:
+        """
+        self.__connection.close()
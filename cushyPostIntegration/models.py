@@ -0,0 +1,212 @@
+import abc
+import json
+from cushyPostIntegration.templates import RATES
+
+
+class Model(abc.ABC):
+    __slots__ = ("_encoded",)
+    FIELDS = ()
+
+    def __init__(self, **fields):
+        """
+        Model with a fixed set of fields. The JSON of the request body is encoded once
+        and encoded again only after a field is changed
+        :param fields: values of FIELDS, None when missing
+        """
+        for field in self.FIELDS:
+            object.__setattr__(self, field, fields.pop(field, None))
+        if fields:
+            raise TypeError("unexpected fields {}".format(", ".join(sorted(fields))))
+        object.__setattr__(self, "_encoded", None)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "_encoded", None)
+
+    @abc.abstractmethod
+    def to_dict(self):
+        """
+
+        :return: node of the request body
+        """
+
+    def encode(self):
+        """
+
+        :return: JSON of the node of the request body
+        """
+        if self._encoded is None:
+            object.__setattr__(self, "_encoded", json.dumps(self.to_dict()))
+        return self._encoded
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, field) == getattr(other, field)
+                                                 for field in self.FIELDS)
+
+    def __repr__(self):
+        fields = ", ".join("{}={!r}".format(field, getattr(self, field)) for field in self.FIELDS)
+        return "{}({})".format(type(self).__name__, fields)
+
+
+class Location(Model):
+    FIELDS = ("name", "country", "postalcode", "city", "province", "region", "lat", "lng", "hash", "phone", "email",
+              "contact", "address")
+    __slots__ = FIELDS
+
+    @classmethod
+    def from_geo_db(cls, country_code, cap, location, elem_name):
+        """
+
+        :param country_code:
+        :param cap:
+        :param location: GeoDB location
+        :param elem_name: from or to
+        :return:
+        """
+        return cls(name=elem_name, country=country_code, postalcode=cap, city=location["city"],
+                   province=location["province"], region=location["region"],
+                   lat=location["location"]["coordinates"][1], lng=location["location"]["coordinates"][0],
+                   hash=location["id"], phone="", email="", contact="")
+
+    def to_dict(self):
+        """
+
+        :return: from or to node
+        """
+        location = {
+            "name": self.name,
+            "country": self.country,
+            "postalcode": self.postalcode,
+            "city": self.city,
+            "province": self.province,
+            "phone": self.phone,
+            "email": self.email,
+            "contact": self.contact,
+            "locality": self.city,
+            "administrative_area_level_1": self.region,
+            "administrative_area_level_2": self.province,
+            "location": {
+                "lat": self.lat,
+                "lng": self.lng,
+                "location_type": "APPROXIMATE"
+            },
+            "validity": {
+                "valid": True,
+                "component": "postalcode"
+            },
+            "type": "geodb",
+            "hash": self.hash
+        }
+        if self.address is not None:
+            location["address"] = self.address
+            location["administrative_area_level_3"] = self.city
+        return location
+
+
+class Package(Model):
+    FIELDS = ("type", "height", "width", "length", "weight", "content", "hash")
+    __slots__ = FIELDS
+
+    def to_dict(self):
+        """
+
+        :return: package node
+        """
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class Shipping(Model):
+    FIELDS = ("goods_desc", "product", "special_instructions", "packages")
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        """
+        The packages are kept in a tuple, change the attribute to change them
+        :param fields: values of FIELDS, packages is a list of Package
+        """
+        fields["packages"] = tuple(fields.get("packages") or ())
+        super(Shipping, self).__init__(**fields)
+
+    def __setattr__(self, name, value):
+        super(Shipping, self).__setattr__(name, tuple(value) if name == "packages" else value)
+
+    @property
+    def total_weight(self):
+        return sum([int(package.weight) for package in self.packages])
+
+    def to_dict(self):
+        """
+
+        :return: shipping node
+        """
+        return {
+            "total_weight": self.total_weight,
+            "goods_desc": self.goods_desc,
+            "product": self.product,
+            "special_instructions": self.special_instructions,
+            "packages": [package.to_dict() for package in self.packages]
+        }
+
+    def encode(self):
+        """
+        The packages are encoded by themselves, so that a change of a package is seen
+        :return:
+        """
+        if self._encoded is None:
+            object.__setattr__(self, "_encoded", json.dumps({"goods_desc": self.goods_desc, "product": self.product,
+                                                             "special_instructions": self.special_instructions})[1:-1])
+        return '{{"total_weight": {}, {}, "packages": [{}]}}'.format(
+            self.total_weight, self._encoded, ", ".join(package.encode() for package in self.packages))
+
+
+class Services(Model):
+    FIELDS = ("collection_date", "hours", "insurance_value", "cash_on_delivery")
+    __slots__ = FIELDS
+
+    def to_dict(self):
+        """
+
+        :return: services node
+        """
+        return {
+            "collection": {
+                "date": self.collection_date,
+                "hours": list(self.hours) if self.hours is not None else [10, 14]
+            },
+            "insurance": {
+                "value": float(self.insurance_value) if self.insurance_value else 0,
+                "currency": "EUR",
+                "algorithm": "any" if self.insurance_value else "none"
+            },
+            "cash_on_delivery": {
+                "value": float(self.cash_on_delivery) if self.cash_on_delivery else 0,
+                "currency": "EUR"
+            }
+        }
+
+
+class RatesRequest(Model):
+    FIELDS = ("app", "from_location", "to_location", "shipping", "services")
+    __slots__ = FIELDS
+
+    def to_dict(self):
+        """
+
+        :return: body of shipment/rate
+        """
+        return {
+            "app": self.app,
+            "from": self.from_location.to_dict(),
+            "to": self.to_location.to_dict(),
+            "shipping": self.shipping.to_dict(),
+            "services": self.services.to_dict()
+        }
+
+    def encode(self):
+        """
+        Built on the encodings of the nodes, the locations shared by many requests are encoded once
+        :return:
+        """
+        return RATES.bind(app=self.app).render(**{"from": self.from_location.encode(), "to": self.to_location.encode(),
+                                                  "shipping": self.shipping.encode(),
+                                                  "services": self.services.encode()})
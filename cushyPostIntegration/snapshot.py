@@ -0,0 +1,44 @@
+import json
+import zlib
+from cushyPostIntegration.exceptions import InvalidSnapshot
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SNAPSHOT_MAGIC = b"CPS"
+SNAPSHOT_VERSION = 1
+COMPRESSED = 1
+
+
+def dumps_snapshot(state, compress=True):
+    """
+    Encode a state as a versioned snapshot: magic, version, flags and the JSON of the state,
+    compressed with zlib. orjson is used when installed
+    :param state: dictionary of JSON types
+    :param compress: (optional) compress the JSON, worth it when geo_db_data is embedded
+    :return: bytes
+    """
+    payload = orjson.dumps(state) if orjson is not None else json.dumps(state, separators=(",", ":")).encode()
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= COMPRESSED
+    return SNAPSHOT_MAGIC + bytes((SNAPSHOT_VERSION, flags)) + payload
+
+
+def loads_snapshot(snapshot):
+    """
+
+    :param snapshot: bytes built by dumps_snapshot
+    :return: the state
+    """
+    if len(snapshot) < 5 or snapshot[:3] != SNAPSHOT_MAGIC or snapshot[3] != SNAPSHOT_VERSION:
+        raise InvalidSnapshot()
+    payload = memoryview(snapshot)[5:]
+    try:
+        if snapshot[4] & COMPRESSED:
+            payload = zlib.decompress(payload)
+        return orjson.loads(payload) if orjson is not None else json.loads(bytes(payload))
+    except (zlib.error, ValueError):
+        raise InvalidSnapshot()
@@ -0,0 +1,151 @@
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+
+class Field:
+    def __init__(self, name, raw=False):
+        """
+        Variable field of a BodyTemplate
+        :param name: name of the value passed to render
+        :param raw: (optional) the value is already encoded JSON and is spliced as it is
+        """
+        self.name = name
+        self.raw = raw
+
+
+class BodyTemplate:
+    __MARKER = re.compile(r'"@@(\d+)@@"')
+
+    def __init__(self, body):
+        """
+        Request body encoded once: only the Field values are encoded by render.
+        The output is the same of json.dumps over the complete body
+        :param body: dictionary of the body, the variable values are Field
+        """
+        fields = []
+
+        def mark(value):
+            if not isinstance(value, Field):
+                raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+            fields.append(value)
+            return "@@{}@@".format(len(fields) - 1)
+
+        parts = self.__MARKER.split(json.dumps(body, default=mark))
+        self.__literals = parts[0::2]
+        self.__fields = [fields[int(index)] for index in parts[1::2]]
+        self.__bound = {}
+
+    @classmethod
+    def __from_parts(cls, literals, fields):
+        template = cls.__new__(cls)
+        template.__literals = literals
+        template.__fields = fields
+        template.__bound = {}
+        return template
+
+    @property
+    def fields(self):
+        """
+
+        :return: names of the fields still to render
+        """
+        return [field.name for field in self.__fields]
+
+    def bind(self, **values):
+        """
+        Encode some fields once, e.g. the app of a client. The bound templates are kept
+        :param values: values of the fields to fix
+        :return: BodyTemplate with the remaining fields
+        """
+        key = tuple(sorted(values.items()))
+        template = self.__bound.get(key)
+        if template is None:
+            literals = [self.__literals[0]]
+            fields = []
+            for field, literal in zip(self.__fields, self.__literals[1:]):
+                if field.name in values:
+                    literals[-1] += self.__encode(field, values[field.name]) + literal
+                else:
+                    fields.append(field)
+                    literals.append(literal)
+            template = self.__bound[key] = self.__from_parts(literals, fields)
+        return template
+
+    @staticmethod
+    def __encode(field, value):
+        """
+        Same output of json.dumps, without its overhead for strings and integers
+        :param field:
+        :param value:
+        :return:
+        """
+        if field.raw:
+            return value
+        if type(value) is str:
+            return encode_basestring_ascii(value)
+        if type(value) is int:
+            return int.__repr__(value)
+        return json.dumps(value)
+
+    def render(self, **values):
+        """
+
+        :param values: values of all the fields
+        :return: JSON of the body
+        """
+        literals = self.__literals
+        parts = [literals[0]]
+        for field, literal in zip(self.__fields, literals[1:]):
+            parts.append(self.__encode(field, values[field.name]))
+            parts.append(literal)
+        return "".join(parts)
+
+
+SEARCH_PAID_SHIPPING = BodyTemplate({
+    "app": Field("app"),
+    "limit": Field("limit"),
+    "skip": Field("skip"),
+    "sort": {
+        "services.collection.date": -1
+    },
+    "filter": {
+        "status.current.value": {
+            "$nin": ["WaitingForPayment", "PaymentInitiated", "Draft", "Archived"]
+        }
+    },
+    "match": {
+        "status.current.value": {
+            "$nin": ["WaitingForPayment", "PaymentInitiated", "Draft", "Archived"]
+        }
+    },
+    "inspect": False
+})
+
+SEARCH_QUOTATION_TO_PAY = BodyTemplate({
+    "app": Field("app"),
+    "limit": Field("limit"),
+    "skip": Field("skip"),
+    "sort": {
+        "services.collection.date": -1
+    },
+    "filter": {
+        "status.current.value": {
+            "$in": ["WaitingForPayment", "PaymentInitiated"]
+        }
+    }
+})
+
+CART_ITEM = BodyTemplate({
+    "app": Field("app"),
+    "type": "shipment",
+    "id": Field("id")
+})
+
+RATES = BodyTemplate({
+    "app": Field("app"),
+    "from": Field("from", raw=True),
+    "to": Field("to", raw=True),
+    "shipping": Field("shipping", raw=True),
+    "services": Field("services", raw=True)
+})
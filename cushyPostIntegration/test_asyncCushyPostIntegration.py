@@ -0,0 +1,374 @@
+import asyncio
+import threading
+import unittest
+from cushyPostIntegration import AsyncCushyPostIntegration, HttpTransport, FileTokenStore, SQLiteTokenStore
+from cushyPostIntegration.transport import AsyncResponse
+from cushyPostIntegration.exceptions import AddToCartFailed, MissingToken
+from cushyPostIntegration.test_cushyPostIntegration import get_jwt
+from cushyPostIntegration.cushyPostIntegration import _holidays
+import json
+import responses
+import logging
+import os
+import tempfile
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class RequestsAsyncTransport:
+    """
+    Async transport running the calls on requests, so that they can be mocked with responses
+    """
+    def __init__(self):
+        self.transport = HttpTransport()
+
+    async def request(self, http_method, url, headers=None, data=None, params=None):
+        response = self.transport.request(http_method, url, headers=headers, data=data, params=params)
+        return AsyncResponse(response.status_code, response.headers, response.content)
+
+
+class SlowAsyncTransport(RequestsAsyncTransport):
+    """
+    RequestsAsyncTransport giving back the control to the event loop before every call
+    """
+    async def request(self, http_method, url, headers=None, data=None, params=None):
+        await asyncio.sleep(0.01)
+        return await super(SlowAsyncTransport, self).request(http_method, url, headers=headers, data=data,
+                                                             params=params)
+
+
+class TestAsyncCushyPostIntegration(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        _holidays.clear()
+
+    def get_client(self):
+        cushy_post_integration = AsyncCushyPostIntegration("TEST", "NEW_APP", transport=RequestsAsyncTransport())
+        cushy_post_integration.token = "X-Cushypost-JWT_LOGIN"
+        cushy_post_integration.refresh_token = "X-Cushypost-Refresh-JWT_REFRESH"
+        return cushy_post_integration
+
+    @responses.activate
+    async def test_login_success(self):
+        cushy_post_integration = AsyncCushyPostIntegration("TEST", "NEW_APP", transport=RequestsAsyncTransport())
+        responses.add(responses.POST, "{}/security/v1/login".format(cushy_post_integration.domain),
+                      json={"response": {"data": {}}},
+                      status=200,
+                      headers={
+                          "X-Cushypost-JWT": "X-Cushypost-JWT_LOGIN",
+                          "X-Cushypost-Refresh-JWT": "X-Cushypost-Refresh-JWT_REFRESH"
+                      })
+        await cushy_post_integration.login("username", "password")
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body),
+                         {"app": cushy_post_integration.app, "username": "username", "password": "password"})
+        self.assertEqual(cushy_post_integration.token, "X-Cushypost-JWT_LOGIN")
+        self.assertEqual(cushy_post_integration.refresh_token, "X-Cushypost-Refresh-JWT_REFRESH")
+
+    @responses.activate
+    async def test_login_with_shared_token_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for store_class, path in ((FileTokenStore, "tokens.json"), (SQLiteTokenStore, "tokens.sqlite")):
+                responses.reset()
+                clients = [AsyncCushyPostIntegration("TEST", "NEW_APP", transport=SlowAsyncTransport(),
+                                                     token_store=store_class(os.path.join(directory, path)))
+                           for _ in range(2)]
+                responses.add(responses.POST, "{}/security/v1/login".format(clients[0].domain),
+                              json={"response": {"data": {}}},
+                              status=200,
+                              headers={
+                                  "X-Cushypost-JWT": "X-Cushypost-JWT_LOGIN",
+                                  "X-Cushypost-Refresh-JWT": "X-Cushypost-Refresh-JWT_REFRESH"
+                              })
+                ticks = []
+
+                async def tick():
+                    while True:
+                        ticks.append(None)
+                        await asyncio.sleep(0.005)
+
+                ticker = asyncio.ensure_future(tick())
+                await asyncio.wait_for(asyncio.gather(*[client.login("username", "password")
+                                                        for client in clients]), 5)
+                ticker.cancel()
+                self.assertEqual(len(responses.calls), 1)
+                self.assertEqual([client.token for client in clients], ["X-Cushypost-JWT_LOGIN"] * 2)
+                self.assertGreater(len(ticks), 1)
+
+    @responses.activate
+    async def test_token_store_out_of_the_event_loop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            token_store = FileTokenStore(os.path.join(directory, "tokens.json"))
+            client = AsyncCushyPostIntegration("TEST", "NEW_APP", transport=RequestsAsyncTransport(),
+                                               token_store=token_store)
+            responses.add(responses.POST, "{}/security/v1/login".format(client.domain),
+                          json={"response": {"data": {}}},
+                          status=200,
+                          headers={
+                              "X-Cushypost-JWT": "X-Cushypost-JWT_LOGIN",
+                              "X-Cushypost-Refresh-JWT": "X-Cushypost-Refresh-JWT_REFRESH"
+                          })
+            threads = []
+            load, save = token_store.load, token_store.save
+            token_store.load = lambda: threads.append(threading.get_ident()) or load()
+            token_store.save = lambda *tokens: threads.append(threading.get_ident()) or save(*tokens)
+
+            self.assertTrue(token_store.acquire(owner="other process"))
+            waiting = asyncio.ensure_future(client.login("username", "password"))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+            waiting.cancel()
+            token_store.release(owner="other process")
+            await asyncio.wait_for(client.login("username", "password"), 5)
+            self.assertEqual(client.token, "X-Cushypost-JWT_LOGIN")
+            self.assertEqual(len(threads), 2)
+            self.assertNotIn(threading.get_ident(), threads)
+            self.assertTrue(token_store.acquire(blocking=False, owner="other process"))
+            token_store.release(owner="other process")
+
+    @responses.activate
+    async def test_token_without_refresh_token(self):
+        cushy_post_integration = AsyncCushyPostIntegration("TEST", "NEW_APP", transport=RequestsAsyncTransport(),
+                                                           token_refresh_margin=60)
+        cushy_post_integration.token = get_jwt(30)
+        cushy_post_integration.start_token_refresher()
+        await asyncio.sleep(0.05)
+        self.assertNotIn("__refresh_tokens_in_background",
+                         [task.get_coro().__qualname__.split(".")[-1] for task in asyncio.all_tasks()])
+        cushy_post_integration.token = get_jwt(-1)
+        cushy_post_integration.checkout_session_id = "1234"
+        with self.assertRaises(MissingToken):
+            await cushy_post_integration.confirm_cart()
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    async def test_search_geo_db_with_refresh(self):
+        cushy_post_integration = self.get_client()
+        responses.add(responses.POST, "{}/security/refresh_token".format(cushy_post_integration.domain),
+                      json={"response": {"data": {}}},
+                      status=200,
+                      headers={
+                          "X-Cushypost-JWT": "X-Cushypost-JWT_LOGIN_new",
+                          "X-Cushypost-Refresh-JWT": "X-Cushypost-Refresh-JWT_REFRESH_new"
+                      })
+        location = {"id": "b9b645b94641103026828a421dec14ce", "province": "RM", "region": "Lazio",
+                    "postcode": "00020", "city": "Vivaro Romano",
+                    "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}
+
+        def request_callback(request):
+            if request.headers["Authorization"] == "Bearer X-Cushypost-JWT_LOGIN":
+                return 401, {}, json.dumps({"response": {"data": None}})
+            return 200, {}, json.dumps({"response": {"data": [location]}})
+
+        responses.add_callback(responses.POST, "{}/geodb/place_autocomplete".format(cushy_post_integration.domain),
+                               callback=request_callback,
+                               content_type='application/json')
+        self.assertEqual(await cushy_post_integration.search_geo_db("IT", "00020"), [location])
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(cushy_post_integration.token, "X-Cushypost-JWT_LOGIN_new")
+        self.assertEqual(cushy_post_integration.refresh_token, "X-Cushypost-Refresh-JWT_REFRESH_new")
+        await cushy_post_integration.set_from("IT", "00020", "Vivaro Romano")
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(cushy_post_integration.from_location["hash"], "b9b645b94641103026828a421dec14ce")
+        self.assertEqual(cushy_post_integration.from_location["location"],
+                         {"lat": "42.09882", "lng": "13.00659", "location_type": "APPROXIMATE"})
+
+    @responses.activate
+    async def test_concurrent_get_rates(self):
+        clients = [self.get_client() for _ in range(5)]
+        responses.add(responses.POST, "{}/shipment/rate".format(clients[0].domain),
+                      json={"response": {"data": {"list": []}}},
+                      status=200)
+        for client in clients:
+            client.from_location = {"country": "IT"}
+            client.to_location = {"country": "IT"}
+            client.services = {"collection": {}}
+            client.set_shipping([{"height": "10", "width": "10", "length": "10", "weight": "10"}])
+        rates = await asyncio.gather(*[client.get_rates() for client in clients])
+        self.assertEqual(rates, [{"list": []}] * 5)
+        self.assertEqual(len(responses.calls), 5)
+
+    @responses.activate
+    async def test_search_by_quotation_id_many_call(self):
+        with open("{}/test_data/shipment_search.json".format(dir_path), 'r') as file_1:
+            with open("{}/test_data/shipment_search_more.json".format(dir_path), 'r') as file_2:
+                cushy_post_integration = self.get_client()
+                responses.add(responses.POST, "{}/shipment/search".format(cushy_post_integration.domain),
+                              json=json.load(file_1),
+                              status=200)
+                responses.add(responses.POST, "{}/shipment/search".format(cushy_post_integration.domain),
+                              json=json.load(file_2),
+                              status=200)
+                shi_ids, tracking_urls = await cushy_post_integration.search_by_quotation_id(
+                    ["615e295bf6427c79b9749b64789"])
+                self.assertEqual(len(responses.calls), 2)
+                self.assertListEqual(shi_ids, ["615e29d02a562c5ad47e5792789"])
+                self.assertListEqual(tracking_urls, ["tracking_url_format1"])
+                self.assertEqual(json.loads(responses.calls[1].request.body)["skip"], 10)
+
+    @responses.activate
+    async def test_buy_and_confirm_cart(self):
+        with open("{}/test_data/buy_cart_response.json".format(dir_path), 'r') as file:
+            cushy_post_integration = self.get_client()
+            responses.add(responses.POST, "{}/cart/buy".format(cushy_post_integration.domain),
+                          json=json.load(file),
+                          status=200)
+            responses.add(responses.POST, "{}/cart/confirm".format(cushy_post_integration.domain),
+                          json={"response": {"data": []}},
+                          status=200)
+            await cushy_post_integration.buy_cart("success_url", "cancel_url", "description")
+            self.assertEqual(await cushy_post_integration.confirm_cart(), [])
+            self.assertEqual(json.loads(responses.calls[1].request.body),
+                             {"app": "NEW_APP", "session_id": cushy_post_integration.checkout_session_id})
+
+    @responses.activate
+    async def test_add_shipping_ids_to_cart_concurrently(self):
+        cushy_post_integration = self.get_client()
+
+        def request_callback(request):
+            shipping_id = json.loads(request.body)["id"] if request.method == "POST" else request.params["id"]
+            if shipping_id == "ID002":
+                return 500, {}, json.dumps({"error": shipping_id})
+            if request.method == "DELETE" and shipping_id == "ID000":
+                return 502, {}, "Bad Gateway"
+            return 200, {}, json.dumps({"response": {"data": {"id": shipping_id}}})
+
+        for method in (responses.POST, responses.DELETE):
+            responses.add_callback(method, "{}/cart/item".format(cushy_post_integration.domain),
+                                   callback=request_callback, content_type='application/json')
+        try:
+            await cushy_post_integration.add_shipping_ids_to_cart(["ID000", "ID001", "ID002"], max_concurrency=2)
+            raise Exception("ADD TO CART FAILED - TEST FAILED")
+        except AddToCartFailed as error:
+            self.assertEqual(error.outcomes["ID001"], {"data": {"id": "ID001"}, "error": None})
+            self.assertIsNotNone(error.outcomes["ID002"]["error"])
+            self.assertIsNotNone(error.removal_outcomes["ID000"]["error"])
+            self.assertEqual(error.removal_outcomes["ID001"], {"data": {"id": "ID001"}, "error": None})
+        self.assertEqual(sorted(call.request.params["id"] for call in responses.calls if call.request.method == "DELETE"),
+                         ["ID000", "ID001"])
+
+    @responses.activate
+    async def test_download_shipment_labels(self):
+        cushy_post_integration = self.get_client()
+        responses.add(responses.GET, "{}/shipment/label".format(cushy_post_integration.domain),
+                      json={"response": {"data": "JVBERi0xLjQ="}},
+                      status=200)
+        labels = {}
+
+        async def save_label(shipping_id, label):
+            labels[shipping_id] = label
+
+        outcomes = await cushy_post_integration.download_shipment_labels(["label_1", "label_2"], save_label)
+        self.assertEqual(labels, {"label_1": b"%PDF-1.4", "label_2": b"%PDF-1.4"})
+        self.assertEqual(outcomes["label_2"], {"data": 8, "error": None})
+
+    @responses.activate
+    async def test_get_rates_batch(self):
+        cushy_post_integration = self.get_client()
+        cushy_post_integration.geo_db_data = {"IT_00020_City": {
+            "id": "HASH_00020", "province": "RM", "region": "Lazio", "postcode": "00020", "city": "City",
+            "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}}
+        responses.add(responses.POST, "{}/calendar/holidays".format(cushy_post_integration.domain),
+                      json={"response": {"data": []}},
+                      status=200)
+        responses.add(responses.POST, "{}/shipment/rate".format(cushy_post_integration.domain),
+                      json={"response": {"data": {"list": []}}},
+                      status=200)
+        rate_request = {
+            "from": {"country_code": "IT", "cap": "00020", "city": "City"},
+            "to": {"country_code": "IT", "cap": "00020", "city": "City"},
+            "shipping": {"packages": [{"height": "10", "width": "10", "length": "10", "weight": "10"}]},
+            "services": {"year": "2021"}
+        }
+        results = [result async for result in cushy_post_integration.get_rates_batch([rate_request] * 3 + [{}])]
+        self.assertEqual(sorted(result["index"] for result in results), [0, 1, 2, 3])
+        self.assertEqual([result["data"] for result in results if result["index"] != 3], [{"list": []}] * 3)
+        self.assertIsInstance([result for result in results if result["index"] == 3][0]["error"], KeyError)
+        self.assertEqual(len(responses.calls), 4)
+
+    async def test_get_rates_batch_missing_token(self):
+        cushy_post_integration = AsyncCushyPostIntegration("TEST", "NEW_APP", transport=RequestsAsyncTransport())
+        self.assertRaises(MissingToken, cushy_post_integration.get_rates_batch, [])
+
+    @responses.activate
+    async def test_get_rates_batch_stopped_early(self):
+        cushy_post_integration = self.get_client()
+        cushy_post_integration.transport = SlowAsyncTransport()
+        cushy_post_integration.geo_db_data = {"IT_00020_City": {
+            "id": "HASH_00020", "province": "RM", "region": "Lazio", "postcode": "00020", "city": "City",
+            "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}}
+        responses.add(responses.POST, "{}/calendar/holidays".format(cushy_post_integration.domain),
+                      json={"response": {"data": []}},
+                      status=200)
+        responses.add(responses.POST, "{}/shipment/rate".format(cushy_post_integration.domain),
+                      json={"response": {"data": {"list": []}}},
+                      status=200)
+        rate_request = {
+            "from": {"country_code": "IT", "cap": "00020", "city": "City"},
+            "to": {"country_code": "IT", "cap": "00020", "city": "City"},
+            "shipping": {"packages": [{"height": "10", "width": "10", "length": "10", "weight": "10"}]},
+            "services": {"year": "2021"}
+        }
+        results = cushy_post_integration.get_rates_batch([rate_request] * 100, max_concurrency=2)
+        async for result in results:
+            self.assertEqual(result["data"], {"list": []})
+            break
+        await results.aclose()
+        await asyncio.sleep(0.1)
+        calls = [call.request.url.split("/")[-1] for call in responses.calls]
+        self.assertLess(calls.count("rate"), 10)
+
+    @responses.activate
+    async def test_rate_matrix(self):
+        cushy_post_integration = self.get_client()
+        cushy_post_integration.geo_db_data = {"IT_00020_City": {
+            "id": "HASH_00020", "province": "RM", "region": "Lazio", "postcode": "00020", "city": "City",
+            "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}}
+        responses.add(responses.POST, "{}/calendar/holidays".format(cushy_post_integration.domain),
+                      json={"response": {"data": []}},
+                      status=200)
+        responses.add(responses.POST, "{}/shipment/rate".format(cushy_post_integration.domain),
+                      json={"response": {"data": {"list": [{"label": "TNT", "price": 10}]}}},
+                      status=200)
+        location = {"country_code": "IT", "cap": "00020", "city": "City"}
+        packages = [{"height": "10", "width": "10", "length": "10", "weight": "10"}]
+        table = await cushy_post_integration.rate_matrix([location], [location, location], [packages])
+        self.assertEqual(table["destination"], [0, 1])
+        self.assertEqual(table["carrier"], ["TNT", "TNT"])
+        self.assertEqual(table["price"], [10, 10])
+
+    @responses.activate
+    async def test_iter_quotations_to_pay(self):
+        cushy_post_integration = self.get_client()
+        shipments = [{"_id": {"$oid": "ID{}".format(index)}} for index in range(7)]
+
+        def request_callback(request):
+            request_sent = json.loads(request.body)
+            items = shipments[request_sent["skip"]:request_sent["skip"] + request_sent["limit"]]
+            return 200, {}, json.dumps({"response": {"data": {"total": len(shipments), "items": items}}})
+
+        responses.add_callback(responses.POST, "{}/shipment/search".format(cushy_post_integration.domain),
+                               callback=request_callback, content_type='application/json')
+        self.assertEqual([item async for item in cushy_post_integration.iter_quotations_to_pay(page_size=3)],
+                         shipments)
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual([item async for item in cushy_post_integration.iter_paid_shipments(page_size=7,
+                                                                                              prefetch=False)],
+                         shipments)
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    async def test_search_all_paid_shipping(self):
+        cushy_post_integration = self.get_client()
+        shipments = [{"_id": {"$oid": "ID{}".format(index)}} for index in range(7)]
+
+        def request_callback(request):
+            request_sent = json.loads(request.body)
+            items = shipments[request_sent["skip"]:request_sent["skip"] + request_sent["limit"]]
+            return 200, {}, json.dumps({"response": {"data": {"total": len(shipments), "items": items}}})
+
+        responses.add_callback(responses.POST, "{}/shipment/search".format(cushy_post_integration.domain),
+                               callback=request_callback, content_type='application/json')
+        self.assertEqual(await cushy_post_integration.search_all_paid_shipping(page_size=2), shipments)
+        self.assertEqual(len(responses.calls), 4)
@@ -0,0 +1,73 @@
+import unittest
+import datetime
+from unittest import mock
+from cushyPostIntegration import CushyPostIntegration, MemoryCache, BusinessCalendar, collection_dates
+from cushyPostIntegration import business_days
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestBusinessDays(unittest.TestCase):
+    def test_roll_forward(self):
+        calendar = BusinessCalendar([{"date": "2021-11-01"}, "2021-12-24", datetime.date(2021, 12, 27)])
+        self.assertEqual(calendar.roll_forward([]), [])
+        self.assertEqual(calendar.roll_forward([
+            datetime.date(2021, 10, 28),
+            datetime.date(2021, 10, 30),
+            datetime.date(2021, 10, 31),
+            datetime.datetime(2021, 12, 24, 15, 30)
+        ]), [
+            datetime.date(2021, 10, 28),
+            datetime.date(2021, 11, 2),
+            datetime.date(2021, 11, 2),
+            datetime.datetime(2021, 12, 28, 15, 30)
+        ])
+        self.assertTrue(calendar.is_business_day("2021-11-02"))
+        self.assertFalse(calendar.is_business_day(datetime.datetime(2021, 11, 1, 10)))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_parity(self):
+        holidays = ["2021-01-01", "2021-01-06", "2021-04-05", "2021-04-25", "2021-05-01", "2021-06-02",
+                    "2021-08-15", "2021-11-01", "2021-12-08", "2021-12-24", "2021-12-25", "2021-12-26",
+                    "2021-12-27", "2021-12-31", "2022-01-03"]
+        dates = [datetime.date(2020, 12, 20) + datetime.timedelta(days=day) for day in range(400)] + \
+                [datetime.datetime(2021, 12, 24, 15, 30), datetime.datetime(2021, 10, 6, 9, 0)]
+        numpy_dates = BusinessCalendar(holidays).roll_forward(dates)
+        with mock.patch("cushyPostIntegration.business_days.numpy", None):
+            calendar = BusinessCalendar(holidays)
+            self.assertEqual(calendar.roll_forward(dates), numpy_dates)
+        self.assertEqual(numpy_dates[-2:], [datetime.datetime(2021, 12, 28, 15, 30), datetime.datetime(2021, 10, 6, 9, 0)])
+
+    def test_collection_dates(self):
+        calendars = {"IT": BusinessCalendar(["2021-06-02"]), "FR": BusinessCalendar(["2021-07-14"])}
+        self.assertEqual(collection_dates(
+            [datetime.date(2021, 6, 2), datetime.date(2021, 6, 2), datetime.date(2021, 7, 14),
+             datetime.date(2021, 7, 14), datetime.date(2021, 7, 17)],
+            ["IT", "FR", "IT", "FR", "DE"],
+            calendars
+        ), [datetime.date(2021, 6, 3), datetime.date(2021, 6, 2), datetime.date(2021, 7, 14),
+            datetime.date(2021, 7, 15), datetime.date(2021, 7, 19)])
+        try:
+            collection_dates([datetime.date(2021, 6, 2)], [], calendars)
+            raise Exception("LENGTH NOT VALID - TEST FAILED")
+        except ValueError as error:
+            self.assertEqual(str(error), "requested_dates and countries must have the same length")
+
+    def test_client_calendars(self):
+        holiday_cache = MemoryCache()
+        holiday_cache.set("SM_2031", [{"date": "2031-10-06"}])
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", token="token", holiday_cache=holiday_cache)
+        cushy_post_integration.from_location = {"country": "SM"}
+        with mock.patch("cushyPostIntegration.cushyPostIntegration.BusinessCalendar",
+                        wraps=business_days.BusinessCalendar) as calendar_class:
+            for day in ("6", "7", "6"):
+                cushy_post_integration.set_services("2031", month="10", day=day)
+            self.assertEqual(calendar_class.call_count, 1)
+            self.assertEqual(cushy_post_integration.services["collection"]["date"][:10], "2031-10-07")
+            # the calendar is built again when the holidays change
+            holiday_cache.set("SM_2031", [{"date": "2031-10-07"}])
+            cushy_post_integration.set_services("2031", month="10", day="6")
+            self.assertEqual(calendar_class.call_count, 2)
+            self.assertEqual(cushy_post_integration.services["collection"]["date"][:10], "2031-10-06")
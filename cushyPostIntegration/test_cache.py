@@ -0,0 +1,213 @@
+import unittest
+from cushyPostIntegration import CushyPostIntegration, MemoryCache, SQLiteCache, LabelCache
+from cushyPostIntegration.exceptions import MissingData
+from cushyPostIntegration.cushyPostIntegration import _holidays
+import os
+import base64
+import json
+import responses
+import logging
+import tempfile
+import time
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        _holidays.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def check_cache(self, cache):
+        self.assertIsNone(cache.get("missing"))
+        cache.set("first", {"value": 1})
+        cache.set("second", [1, 2])
+        self.assertEqual(cache.get("first"), {"value": 1})
+        cache.set("third", "3")
+        # second is the least recently used
+        self.assertIsNone(cache.get("second"))
+        self.assertEqual(cache.get("third"), "3")
+        cache.set("expired", "value", ttl=-1)
+        self.assertIsNone(cache.get("expired"))
+        cache.delete("third")
+        self.assertIsNone(cache.get("third"))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 4, "entries": 0})
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_memory_cache(self):
+        self.check_cache(MemoryCache(max_entries=2))
+
+    def test_sqlite_cache(self):
+        cache = SQLiteCache(self.path, max_entries=2)
+        self.check_cache(cache)
+        cache.close()
+
+    def test_sqlite_cache_shared(self):
+        first_cache = SQLiteCache(self.path, table="geo_db", ttl=60)
+        second_cache = SQLiteCache(self.path, table="geo_db", ttl=60)
+        first_cache.set("IT_00020_Vivaro Romano", {"id": "HASH"})
+        self.assertEqual(second_cache.get("IT_00020_Vivaro Romano"), {"id": "HASH"})
+        self.assertIsNone(SQLiteCache(self.path, table="other").get("IT_00020_Vivaro Romano"))
+        first_cache.close()
+        second_cache.close()
+
+    def test_ttl(self):
+        cache = MemoryCache(ttl=0.01)
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("key"))
+
+    @responses.activate
+    def test_geo_cache(self):
+        geo_cache = SQLiteCache(self.path, table="geo_db")
+        location = {"id": "b9b645b94641103026828a421dec14ce", "province": "RM", "region": "Lazio",
+                    "postcode": "00020", "city": "Vivaro Romano",
+                    "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", token="token", geo_cache=geo_cache)
+        responses.add(responses.POST, "{}/geodb/place_autocomplete".format(cushy_post_integration.domain),
+                      json={"response": {"data": [location]}},
+                      status=200)
+        cushy_post_integration.set_from("IT", "00020", "Vivaro")
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body)["sequence"], "00020 Vivaro")
+        other_worker = CushyPostIntegration("TEST", "NEW_APP", token="token",
+                                            geo_cache=SQLiteCache(self.path, table="geo_db"))
+        other_worker.set_from("IT", "00020", "Vivaro")
+        other_worker.set_to("IT", "00020", "Vivaro")
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(other_worker.from_location, cushy_post_integration.from_location)
+        self.assertEqual(other_worker.geo_cache.stats()["hits"], 2)
+        self.assertEqual(other_worker.geo_db_data, {})
+        cushy_post_integration.search_geo_db("IT", "00020")
+        self.assertEqual(other_worker.geo_cache.get("IT_00020_Vivaro Romano"), location)
+
+    def test_label_cache(self):
+        directory = os.path.join(self.directory.name, "labels")
+        cache = LabelCache(directory, max_bytes=20)
+        self.assertIsNone(cache.get("label_1"))
+        cache.set("label_1", b"0123456789")
+        cache.set("label_2", b"0123456789")
+        # the same PDF is saved once
+        self.assertEqual(len([name for name in os.listdir(directory) if name.endswith(".pdf")]), 1)
+        cache.set("label_3", b"abcdefghij")
+        self.assertEqual(cache.get("label_1"), b"0123456789")
+        cache.set("label_4", b"ABCDEFGHIJ")
+        # label_3 is the least recently used
+        self.assertIsNone(cache.get("label_3"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "entries": 2, "bytes": 20})
+        cache.delete("label_1")
+        self.assertEqual(LabelCache(directory).get("label_4"), b"ABCDEFGHIJ")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual([name for name in os.listdir(directory) if name.endswith(".pdf")], [])
+        cache.close()
+
+    @responses.activate
+    def test_label_cache_client(self):
+        label_cache = LabelCache(os.path.join(self.directory.name, "labels"))
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", token="token", label_cache=label_cache)
+        responses.add(responses.GET, "{}/shipment/label".format(cushy_post_integration.domain),
+                      json={"response": {"data": "JVBERi0xLjQ="}},
+                      status=200)
+        self.assertEqual(cushy_post_integration.get_shipment_label(["label_1"]), ["JVBERi0xLjQ="])
+        self.assertEqual(cushy_post_integration.get_shipment_label(["label_1"]), ["JVBERi0xLjQ="])
+        labels = {}
+        cushy_post_integration.download_shipment_labels(["label_1"], labels.__setitem__)
+        self.assertEqual(labels, {"label_1": base64.b64decode("JVBERi0xLjQ=")})
+        self.assertEqual(len(responses.calls), 1)
+        label_cache.delete("label_1")
+        cushy_post_integration.get_shipment_label(["label_1"])
+        self.assertEqual(len(responses.calls), 2)
+        label_cache.close()
+
+    @responses.activate
+    def test_rate_cache_environments(self):
+        rate_cache = MemoryCache(ttl=60)
+        clients = [CushyPostIntegration(environment, "NEW_APP", token="token", rate_cache=rate_cache)
+                   for environment in ("TEST", "PRD")]
+        for cushy_post_integration, price in zip(clients, (10, 20)):
+            responses.add(responses.POST, "{}/shipment/rate".format(cushy_post_integration.domain),
+                          json={"response": {"data": [{"price": price}]}},
+                          status=200)
+            cushy_post_integration.from_location = {"country": "IT", "postalcode": "00020", "hash": "FROM_HASH",
+                                                    "city": "Vivaro Romano"}
+            cushy_post_integration.to_location = {"country": "IT", "postalcode": "00028", "hash": "TO_HASH",
+                                                  "city": "Subiaco"}
+            cushy_post_integration.services = {"collection": {"date": "2021-10-06T10:00:00Z", "hours": [10, 14]}}
+            cushy_post_integration.set_shipping([{"height": "10", "width": "10", "length": "10", "weight": "10"}])
+        self.assertEqual(clients[0].get_rates(), [{"price": 10}])
+        self.assertEqual(clients[1].get_rates(), [{"price": 20}])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(clients[1].get_rates(), [{"price": 20}])
+        self.assertEqual(rate_cache.stats(), {"hits": 1, "misses": 2, "entries": 2})
+
+    @responses.activate
+    def test_rate_cache_quotations(self):
+        rate_cache = MemoryCache(ttl=60)
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", token="token", rate_cache=rate_cache)
+        rate = {"id": {"$oid": "QUOTATION_1"}, "call": "CALL_1", "label": "TNT", "price": 10}
+        responses.add(responses.POST, "{}/shipment/rate".format(cushy_post_integration.domain),
+                      json={"response": {"data": {"currency": "EUR", "best_price": rate, "list": [rate]}}},
+                      status=200)
+        cushy_post_integration.from_location = {"country": "IT", "postalcode": "00020", "hash": "FROM_HASH"}
+        cushy_post_integration.to_location = {"country": "IT", "postalcode": "00028", "hash": "TO_HASH"}
+        cushy_post_integration.services = {"collection": {"date": "2021-10-06T10:00:00Z", "hours": [10, 14]}}
+        cushy_post_integration.set_shipping([{"height": "10", "width": "10", "length": "10", "weight": "10"}])
+        self.assertEqual(cushy_post_integration.get_rates()["list"][0]["id"], {"$oid": "QUOTATION_1"})
+        cached_rates = cushy_post_integration.get_rates()
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(cached_rates, {"currency": "EUR", "best_price": {"label": "TNT", "price": 10},
+                                        "list": [{"label": "TNT", "price": 10}]})
+        with self.assertRaises(MissingData):
+            cushy_post_integration.approve_quotation(cached_rates["list"][0].get("id"), {}, {})
+        self.assertEqual(cushy_post_integration.get_rates(use_cache=False)["list"][0]["id"],
+                         {"$oid": "QUOTATION_1"})
+        self.assertEqual(len(responses.calls), 2)
+        self.assertNotIn("id", rate_cache.get(cushy_post_integration._rate_cache_key(
+            cushy_post_integration._current_rates_body()))["list"][0])
+
+    @responses.activate
+    def test_rate_cache(self):
+        rate_cache = MemoryCache(ttl=60)
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", token="token", rate_cache=rate_cache)
+        responses.add(responses.POST, "{}/shipment/rate".format(cushy_post_integration.domain),
+                      json={"response": {"data": [{"price": 10}]}},
+                      status=200)
+        responses.add(responses.POST, "{}/calendar/holidays".format(cushy_post_integration.domain),
+                      json={"response": {"data": []}},
+                      status=200)
+        cushy_post_integration.from_location = {"country": "IT", "postalcode": "00020", "hash": "FROM_HASH",
+                                                "city": "Vivaro Romano"}
+        cushy_post_integration.to_location = {"country": "IT", "postalcode": "00028", "hash": "TO_HASH",
+                                              "city": "Subiaco"}
+        cushy_post_integration.set_services("2021", month="10", day="6")
+        packages = [{"height": "10", "width": "10", "length": "10", "weight": "10"},
+                    {"type": "Pallet", "height": "20", "width": "20", "length": "20", "weight": "20"}]
+        cushy_post_integration.set_shipping(packages)
+        self.assertEqual(cushy_post_integration.get_rates(), [{"price": 10}])
+        # new package hashes, same packages in another order
+        cushy_post_integration.set_shipping(list(reversed(packages)), goods_desc="other")
+        self.assertEqual(cushy_post_integration.get_rates(), [{"price": 10}])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(rate_cache.stats(), {"hits": 1, "misses": 1, "entries": 1})
+        cushy_post_integration.set_shipping([dict(packages[0], weight="11")])
+        cushy_post_integration.get_rates()
+        cushy_post_integration.set_services("2021", month="10", day="7")
+        cushy_post_integration.get_rates()
+        self.assertEqual([call.request.url.split("/")[-1] for call in responses.calls].count("rate"), 3)
+        # the collection date is computed again, a second later
+        cushy_post_integration.set_services("2021", month="10", day="7")
+        self.assertEqual(cushy_post_integration.services["collection"]["date"][:10], "2021-10-07")
+        cushy_post_integration.services["collection"]["date"] = "2021-10-07T23:59:59Z"
+        cushy_post_integration.get_rates()
+        self.assertEqual([call.request.url.split("/")[-1] for call in responses.calls].count("rate"), 3)
+        cushy_post_integration.set_services("2021", month="10", day="7", insurance_value="100")
+        cushy_post_integration.get_rates()
+        self.assertEqual([call.request.url.split("/")[-1] for call in responses.calls].count("rate"), 4)
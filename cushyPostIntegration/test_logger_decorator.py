@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+from cushyPostIntegration.logger_decorator import logger
+import logging
+import traceback
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+@logger
+def add(first, second):
+    return first + second
+
+
+@logger
+def fail():
+    raise ValueError("failed")
+
+
+@logger
+async def async_add(first, second):
+    return first + second
+
+
+class TestLoggerDecorator(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.level = logging.getLogger().level
+
+    def tearDown(self):
+        logging.getLogger().setLevel(self.level)
+
+    async def test_debug_enabled(self):
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            self.assertEqual(add(1, 2), 3)
+            self.assertEqual(await async_add(1, 2), 3)
+        self.assertEqual([record.getMessage() for record in logs.records if "seconds" not in record.getMessage()],
+                         ["About to run add", "Done running add", "About to run async_add", "Done running async_add"])
+        self.assertEqual(add.__name__, "add")
+
+    async def test_debug_disabled(self):
+        logging.getLogger().setLevel(logging.INFO)
+        with mock.patch("cushyPostIntegration.logger_decorator.logging.debug") as debug:
+            self.assertEqual(add(1, 2), 3)
+            self.assertEqual(await async_add(1, 2), 3)
+            self.assertRaises(ValueError, fail)
+        debug.assert_not_called()
+
+    def test_traceback(self):
+        for level in (logging.DEBUG, logging.INFO):
+            logging.getLogger().setLevel(level)
+            try:
+                fail()
+            except ValueError as error:
+                lines = [frame.line for frame in traceback.extract_tb(error.__traceback__)]
+            self.assertNotIn("raise error", lines)
+            self.assertEqual(lines[-1], 'raise ValueError("failed")')
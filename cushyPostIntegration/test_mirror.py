@@ -0,0 +1,121 @@
+import unittest
+from cushyPostIntegration import CushyPostIntegration, ShipmentMirror
+import datetime
+import os
+import json
+import responses
+import logging
+import tempfile
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+DAY = 24 * 60 * 60 * 1000
+START = 1640995200000  # 2022-01-01
+
+
+class TestShipmentMirror(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "mirror.sqlite")
+        self.shipments = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def add_shipment(self, index, status, collection_date):
+        self.shipments.append({"_id": {"$oid": "ID{:03d}".format(index)}, "quotation": {"id": "Q{:03d}".format(index)},
+                               "status": {"current": {"value": status}},
+                               "services": {"collection": {"date": {"$date": {"$numberLong": str(collection_date)}}}}})
+
+    def add_search_callback(self, domain):
+        def request_callback(request):
+            request_sent = json.loads(request.body)
+            to_pay = "$in" in request_sent["filter"]["status.current.value"]
+            shipments = sorted([shipment for shipment in self.shipments
+                                if (shipment["status"]["current"]["value"] == "WaitingForPayment") == to_pay],
+                               key=ShipmentMirror._collection_date, reverse=True)
+            items = shipments[request_sent["skip"]:request_sent["skip"] + request_sent["limit"]]
+            return 200, {}, json.dumps({"response": {"data": {"total": len(shipments), "items": items}}})
+
+        responses.add_callback(responses.POST, "{}/shipment/search".format(domain),
+                               callback=request_callback, content_type='application/json')
+
+    def get_client(self):
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP")
+        cushy_post_integration.token = "X-Cushypost-JWT_LOGIN"
+        cushy_post_integration.refresh_token = "X-Cushypost-Refresh-JWT_REFRESH"
+        return cushy_post_integration
+
+    @responses.activate
+    def test_sync(self):
+        cushy_post_integration = self.get_client()
+        self.add_search_callback(cushy_post_integration.domain)
+        for index in range(20):
+            self.add_shipment(index, "Delivered", START + index * DAY)
+        for index in range(20, 25):
+            self.add_shipment(index, "WaitingForPayment", START + index * DAY)
+        mirror = ShipmentMirror(cushy_post_integration, self.path, page_size=5, rescan_days=0)
+        self.assertEqual(mirror.sync(), {ShipmentMirror.PAID: 20, ShipmentMirror.TO_PAY: 5})
+        self.assertEqual(len(responses.calls), 5)
+        self.assertEqual(len(mirror), 25)
+        self.assertEqual(mirror.watermark(ShipmentMirror.PAID), START + 19 * DAY)
+
+        # a quotation is paid and a new one is created
+        self.shipments[22]["status"]["current"]["value"] = "Delivered"
+        self.add_shipment(25, "WaitingForPayment", START + 25 * DAY)
+        self.assertEqual(mirror.sync(), {ShipmentMirror.PAID: 2, ShipmentMirror.TO_PAY: 2})
+        # only the first page of each search is downloaded again
+        self.assertEqual(len(responses.calls), 7)
+        self.assertEqual(len(mirror), 26)
+        self.assertEqual(mirror.get("ID022")["status"]["current"]["value"], "Delivered")
+        self.assertEqual([shipment["_id"]["$oid"] for shipment in mirror.by_status("WaitingForPayment")],
+                         ["ID025", "ID024", "ID023", "ID021", "ID020"])
+        self.assertEqual([shipment["_id"]["$oid"] for shipment in mirror.by_quotation_id(["Q001", "Q022", "Q999"])],
+                         ["ID022", "ID001"])
+        self.assertEqual([shipment["_id"]["$oid"] for shipment in
+                          mirror.by_collection_date(datetime.date(2022, 1, 3), START + 5 * DAY)],
+                         ["ID004", "ID003", "ID002"])
+        self.assertEqual(len(mirror.by_collection_date(kind=ShipmentMirror.TO_PAY)), 5)
+        self.assertIsNone(mirror.get("MISSING"))
+        mirror.close()
+
+        # the mirror survives the process
+        mirror = ShipmentMirror(cushy_post_integration, self.path)
+        self.assertEqual(len(mirror), 26)
+        self.assertEqual(mirror.sync(full=True), {ShipmentMirror.PAID: 21, ShipmentMirror.TO_PAY: 5})
+        self.assertEqual(len(mirror), 26)
+        mirror.close()
+
+    @responses.activate
+    def test_sync_below_watermark(self):
+        cushy_post_integration = self.get_client()
+        self.add_search_callback(cushy_post_integration.domain)
+        for index in range(20):
+            self.add_shipment(index, "Confirmed", START + index * DAY)
+        mirror = ShipmentMirror(cushy_post_integration, self.path, page_size=5, rescan_days=5)
+        self.assertEqual(mirror.sync(), {ShipmentMirror.PAID: 20, ShipmentMirror.TO_PAY: 0})
+        self.assertEqual(mirror.watermark(ShipmentMirror.PAID), START + 19 * DAY)
+
+        # a new shipment collected before the last one, and an older shipment delivered
+        self.add_shipment(20, "Confirmed", START + 17 * DAY)
+        self.shipments[15]["status"]["current"]["value"] = "Delivered"
+        self.shipments[5]["status"]["current"]["value"] = "Delivered"
+        calls = len(responses.calls)
+        self.assertEqual(mirror.sync(), {ShipmentMirror.PAID: 7, ShipmentMirror.TO_PAY: 0})
+        self.assertEqual(len(responses.calls) - calls, 3)
+        self.assertEqual(len(mirror), 21)
+        self.assertEqual(mirror.get("ID020")["status"]["current"]["value"], "Confirmed")
+        self.assertEqual(mirror.get("ID015")["status"]["current"]["value"], "Delivered")
+        self.assertEqual(mirror.watermark(ShipmentMirror.PAID), START + 19 * DAY)
+        # outside of the window only a full sync sees the change
+        self.assertEqual(mirror.get("ID005")["status"]["current"]["value"], "Confirmed")
+        mirror.sync(full=True)
+        self.assertEqual(mirror.get("ID005")["status"]["current"]["value"], "Delivered")
+
+        # a shipment deleted within the window is removed
+        del self.shipments[18]
+        mirror.sync()
+        self.assertIsNone(mirror.get("ID018"))
+        self.assertEqual(len(mirror), 20)
+        mirror.close()
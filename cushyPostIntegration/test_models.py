@@ -0,0 +1,111 @@
+import unittest
+from cushyPostIntegration import CushyPostIntegration
+from cushyPostIntegration.models import Model, Location, Package, Shipping, Services, RatesRequest
+import responses
+import datetime
+import json
+import logging
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestModels(unittest.TestCase):
+    def get_rates_request(self):
+        geo_location = {"id": "b9b645b94641103026828a421dec14ce", "province": "RM", "region": "Lazio",
+                        "postcode": "00020", "city": "Vivaro Romano",
+                        "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}
+        packages = [Package(type="Parcel", height="10", width="10", length="10", weight="10", content="content",
+                            hash="HASH1"),
+                    Package(type="Pallet", height="20", width="20", length="20", weight="5", content="books",
+                            hash="HASH2")]
+        return RatesRequest(app="NEW_APP",
+                            from_location=Location.from_geo_db("IT", "00020", geo_location, "from"),
+                            to_location=Location.from_geo_db("IT", "00020", geo_location, "to"),
+                            shipping=Shipping(goods_desc="content", product="All", special_instructions="Nessuna",
+                                              packages=packages),
+                            services=Services(collection_date="2021-10-06T15:31:51Z", hours=(10, 14),
+                                              insurance_value="10"))
+
+    def test_encode(self):
+        rates_request = self.get_rates_request()
+        self.assertEqual(json.loads(rates_request.encode()), rates_request.to_dict())
+        self.assertEqual(rates_request.to_dict()["shipping"]["total_weight"], 15)
+        self.assertEqual(rates_request.to_dict()["services"]["insurance"],
+                         {"value": 10.0, "currency": "EUR", "algorithm": "any"})
+        self.assertFalse(hasattr(rates_request.from_location, "__dict__"))
+        self.assertRaises(AttributeError, setattr, rates_request.from_location, "other", 1)
+        self.assertRaises(TypeError, Package, colour="red")
+        self.assertRaises(TypeError, Model)
+
+    def test_cached_encoding(self):
+        rates_request = self.get_rates_request()
+        encoded = rates_request.from_location.encode()
+        self.assertIs(rates_request.from_location.encode(), encoded)
+        rates_request.from_location.address = "Via Nomentana 350"
+        self.assertEqual(json.loads(rates_request.from_location.encode())["address"], "Via Nomentana 350")
+        # a change of a package is seen by the shipping
+        rates_request.shipping.encode()
+        rates_request.shipping.packages[1].weight = "15"
+        shipping = json.loads(rates_request.encode())["shipping"]
+        self.assertEqual(shipping["total_weight"], 25)
+        self.assertEqual(shipping["packages"][1]["weight"], "15")
+        rates_request.shipping.packages = rates_request.shipping.packages[:1]
+        self.assertEqual(json.loads(rates_request.encode()), rates_request.to_dict())
+        self.assertEqual(rates_request, self.get_rates_request().__class__(**{
+            field: getattr(rates_request, field) for field in RatesRequest.FIELDS}))
+
+    def test_client_nodes(self):
+        cushy_post_integration = CushyPostIntegration("PRD", "NEW_APP")
+        cushy_post_integration.set_shipping([{"height": "10", "width": "10", "length": "10", "weight": "10",
+                                              "hash": "HASH1"}], special_instructions="Fragile")
+        self.assertEqual(cushy_post_integration.shipping, {
+            "total_weight": 10, "goods_desc": "content", "product": "All", "special_instructions": "Fragile",
+            "packages": [{"type": "Parcel", "height": "10", "width": "10", "length": "10", "weight": "10",
+                          "content": "content", "hash": "HASH1"}]})
+        self.assertEqual(cushy_post_integration._services_model(datetime.datetime(2021, 10, 6, 15, 31, 51)).to_dict(), {
+            "collection": {"date": "2021-10-06T15:31:51Z", "hours": [10, 14]},
+            "insurance": {"value": 0, "currency": "EUR", "algorithm": "none"},
+            "cash_on_delivery": {"value": 0, "currency": "EUR"}})
+
+    @responses.activate
+    def test_client_models(self):
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", token="X-Cushypost-JWT_LOGIN")
+        cushy_post_integration.geo_db_data = {"IT_00020_City": {
+            "id": "HASH_00020", "province": "RM", "region": "Lazio", "postcode": "00020", "city": "City",
+            "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}}
+        responses.add(responses.POST, "{}/calendar/holidays".format(cushy_post_integration.domain),
+                      json={"response": {"data": []}},
+                      status=200)
+        responses.add(responses.POST, "{}/shipment/rate".format(cushy_post_integration.domain),
+                      json={"response": {"data": {"list": []}}},
+                      status=200)
+        cushy_post_integration.set_from("IT", "00020", "City")
+        cushy_post_integration.set_to("IT", "00020", "City")
+        cushy_post_integration.set_services("2021", month="10", day="6")
+        cushy_post_integration.set_shipping([{"height": "10", "width": "10", "length": "10", "weight": "10"}])
+        # the nodes are kept as models, the JSON of each one is encoded once
+        rates_request = cushy_post_integration._current_rates_body()
+        self.assertIsInstance(rates_request, RatesRequest)
+        self.assertIs(rates_request.from_location.encode(), cushy_post_integration._current_rates_body().from_location
+                      .encode())
+        self.assertEqual(cushy_post_integration.get_rates(), {"list": []})
+        self.assertEqual(responses.calls[-1].request.body, rates_request.encode())
+        self.assertIsInstance(cushy_post_integration._current_rates_body(), RatesRequest)
+        self.assertEqual(cushy_post_integration.get_snapshot()[:3], b"CPS")
+        self.assertIsInstance(cushy_post_integration._current_rates_body(), RatesRequest)
+        # printing or comparing the instance does not change the nodes
+        self.assertEqual(json.loads(str(cushy_post_integration))["from_location"], rates_request.from_location.to_dict())
+        self.assertEqual(cushy_post_integration, cushy_post_integration)
+        cushy_post_integration.get_dict()
+        self.assertIsInstance(cushy_post_integration._current_rates_body(), RatesRequest)
+        cushy_post_integration.get_rates()
+        self.assertEqual(responses.calls[-1].request.body, rates_request.encode())
+
+        # once read, a node is a dictionary that can be changed in place
+        cushy_post_integration.from_location["name"] = "Mario Rossi"
+        cushy_post_integration.get_rates()
+        request_sent = json.loads(responses.calls[-1].request.body)
+        self.assertEqual(request_sent["from"]["name"], "Mario Rossi")
+        self.assertEqual(request_sent, dict(rates_request.to_dict(), **{"from": dict(
+            rates_request.from_location.to_dict(), name="Mario Rossi")}))
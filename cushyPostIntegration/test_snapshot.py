@@ -0,0 +1,129 @@
+import unittest
+from cushyPostIntegration import CushyPostIntegration, MemoryCache, snapshot
+from cushyPostIntegration.exceptions import InvalidSnapshot, MissingSnapshot
+from cushyPostIntegration.models import Location
+import logging
+import zlib
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestSnapshot(unittest.TestCase):
+    def get_client(self, geo_cache=None):
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", token="X-Cushypost-JWT_LOGIN",
+                                                      refresh_token="X-Cushypost-Refresh-JWT_REFRESH",
+                                                      geo_cache=geo_cache)
+        cushy_post_integration.geo_db_data = {"IT_{:05d}_City".format(cap): {
+            "id": "HASH_{}".format(cap), "province": "RM", "region": "Lazio", "postcode": "{:05d}".format(cap),
+            "city": "City", "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}
+            for cap in range(100)}
+        cushy_post_integration.from_location = Location.from_geo_db(
+            "IT", "00001", cushy_post_integration.geo_db_data["IT_00001_City"], "from")
+        cushy_post_integration.set_shipping([{"height": "10", "width": "10", "length": "10", "weight": "10"}])
+        cushy_post_integration.checkout_session_id = "1234"
+        return cushy_post_integration
+
+    def test_round_trip(self):
+        cushy_post_integration = self.get_client()
+        for compress in (True, False):
+            image = cushy_post_integration.get_snapshot(compress=compress)
+            self.assertEqual(image[:4], b"CPS" + bytes((snapshot.SNAPSHOT_VERSION,)))
+            restored = CushyPostIntegration("PRD", "OTHER_APP")
+            restored.parse_from_snapshot(image)
+            self.assertEqual(restored, cushy_post_integration)
+            self.assertEqual(restored.domain, "https://test.api.cushypost.com")
+        self.assertLess(len(cushy_post_integration.get_snapshot()), len(str(cushy_post_integration)) / 5)
+
+    def test_geo_db_data(self):
+        geo_cache = MemoryCache()
+        cushy_post_integration = self.get_client(geo_cache=geo_cache)
+        for key in ("IT_00001_City", "IT_00002_City"):
+            geo_cache.set(key, cushy_post_integration.geo_db_data[key])
+        image = cushy_post_integration.get_snapshot(geo_db_data="reference")
+        self.assertLess(len(image), len(cushy_post_integration.get_snapshot()))
+        restored = CushyPostIntegration("TEST", "NEW_APP", geo_cache=geo_cache)
+        restored.parse_from_snapshot(image)
+        self.assertEqual(sorted(restored.geo_db_data), ["IT_00001_City", "IT_00002_City"])
+        self.assertEqual(restored.from_location, cushy_post_integration.from_location)
+
+        restored.geo_db_data = {"IT_00003_City": {}}
+        restored.parse_from_snapshot(cushy_post_integration.get_snapshot(geo_db_data="exclude"))
+        self.assertEqual(restored.geo_db_data, {"IT_00003_City": {}})
+        self.assertEqual(restored.shipping, cushy_post_integration.shipping)
+        self.assertRaises(ValueError, cushy_post_integration.get_snapshot, geo_db_data="other")
+
+    def test_invalid_snapshot(self):
+        cushy_post_integration = self.get_client()
+        for image in (b"", b"CPS", str(cushy_post_integration).encode(), b"CPS\x00\x00{}",
+                      b"CPS" + bytes((snapshot.SNAPSHOT_VERSION, snapshot.COMPRESSED)) + b"not zlib"):
+            self.assertRaises(InvalidSnapshot, cushy_post_integration.parse_from_snapshot, image)
+
+    def test_json_backend(self):
+        state = {"token": "token", "shipping": {"packages": [{"weight": 10}]}, "from_location": None}
+        image = snapshot.dumps_snapshot(state, compress=False)
+        orjson = snapshot.orjson
+        snapshot.orjson = None
+        try:
+            self.assertEqual(snapshot.loads_snapshot(image), state)
+            image = snapshot.dumps_snapshot(state)
+        finally:
+            snapshot.orjson = orjson
+        self.assertEqual(snapshot.loads_snapshot(image), state)
+        self.assertEqual(zlib.decompress(image[5:]), b'{"token":"token","shipping":{"packages":[{"weight":10}]},'
+                                                     b'"from_location":null}')
+
+    def test_delta_snapshot(self):
+        cushy_post_integration = self.get_client()
+        self.assertRaises(MissingSnapshot, cushy_post_integration.get_delta_snapshot)
+        image = cushy_post_integration.get_snapshot()
+        session = CushyPostIntegration("TEST", "NEW_APP")
+        session.parse_from_snapshot(image)
+        # nothing changed
+        self.assertEqual(snapshot.loads_snapshot(session.get_delta_snapshot())["set"], {})
+
+        session.checkout_session_id = "5678"
+        session.from_location["address"] = "Via Nomentana 350"
+        session.geo_db_data["IT_99999_City"] = {"id": "HASH_99999"}
+        del session.geo_db_data["IT_00000_City"]
+        first_delta = session.get_delta_snapshot()
+        state = snapshot.loads_snapshot(first_delta)
+        self.assertEqual(sorted(state["set"]), ["checkout_session_id", "from_location"])
+        self.assertEqual(state["geo_db_set"], {"IT_99999_City": {"id": "HASH_99999"}})
+        self.assertEqual(state["geo_db_removed"], ["IT_00000_City"])
+        self.assertLess(len(first_delta), len(image))
+        session.token = "NEW_TOKEN"
+        second_delta = session.get_delta_snapshot(compress=True)
+        self.assertEqual(list(snapshot.loads_snapshot(second_delta)["set"]), ["token"])
+
+        restored = CushyPostIntegration("TEST", "NEW_APP")
+        restored.parse_from_snapshot(image)
+        # the deltas are applied in order, on the snapshot they come from
+        self.assertRaises(MissingSnapshot, restored.apply_delta_snapshot, second_delta)
+        self.assertRaises(InvalidSnapshot, restored.apply_delta_snapshot, image)
+        self.assertRaises(InvalidSnapshot, restored.parse_from_snapshot, first_delta)
+        restored.apply_delta_snapshot(first_delta)
+        restored.apply_delta_snapshot(second_delta)
+        self.assertEqual(restored, session)
+        # the restored instance continues the chain
+        restored.shipping = None
+        third_delta = restored.get_delta_snapshot()
+        session.apply_delta_snapshot(third_delta)
+        self.assertIsNone(session.shipping)
+
+    def test_delta_snapshot_geo_db_reference(self):
+        geo_cache = MemoryCache()
+        cushy_post_integration = self.get_client(geo_cache=geo_cache)
+        image = cushy_post_integration.get_snapshot(geo_db_data="reference")
+        geo_cache.set("IT_99999_City", {"id": "HASH_99999"})
+        cushy_post_integration.geo_db_data["IT_99999_City"] = {"id": "HASH_99999"}
+        delta = cushy_post_integration.get_delta_snapshot()
+        self.assertEqual(snapshot.loads_snapshot(delta)["geo_db_set"], ["IT_99999_City"])
+        restored = CushyPostIntegration("TEST", "NEW_APP", geo_cache=geo_cache)
+        restored.parse_from_snapshot(image)
+        restored.apply_delta_snapshot(delta)
+        self.assertEqual(restored.geo_db_data, {"IT_99999_City": {"id": "HASH_99999"}})
+
+        image = cushy_post_integration.get_snapshot(geo_db_data="exclude")
+        cushy_post_integration.geo_db_data = {}
+        self.assertNotIn("geo_db_removed", snapshot.loads_snapshot(cushy_post_integration.get_delta_snapshot()))
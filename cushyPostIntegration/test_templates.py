@@ -0,0 +1,86 @@
+import unittest
+from cushyPostIntegration import CushyPostIntegration
+from cushyPostIntegration.templates import BodyTemplate, Field, CART_ITEM, RATES
+import json
+import logging
+import os
+import timeit
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestTemplates(unittest.TestCase):
+    def test_render(self):
+        template = BodyTemplate({"app": Field("app"), "filter": {"$in": ["A", "B"]}, "limit": Field("limit"),
+                                 "value": Field("value"), "raw": Field("raw", raw=True), "inspect": False})
+        self.assertEqual(template.fields, ["app", "limit", "value", "raw"])
+        for app, limit, value in [("NEW_APP", 10, None), ("Città \"vecchia\"", 0, 1.5), ("", -1, {"a": [True]})]:
+            self.assertEqual(template.render(app=app, limit=limit, value=value, raw='{"b": 1}'),
+                             json.dumps({"app": app, "filter": {"$in": ["A", "B"]}, "limit": limit, "value": value,
+                                         "raw": {"b": 1}, "inspect": False}))
+        bound = template.bind(app="NEW_APP", raw="[]")
+        self.assertIs(template.bind(raw="[]", app="NEW_APP"), bound)
+        self.assertEqual(bound.fields, ["limit", "value"])
+        self.assertEqual(bound.render(limit=True, value="x"), template.render(app="NEW_APP", limit=True, value="x",
+                                                                              raw="[]"))
+        self.assertRaises(KeyError, bound.render, limit=1)
+        self.assertRaises(TypeError, BodyTemplate, {"app": object()})
+
+    def test_client_bodies(self):
+        cushy_post_integration = CushyPostIntegration("PRD", "NEW_APP")
+        self.assertEqual(json.loads(cushy_post_integration._search_paid_shipping_body(2, page_size=20)), {
+            "app": "NEW_APP", "limit": 20, "skip": 40, "sort": {"services.collection.date": -1},
+            "filter": {"status.current.value": {"$nin": ["WaitingForPayment", "PaymentInitiated", "Draft",
+                                                         "Archived"]}},
+            "match": {"status.current.value": {"$nin": ["WaitingForPayment", "PaymentInitiated", "Draft",
+                                                        "Archived"]}},
+            "inspect": False})
+        self.assertEqual(json.loads(cushy_post_integration._search_quotation_to_pay_body(0)), {
+            "app": "NEW_APP", "limit": 10, "skip": 0, "sort": {"services.collection.date": -1},
+            "filter": {"status.current.value": {"$in": ["WaitingForPayment", "PaymentInitiated"]}}})
+        self.assertEqual(CART_ITEM.bind(app="NEW_APP").render(id="ID1"),
+                         json.dumps({"app": "NEW_APP", "type": "shipment", "id": "ID1"}))
+        self.assertEqual(RATES.fields, ["app", "from", "to", "shipping", "services"])
+
+    @unittest.skipUnless(os.environ.get("CUSHYPOST_BENCHMARK"), "set CUSHYPOST_BENCHMARK=1 to run the benchmark")
+    def test_benchmark(self):
+        cushy_post_integration = CushyPostIntegration("PRD", "NEW_APP", token="X-Cushypost-JWT_LOGIN")
+        cushy_post_integration.geo_db_data = {"IT_00020_Vivaro Romano": {
+            "id": "b9b645b94641103026828a421dec14ce", "province": "RM", "region": "Lazio", "postcode": "00020",
+            "city": "Vivaro Romano", "location": {"type": "Point", "coordinates": ["13.00659", "42.09882"]}}}
+        cushy_post_integration.holiday_cache.set("IT_2021", [])
+        cushy_post_integration.set_from("IT", "00020", "Vivaro Romano")
+        cushy_post_integration.set_to("IT", "00020", "Vivaro Romano")
+        cushy_post_integration.set_services("2021", month="10", day="6", insurance_value="10")
+        cushy_post_integration.set_shipping([{"height": "10", "width": "10", "length": "10", "weight": "10"},
+                                             {"height": "20", "width": "20", "length": "20", "weight": "5"}])
+        search_body = {
+            "app": "NEW_APP", "limit": 50, "skip": 150, "sort": {"services.collection.date": -1},
+            "filter": {"status.current.value": {"$nin": ["WaitingForPayment", "PaymentInitiated", "Draft",
+                                                         "Archived"]}},
+            "match": {"status.current.value": {"$nin": ["WaitingForPayment", "PaymentInitiated", "Draft",
+                                                        "Archived"]}},
+            "inspect": False}
+        rates_request = cushy_post_integration._current_rates_body()
+        rates_body = rates_request.to_dict()
+
+        def new_rates_body():
+            request_body = cushy_post_integration._current_rates_body()
+            request_body.shipping.packages[0].weight = "10"
+            return cushy_post_integration._encode_rates_body(request_body)
+
+        benchmarks = [
+            ("search_paid_shipping", lambda: json.dumps(dict(search_body, skip=150)),
+             lambda: cushy_post_integration._search_paid_shipping_body(3, page_size=50)),
+            ("add_shipping_ids_to_cart", lambda: json.dumps({"app": "NEW_APP", "type": "shipment", "id": "ID001"}),
+             lambda: CART_ITEM.bind(app="NEW_APP").render(id="ID001")),
+            ("get_rates", lambda: json.dumps(rates_body), new_rates_body)
+        ]
+        for name, old_body, new_body in benchmarks:
+            self.assertEqual(json.loads(old_body()), json.loads(new_body()))
+            number = 20000
+            old_time = min(timeit.repeat(old_body, number=number, repeat=5)) / number * 1e6
+            new_time = min(timeit.repeat(new_body, number=number, repeat=5)) / number * 1e6
+            print("{}: json.dumps {:.2f} us, template {:.2f} us".format(name, old_time, new_time))
+            self.assertLess(new_time, old_time)
@@ -0,0 +1,93 @@
+import unittest
+from cushyPostIntegration import CushyPostIntegration, HttpTransport, get_default_transport, set_default_transport, \
+    AsyncHttpTransport, get_default_async_transport
+from cushyPostIntegration.transport import aiohttp
+import asyncio
+import responses
+import logging
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestTransport(unittest.TestCase):
+    def test_default_transport_is_shared(self):
+        first_client = CushyPostIntegration("TEST", "NEW_APP")
+        second_client = CushyPostIntegration("PRD", "OTHER_APP")
+        self.assertIs(first_client.transport, second_client.transport)
+        self.assertIs(first_client.transport, get_default_transport())
+
+    def test_set_default_transport(self):
+        transport = HttpTransport(pool_connections=2, pool_maxsize=20, keep_alive=False)
+        try:
+            set_default_transport(transport)
+            self.assertIs(CushyPostIntegration("TEST", "NEW_APP").transport, transport)
+            self.assertEqual(transport.session.get_adapter("https://test.api.cushypost.com")._pool_maxsize, 20)
+            self.assertEqual(transport.session.headers["Connection"], "close")
+        finally:
+            set_default_transport(None)
+        self.assertIsNot(get_default_transport(), transport)
+
+    @responses.activate
+    def test_calls_go_through_the_transport(self):
+        transport = HttpTransport(timeout=5)
+        cushy_post_integration = CushyPostIntegration("TEST", "NEW_APP", transport=transport)
+        for _ in range(2):
+            responses.add(responses.POST, "{}/security/v1/login".format(cushy_post_integration.domain),
+                          json={"response": {"data": {}}},
+                          status=200,
+                          headers={
+                              "X-Cushypost-JWT": "X-Cushypost-JWT_LOGIN",
+                              "X-Cushypost-Refresh-JWT": "X-Cushypost-Refresh-JWT_REFRESH"
+                          })
+        cushy_post_integration.login("username", "password")
+        CushyPostIntegration("TEST", "NEW_APP", transport=transport).login("username", "password")
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(cushy_post_integration.token, "X-Cushypost-JWT_LOGIN")
+        self.assertEqual(cushy_post_integration.refresh_token, "X-Cushypost-Refresh-JWT_REFRESH")
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+    def test_async_transport_across_event_loops(self):
+        from aiohttp import web
+
+        async def login(request):
+            body = await request.json()
+            return web.json_response({"response": {"data": {"app": body["app"]}}},
+                                     headers={"X-Cushypost-JWT": "JWT"})
+
+        async def call(transport):
+            application = web.Application()
+            application.router.add_post("/security/v1/login", login)
+            runner = web.AppRunner(application)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            try:
+                port = site._server.sockets[0].getsockname()[1]
+                response = await transport.request("POST", "http://127.0.0.1:{}/security/v1/login".format(port),
+                                                   headers={"Content-Type": "application/json"},
+                                                   data='{"app": "NEW_APP"}')
+                return response.status_code, response.headers.get("X-Cushypost-JWT"), response.json(), \
+                    transport.session
+            finally:
+                await runner.cleanup()
+
+        transport = get_default_async_transport()
+        sessions = []
+        for _ in range(2):
+            status_code, token, data, session = asyncio.run(call(transport))
+            self.assertEqual((status_code, token, data), (200, "JWT", {"response": {"data": {"app": "NEW_APP"}}}))
+            sessions.append(session)
+        self.assertIsNot(sessions[0], sessions[1])
+        self.assertTrue(sessions[0].closed)
+        self.assertIsNone(sessions[0].connector)
+
+        async def close():
+            await call(transport)
+            await transport.close()
+            return transport.session
+        self.assertIsNone(asyncio.run(close()))
+
+    @unittest.skipIf(aiohttp is not None, "aiohttp is installed")
+    def test_async_transport_requires_aiohttp(self):
+        self.assertRaises(ImportError, AsyncHttpTransport)
@@ -0,0 +1,258 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class _TokenStoreLock:
+    def __init__(self):
+        """
+        Lock shared by the token stores: exclusive between the owners of this process (threads by default)
+        and, through _lock_process, between processes. It is reentrant for the same owner
+        """
+        self.__condition = threading.Condition()
+        self.__owner = None
+        self.__depth = 0
+        self.__failed = False
+
+    def _lock_process(self, blocking):
+        """
+        Take the lock between processes
+        :param blocking:
+        :return: True when taken, False when held by another process and not blocking
+        """
+        return True
+
+    def _unlock_process(self, failed):
+        """
+        Release the lock between processes
+        :param failed: an exception was raised while holding the lock
+        :return:
+        """
+
+    def acquire(self, blocking=True, owner=None):
+        """
+        Take the lock, as lock() does
+        :param blocking: (optional) with False, return immediately when the lock is held by someone else
+        :param owner: (optional) holder of the lock, by default the current thread (e.g. an asyncio task)
+        :return: True when the lock has been taken
+        """
+        owner = threading.get_ident() if owner is None else owner
+        with self.__condition:
+            if self.__owner == owner:
+                self.__depth += 1
+                return True
+            while self.__owner is not None:
+                if not blocking:
+                    return False
+                self.__condition.wait()
+            # Claimed before locking the process, so that nobody waits on the condition while blocked
+            self.__owner = owner
+        locked = False
+        try:
+            locked = self._lock_process(blocking)
+        finally:
+            with self.__condition:
+                if locked:
+                    self.__depth = 1
+                    self.__failed = False
+                else:
+                    self.__owner = None
+                    self.__condition.notify()
+        return locked
+
+    def release(self, owner=None, failed=False):
+        """
+
+        :param owner: (optional) holder of the lock, by default the current thread
+        :param failed: (optional) an exception was raised while holding the lock
+        :return:
+        """
+        owner = threading.get_ident() if owner is None else owner
+        with self.__condition:
+            if self.__owner != owner:
+                raise RuntimeError("token store lock not held")
+            self.__depth -= 1
+            self.__failed = self.__failed or failed
+            if self.__depth > 0:
+                return
+            try:
+                self._unlock_process(self.__failed)
+            finally:
+                self.__owner = None
+                self.__condition.notify()
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        Exclusive lock between threads and processes, to be held while logging in or refreshing
+        :return:
+        """
+        self.acquire()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.release(failed=failed)
+
+
+class FileTokenStore(_TokenStoreLock):
+    def __init__(self, path):
+        """
+        Token pair stored in a JSON file, shared by all the processes using the same path.
+        The lock is an flock on path + ".lock" (on systems without fcntl it only serializes threads)
+        :param path: path of the file
+        """
+        super(FileTokenStore, self).__init__()
+        self.path = path
+        self.__thread_lock = threading.RLock()
+        self.__lock_file = None
+        self.__cache = (None, (None, None))
+
+    def _lock_process(self, blocking):
+        """
+
+        :param blocking:
+        :return:
+        """
+        lock_file = open("{}.lock".format(self.path), "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        except BaseException:
+            lock_file.close()
+            raise
+        self.__lock_file = lock_file
+        return True
+
+    def _unlock_process(self, failed):
+        """
+
+        :param failed:
+        :return:
+        """
+        lock_file, self.__lock_file = self.__lock_file, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    def load(self):
+        """
+        The file is read again only when it changed
+        :return: token and refresh_token, None when missing
+        """
+        with self.__thread_lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return None, None
+            version = (stat.st_mtime_ns, stat.st_size)
+            if self.__cache[0] != version:
+                with open(self.path, "r") as file:
+                    tokens = json.load(file)
+                self.__cache = (version, (tokens.get("token"), tokens.get("refresh_token")))
+            return self.__cache[1]
+
+    def save(self, token, refresh_token):
+        """
+
+        :param token:
+        :param refresh_token:
+        :return:
+        """
+        with self.__thread_lock:
+            temporary_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(temporary_path, "w") as file:
+                json.dump({"token": token, "refresh_token": refresh_token}, file)
+            os.replace(temporary_path, self.path)
+
+
+class SQLiteTokenStore(_TokenStoreLock):
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, path, key="default"):
+        """
+        Token pair stored on a SQLite database, shared by all the processes using the same path and key
+        :param path: path of the database file
+        :param key: (optional) name of the token pair, e.g. to keep TEST and PRD in the same file
+        """
+        super(SQLiteTokenStore, self).__init__()
+        self.path = path
+        self.key = key
+        self.__thread_lock = threading.RLock()
+        self.__connection = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, check_same_thread=False,
+                                            isolation_level=None)
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, token TEXT, "
+                                  "refresh_token TEXT, updated_at REAL NOT NULL)")
+
+    def _lock_process(self, blocking):
+        """
+        The lock is a write transaction
+        :param blocking:
+        :return:
+        """
+        with self.__thread_lock:
+            if blocking:
+                self.__connection.execute("BEGIN IMMEDIATE")
+                return True
+            self.__connection.execute("PRAGMA busy_timeout = 0")
+            try:
+                self.__connection.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as error:
+                if "locked" not in str(error) and "busy" not in str(error):
+                    raise
+                return False
+            finally:
+                self.__connection.execute("PRAGMA busy_timeout = {}".format(self.BUSY_TIMEOUT * 1000))
+            return True
+
+    def _unlock_process(self, failed):
+        """
+        The transaction is rolled back when an exception was raised while holding the lock
+        :param failed:
+        :return:
+        """
+        with self.__thread_lock:
+            self.__connection.execute("ROLLBACK" if failed else "COMMIT")
+
+    def load(self):
+        """
+
+        :return: token and refresh_token, None when missing
+        """
+        with self.__thread_lock:
+            row = self.__connection.execute("SELECT token, refresh_token FROM tokens WHERE key = ?",
+                                            (self.key,)).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+    def save(self, token, refresh_token):
+        """
+
+        :param token:
+        :param refresh_token:
+        :return:
+        """
+        with self.__thread_lock:
+            self.__connection.execute("INSERT OR REPLACE INTO tokens (key, token, refresh_token, updated_at) "
+                                      "VALUES (?, ?, ?, ?)", (self.key, token, refresh_token, time.time()))
+
+    def close(self):
+        """
+
+        :return:
+        """
+        self.__connection.close()
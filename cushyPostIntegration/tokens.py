@@ -0,0 +1,19 @@
+import base64
+import binascii
+import json
+
+
+def get_token_expiry(token):
+    """
+    Read the expiry (exp claim) of a JWT. The signature is not verified, CushyPost does it
+    :param token: the JWT
+    :return: expiry as timestamp, None when the token is not a JWT or it has no expiry
+    """
+    if not token:
+        return None
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError, binascii.Error):
+        return None
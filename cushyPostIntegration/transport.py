@@ -0,0 +1,212 @@
+import asyncio
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from cushyPostIntegration.logger_decorator import logger
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class HttpTransport:
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, max_retries=0, keep_alive=True,
+                 timeout=None):
+        """
+        Transport backed by a persistent requests.Session, so connections and TLS sessions are reused
+        :param pool_connections: (optional) number of per-host connection pools to cache
+        :param pool_maxsize: (optional) maximum number of connections kept alive for each host
+        :param pool_block: (optional) block when a host pool is exhausted instead of opening extra connections
+        :param max_retries: (optional) retries on connection errors, handled by urllib3
+        :param keep_alive: (optional) set to False to close the connection after every call
+        :param timeout: (optional) timeout in seconds applied to every call
+        """
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block,
+                              max_retries=max_retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    @logger
+    def request(self, http_method, url, headers=None, data=None, params=None):
+        """
+        Execute the call on the pooled session
+        :param http_method: GET/POST/PATCH/DELETE
+        :param url: full url to call
+        :param headers: (optional) headers of the call
+        :param data: (optional) body of the message as string
+        :param params: (optional) query parameters
+        :return:
+        """
+        return self.session.request(http_method,
+                                    url,
+                                    headers=headers,
+                                    data=data,
+                                    params=params,
+                                    timeout=self.timeout)
+
+    def close(self):
+        """
+        Release all the pooled connections
+        :return:
+        """
+        self.session.close()
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    """
+    Transport shared by every client that has not been given one explicitly
+    :return:
+    """
+    global _default_transport
+    if _default_transport is None:
+        with _default_transport_lock:
+            if _default_transport is None:
+                _default_transport = HttpTransport()
+    return _default_transport
+
+
+def set_default_transport(transport):
+    """
+    Replace the shared transport (e.g. to configure the pool size once at startup)
+    :param transport: the new transport, None to go back to the default one
+    :return:
+    """
+    global _default_transport
+    with _default_transport_lock:
+        _default_transport = transport
+
+
+class AsyncResponse:
+    def __init__(self, status_code, headers, content):
+        """
+        Fully read response of an AsyncHttpTransport call
+        :param status_code:
+        :param headers:
+        :param content: body of the response as bytes
+        """
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """
+
+        :return:
+        """
+        return json.loads(self.content)
+
+
+class AsyncHttpTransport:
+    def __init__(self, pool_maxsize=100, pool_maxsize_per_host=0, keep_alive=True, timeout=None):
+        """
+        Transport backed by a persistent aiohttp session. It requires aiohttp to be installed
+        :param pool_maxsize: (optional) maximum number of simultaneous connections
+        :param pool_maxsize_per_host: (optional) maximum number of simultaneous connections to the same host, 0 is no limit
+        :param keep_alive: (optional) set to False to close the connection after every call
+        :param timeout: (optional) timeout in seconds applied to every call
+        """
+        if aiohttp is None:
+            raise ImportError("aiohttp is required to use the asyncio client")
+        self.pool_maxsize = pool_maxsize
+        self.pool_maxsize_per_host = pool_maxsize_per_host
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.__sessions = {}
+
+    @property
+    def session(self):
+        """
+
+        :return: session of the running event loop, None when there is none
+        """
+        return self.__sessions.get(asyncio.get_running_loop())
+
+    async def __close_stale_sessions(self):
+        """
+        Close the sessions of the event loops already closed. Their connections can no longer be used, closing
+        the session releases its connector
+        :return:
+        """
+        for closed_loop in [loop for loop in self.__sessions if loop.is_closed()]:
+            await self.__sessions.pop(closed_loop).close()
+
+    async def __get_session(self):
+        """
+        The sessions are created lazily, one for each event loop, as an aiohttp session can only be
+        used on the loop where it was created. The sessions of the loops already closed are closed
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        session = self.__sessions.get(loop)
+        if session is None or session.closed:
+            await self.__close_stale_sessions()
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize,
+                                             limit_per_host=self.pool_maxsize_per_host,
+                                             force_close=not self.keep_alive)
+            session = self.__sessions[loop] = aiohttp.ClientSession(connector=connector,
+                                                                    timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return session
+
+    @logger
+    async def request(self, http_method, url, headers=None, data=None, params=None):
+        """
+        Execute the call on the pooled session
+        :param http_method: GET/POST/PATCH/DELETE
+        :param url: full url to call
+        :param headers: (optional) headers of the call
+        :param data: (optional) body of the message as string
+        :param params: (optional) query parameters
+        :return:
+        """
+        session = await self.__get_session()
+        async with session.request(http_method, url, headers=headers, data=data, params=params) as response:
+            content = await response.read()
+            return AsyncResponse(response.status, response.headers, content)
+
+    async def close(self):
+        """
+        Release the pooled connections of the running event loop and the sessions of the loops already closed
+        :return:
+        """
+        session = self.__sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+        await self.__close_stale_sessions()
+
+
+_default_async_transport = None
+
+
+def get_default_async_transport():
+    """
+    Async transport shared by every async client that has not been given one explicitly
+    :return:
+    """
+    global _default_async_transport
+    if _default_async_transport is None:
+        with _default_transport_lock:
+            if _default_async_transport is None:
+                _default_async_transport = AsyncHttpTransport()
+    return _default_async_transport
+
+
+def set_default_async_transport(transport):
+    """
+    Replace the shared async transport
+    :param transport: the new transport, None to go back to the default one
+    :return:
+    """
+    global _default_async_transport
+    with _default_transport_lock:
+        _default_async_transport = transport
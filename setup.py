@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 setup(
   name='cushyPostIntegration',
   packages=['cushyPostIntegration'],
@@ -11,6 +11,7 @@ setup(
   download_url='https://github.com/Amedeo91/cushypost_integration/archive/refs/tags/V_0.0.9.tar.gz',
   keywords=['cushyPost', 'shipping', 'shipping costs'],
   install_requires=['requests'],
+  extras_require={'async': ['aiohttp'], 'numpy': ['numpy']},
   classifiers=[
     'Development Status :: 3 - Alpha',
     'Intended Audience :: Developers',